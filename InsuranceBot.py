@@ -1,126 +1,245 @@
-import os
 from telegram import Update
+from telegram.constants import ChatAction
 from telegram.ext import ContextTypes
 from mindee_api import MindeeClient
-from gemini_client import GeminiClient
+from gemini_client import GeminiClient, GeminiError
 from database import ChatHistoryDB
-import traceback
+from session_cache import SessionCache
+from summarizer import ChatSummarizer
+from ocr_cache import OCRCache
+from chat_lock import create_chat_locks
+from ocr_scheduler import OCRScheduler, OCRJobCancelled, OCRQueueFull
+from streaming import StreamRelay
+from outbox import Outbox
+from config import GEMINI_STREAMING, INTENT_FAST_PATH, PROMPT_HISTORY_TOKENS
+from intents import FOLLOW_UPS, IntentClassifier
+from prompts import SYSTEM_PROMPT, build_contents, estimate_tokens, fit_turns
+from documents import documents_summary, format_document
+from policy import new_policy, render_policy, render_policy_pdf
+from metrics import ERRORS, INTENTS, stage, update_span
+from logs import redact
+from startup import STARTUP
+import asyncio
+import functools
+import logging
 import re
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def doc_type_for_step(step: int) -> str:
+    return "passport" if step < 3 else "vehicle"
+
+
+def serialized_per_chat(handler):
+    # Runs the handler under the chat's lock; with a distributed lock the cached
+    # session is reloaded before and written back before the lease is released,
+    # or dropped if another worker took the lease in the meantime
+    @functools.wraps(handler)
+    async def wrapper(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        chat_id = str(update.effective_chat.id)
+        with update_span(handler.__name__, chat_id):
+            self.update_received(update)
+            async with self.chat_locks.hold(chat_id) as lease:
+                if self.chat_locks.distributed:
+                    await self.db.invalidate(chat_id)
+                try:
+                    result = await handler(self, update, context)
+                finally:
+                    # Replies queued by the handler go out together, still in the chat's order
+                    await self.outbox.flush(update.effective_chat.id)
+                    if lease.lost:
+                        self.db.discard(chat_id)
+                    elif self.chat_locks.distributed:
+                        await self.db.flush(chat_id)
+        STARTUP.first_update(handler.__name__)
+        # Older turns are folded into the chat's summary after the reply went out
+        self.summarizer.schedule(chat_id, self.gemini_client)
+        return result
+    return wrapper
 
 
 class InsuranceBot:
-    def __init__(self, chat_history_db):
-        self.data_dir = "data/documents"
-        os.makedirs(self.data_dir, exist_ok=True)
-        self.mindee_client = MindeeClient()
-        self.gemini_client = GeminiClient()
-        self.db: ChatHistoryDB = chat_history_db
-        self.prompt = (
-            "FOLLOW THE HISTORY!!!! "
-            "You are a virtual assistant for an insurance company, operating inside a Telegram bot. "
-            "Your job is to politely and clearly help users purchase car insurance. Communicate in a friendly, human-like manner without being too formal. "
-            "Follow this strict scenario and do not deviate: "
-            "1. Greeting and purpose: Briefly introduce yourself and explain that you're here to help with car insurance. Immediately move to the next step. "
-            "2. Request documents: Ask the user to send a photo of their passport. "
-            "3. After passport verification: Ask the user to send a photo of their vehicle identification document. "
-            "4. Data confirmation: Once both documents are processed, display the extracted information as text. Then ask: "
-            "'Please check if everything is correct. If there are any mistakes, you can send either photo again.' "
-            "5. Price: If the user confirms the data, reply: 'The insurance price is 100 USD. This is a fixed rate.' Then ask if they are ready to proceed. "
-            "6. Completion: If the user agrees, generate a detailed car insurance policy using this template:\n\n"
-            "CAR INSURANCE POLICY\n"
-            "Policy Number: POL-{CURRENT_YEAR}-{RANDOM_6_DIGITS}\n"
-            "Issue Date: {CURRENT_DATE}\n\n"
-            "INSURED DETAILS\n"
-            "Full Name: [Extract from passport data]\n"
-            "Document ID: [Extract from passport data]\n"
-            "Address: [Extract from passport data]\n\n"
-            "VEHICLE DETAILS\n"
-            "Make and Model: [Extract from vehicle document]\n"
-            "Vehicle ID/VIN: [Extract from vehicle document]\n"
-            "Year: [Extract from vehicle document]\n\n"
-            "COVERAGE DETAILS\n"
-            "Type: Comprehensive Car Insurance\n"
-            "Coverage Period: 12 months from issue date\n"
-            "Premium Amount: 100 USD\n"
-            "Coverage Includes:\n"
-            "- Third Party Liability (up to $100,000)\n"
-            "- Collision Damage\n"
-            "- Natural Disasters\n"
-            "- Theft Protection\n"
-            "- 24/7 Roadside Assistance\n\n"
-            "TERMS AND CONDITIONS\n"
-            "1. This policy is valid for 12 months from the issue date\n"
-            "2. Claims must be reported within 24 hours of incident\n"
-            "3. Deductible: $500 per claim\n"
-            "4. Policy is non-transferable\n"
-            "5. Coverage is valid within the territory of operation\n\n"
-            "For assistance, contact:\n"
-            "Phone: +1-800-INSURE\n"
-            "Email: support@carinsurance.com\n"
-            "---END OF POLICY---\n\n"
-            "After generating the policy, say: 'Here is your insurance policy. Thank you for using our service!'\n\n"
-            "⚠️ Handling invalid inputs: If the user says something off-topic (e.g., asks about other insurance types, jokes, is rude, or sends nonsense), reply politely and neutrally. For example: "
-            "'I can only help with car insurance. Shall we begin?' "
-            "'Please send the required documents to continue.' "
-            "'Sorry, I can only assist with car insurance at the moment.' "
-            "‼️ Never make up information. Do not pretend to be a real person. Only respond based on known context. If something is unclear — ask the user to clarify. "
-            "Additional instructions: "
-            "- If the user asks questions related to the car insurance process, such as: "
-            "'What kind of insurance is this?' "
-            "'How much does it cost?' "
-            "'What does the insurance cover?' "
-            "or any other reasonable questions about the insurance product or pricing, "
-            "answer these questions politely and clearly, then immediately continue with the current step of the scenario without skipping or restarting steps. "
-            "- Do not deviate from the scenario flow even after answering such questions. Always bring the user back to the next expected step. "
-            "IMPORTANT"
-            "Step tracking: After completing any of the 5 scenario steps, include this line exactly once in your reply to indicate the step number:\n"
-            "'[STEP COMPLETED: X]' where X = CURRENT STEP + 1, if step was completed.(1-6) (if not completed X=-1). DO NOT DECREASE STEP NUMBER!"
-        )
+    def __init__(self, chat_history_db: ChatHistoryDB):
+        # API clients are built on first use (or by warm_up) to keep start-up short
+        self._mindee_client = None
+        self._gemini_client = None
+        self._clients_lock = threading.Lock()
+        self.db = SessionCache(chat_history_db)
+        self.ocr_cache = OCRCache(chat_history_db)
+        self.ocr_scheduler = OCRScheduler()
+        self.chat_locks = create_chat_locks(chat_history_db)
+        self.summarizer = ChatSummarizer(self.db, self.chat_locks)
+        self.outbox = Outbox()
+        self.prompt = SYSTEM_PROMPT
+        self.intents = IntentClassifier()
+        # Newest photo per chat as (message_id, media_group_id, expected doc_type), recorded
+        # before the chat lock is taken
+        self._latest_photos = {}
+
+    @property
+    def mindee_client(self) -> MindeeClient:
+        # Locked because warm_up builds it in a worker thread
+        with self._clients_lock:
+            if self._mindee_client is None:
+                with STARTUP.phase("mindee_client"):
+                    self._mindee_client = MindeeClient()
+        return self._mindee_client
+
+    @mindee_client.setter
+    def mindee_client(self, client):
+        self._mindee_client = client
+
+    @property
+    def gemini_client(self) -> GeminiClient:
+        if self._gemini_client is None:
+            with STARTUP.phase("gemini_client"):
+                self._gemini_client = GeminiClient()
+        return self._gemini_client
+
+    @gemini_client.setter
+    def gemini_client(self, client):
+        self._gemini_client = client
+
+    async def warm_up(self):
+        # Builds the clients in the background once the bot is already receiving updates
+        try:
+            await asyncio.to_thread(lambda: self.mindee_client)
+            self.gemini_client
+        except Exception:
+            # Retried on first use
+            logger.warning("Client warm-up failed", exc_info=True)
+
+    async def close(self):
+        await self.ocr_scheduler.close()
+        await self.summarizer.close()
+        await self.db.close()
+        if self._gemini_client is not None:
+            await self._gemini_client.close()
+
+    def update_received(self, update: Update):
+        # Runs before the update waits for the chat lock (and in webhook mode as soon as it
+        # arrives), so a resent photo cancels the OCR job of the same document still holding
+        # the chat. Safe to call more than once per update.
+        message = update.message
+        if message is None or not message.photo or update.effective_chat is None:
+            return
+        chat_id = str(update.effective_chat.id)
+        previous = self._latest_photos.get(chat_id)
+        if previous is not None and message.message_id <= previous[0]:
+            return
+        step = self.db.peek_step_passed(chat_id)
+        doc_type = doc_type_for_step(step) if step is not None else None
+        self._latest_photos[chat_id] = (message.message_id, message.media_group_id, doc_type)
+        if previous is not None and message.media_group_id is not None and message.media_group_id == previous[1]:
+            # Photos sent together as an album are different documents
+            return
+        self.ocr_scheduler.cancel(chat_id, doc_type)
+
+    def photo_superseded(self, chat_id: str, message, doc_type: str) -> bool:
+        # Same rule as update_received, applied once the photo holds the chat lock
+        latest = self._latest_photos.get(chat_id)
+        if latest is None or latest[0] == message.message_id:
+            return False
+        if message.media_group_id is not None and latest[1] == message.media_group_id:
+            return False
+        return latest[2] is None or latest[2] == doc_type
+
+    async def reply(self, update: Update, text: str):
+        # Queued and coalesced with the handler's other replies, see serialized_per_chat
+        self.outbox.queue_text(update.message, text)
 
+    @serialized_per_chat
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         chat_id = str(update.effective_chat.id)
         message = (
             "Hello! I'm your insurance assistant bot. I'll help you purchase car insurance.\n"
             "To get started, please send me a photo of your passport."
         )
-        await update.message.reply_text(message)
+        await self.reply(update, message)
         await self.db.add_message(chat_id, "/start", message)
         await self.db.set_step_passed(chat_id, 1)
+        # A new purchase gets a new policy number
+        await self.db.set_policy(chat_id, {})
 
     async def unknown(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.message.reply_text(
-            "Sorry, I don't understand that command. Please send /start to begin the insurance process."
+        await self.outbox.send_text(
+            update.message, "Sorry, I don't understand that command. Please send /start to begin the insurance process."
         )
 
+    @serialized_per_chat
     async def handle_photo(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        chat_id = str(update.effective_chat.id)
+        try:
+            await self.process_photo(update, context)
+        finally:
+            latest = self._latest_photos.get(chat_id)
+            if latest is not None and latest[0] == update.message.message_id:
+                del self._latest_photos[chat_id]
+
+    async def process_photo(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         chat_id = str(update.effective_chat.id)
         current_step = await self.db.get_step_passed(chat_id)
 
         if not update.message.photo:
-            await update.message.reply_text("Please send a photo of the required document.")
+            await self.reply(update, "Please send a photo of the required document.")
             return
 
         # Determine document type based on current step
-        doc_type = "passport" if current_step < 3 else "vehicle"
+        doc_type = doc_type_for_step(current_step)
 
         photo = update.message.photo[-1]
         file_id = photo.file_id
 
         try:
-            file = await context.bot.get_file(file_id)
-            downloaded_file = await file.download_as_bytearray()
+            # Resent photos are served from the OCR cache, by file first and then by content
+            cache_keys = [self.ocr_cache.file_key(photo.file_unique_id, doc_type)]
+            mindee_result = await self.ocr_cache.get(cache_keys[0])
+            if mindee_result is None:
+                with stage("download"):
+                    file = await context.bot.get_file(file_id)
+                    downloaded_file = await file.download_as_bytearray()
+                cache_keys.append(self.ocr_cache.content_key(bytes(downloaded_file), doc_type))
+                mindee_result = await self.ocr_cache.get(cache_keys[1])
+                if mindee_result is not None:
+                    await self.ocr_cache.put(cache_keys[:1], doc_type, mindee_result)
 
-            local_path = f"{self.data_dir}/{file_id}.jpg"
-            with open(local_path, "wb") as f:
-                f.write(downloaded_file)
+            self.ocr_cache.record_lookup(mindee_result is not None)
+            if mindee_result is not None:
+                logger.info("OCR cache hit", extra={"chat_id": chat_id, "doc_type": doc_type})
+            progress_message = await self.outbox.send_text(update.message, f"Photo received, processing {doc_type}...")
 
-            print(f"Saved photo to: {local_path}")
-            await update.message.reply_text(f"Photo received, processing {doc_type}...")
+            queued = False
+
+            async def report_progress(position: int):
+                # Only edit the message when the photo actually had to wait
+                nonlocal queued
+                if position > 1:
+                    queued = True
+                    await self.outbox.edit_text(progress_message, f"Photo received, {doc_type} is number {position} in the processing queue...")
+                elif position == 0 and queued:
+                    await self.outbox.edit_text(progress_message, f"Processing {doc_type}...")
 
             try:
-                mindee_result = await self.mindee_client.recognize_document(local_path, doc_type)
+                if mindee_result is None:
+                    if self.photo_superseded(chat_id, update.message, doc_type):
+                        # The same document was sent again while this photo waited for the chat lock
+                        raise OCRJobCancelled(f"Superseded by a newer upload in chat {chat_id}")
+                    # The photo goes to Mindee straight from memory, nothing is written to disk
+                    async with self.outbox.chat_action(update.message, ChatAction.TYPING):
+                        with stage("ocr"):
+                            mindee_result = await self.ocr_scheduler.submit(
+                                chat_id,
+                                # The client is resolved on the OCR thread, building it must not block the event loop
+                                lambda: self.mindee_client.parse(downloaded_file, doc_type, f"{file_id}.jpg"),
+                                report_progress,
+                                tag=doc_type,
+                            )
+                    if mindee_result:
+                        await self.ocr_cache.put(cache_keys, doc_type, mindee_result)
                 if not mindee_result:
-                    await update.message.reply_text(f"Could not extract data from the {doc_type}. Please try again with a clearer photo.")
+                    await self.reply(update, f"Could not extract data from the {doc_type}. Please try again with a clearer photo.")
                     return
 
                 # Store the extracted data
@@ -130,7 +249,7 @@ class InsuranceBot:
                     # After passport, ask for vehicle document
                     response = (
                         f"Passport data processed successfully.\n\n"
-                        f"Extracted text:\n{mindee_result.get('full_text', 'No text extracted')}\n\n"
+                        f"Extracted data:\n{format_document(mindee_result, 'passport')}\n\n"
                         f"Now, please send a photo of your vehicle identification document."
                     )
                     await self.db.set_step_passed(chat_id, 3)
@@ -141,48 +260,126 @@ class InsuranceBot:
                     
                     response = (
                         "Here's all the extracted information:\n\n"
-                        f"Passport Data:\n{passport_data.get('full_text', 'No text extracted')}\n\n"
-                        f"Vehicle Data:\n{vehicle_data.get('full_text', 'No text extracted')}\n\n"
+                        f"Passport Data:\n{format_document(passport_data, 'passport')}\n\n"
+                        f"Vehicle Data:\n{format_document(vehicle_data, 'vehicle')}\n\n"
                         "Please confirm if all information is correct. If not, you can resend either document."
                     )
                     await self.db.set_step_passed(chat_id, 4)
 
-                await update.message.reply_text(response)
+                await self.reply(update, response)
                 await self.db.add_message(chat_id, f"SYSTEM:**{doc_type.capitalize()} photo sent**", response)
 
+            except OCRJobCancelled:
+                # A newer photo from this chat replaced this one
+                logger.info("OCR job superseded", extra={"chat_id": chat_id, "doc_type": doc_type})
+                return
+
+            except OCRQueueFull:
+                ERRORS.inc(where="ocr", type="OCRQueueFull")
+                logger.warning("OCR queue full", extra={"chat_id": chat_id, "doc_type": doc_type})
+                await self.reply(update, "We are processing a lot of documents right now. Please send the photo again in a minute.")
+                return
+
             except Exception as e:
-                print(f"Mindee API error: {str(e)}")
-                await update.message.reply_text(f"Error processing the {doc_type}: {str(e)}. Please try again with a clearer photo.")
+                ERRORS.inc(where="ocr", type=type(e).__name__)
+                logger.error("Mindee API error", exc_info=True, extra={"chat_id": chat_id, "doc_type": doc_type})
+                await self.reply(update, f"Error processing the {doc_type}: {str(e)}. Please try again with a clearer photo.")
                 return
 
         except Exception as e:
-            print(f"Error downloading or saving photo: {str(e)}")
-            await update.message.reply_text("Error saving the photo. Please try again.")
+            ERRORS.inc(where="download", type=type(e).__name__)
+            logger.error("Error downloading photo", exc_info=True, extra={"chat_id": chat_id})
+            await self.reply(update, "Error receiving the photo. Please try again.")
+
+    async def send_policy(self, update: Update, chat_id: str):
+        passport_data = await self.db.get_document_data(chat_id, "passport")
+        vehicle_data = await self.db.get_document_data(chat_id, "vehicle")
+        if not passport_data or not vehicle_data:
+            # Go back to the missing document instead of issuing an empty policy
+            step = 1 if not passport_data else 3
+            await self.db.set_step_passed(chat_id, step)
+            await self.reply(update, f"Both documents are needed before the policy can be issued. {FOLLOW_UPS[step]}")
+            return
+        # Generated once; sending the policy again re-renders the stored number and date
+        policy = await self.db.get_policy(chat_id)
+        if not policy:
+            policy = new_policy()
+            await self.db.set_policy(chat_id, policy)
+        policy_number = policy["number"]
+        policy_text = render_policy(policy, passport_data, vehicle_data)
+
+        await self.reply(update, policy_text)
+        async with self.outbox.chat_action(update.message, ChatAction.UPLOAD_DOCUMENT):
+            # PDF generation is CPU bound, keep it off the event loop
+            with stage("policy_pdf"):
+                policy_pdf = await asyncio.to_thread(render_policy_pdf, policy_text)
+            await self.outbox.send_document(update.message, policy_pdf, f"{policy_number}.pdf")
+        await self.reply(update, "Here is your insurance policy. Thank you for using our service!")
+        logger.info("Policy issued", extra={"chat_id": chat_id, "policy_number": policy_number})
+        await self.db.add_message(chat_id, "SYSTEM:**Policy issued**", policy_text)
 
+    @serialized_per_chat
     async def handle_text(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         chat_id = str(update.effective_chat.id)
         user_input = update.message.text
         
-        chat_history = "Chat History:\n"
-        chat_history += await self.db.get_trimmed_chat_history(chat_id)
-        chat_history += f"User:{user_input} **THIS IS THE LAST MESSAGE FROM USER YOU HAVE TO ANSWER**\n"     
-        chat_history += "HISTORY ENDS"
-        
-        final_prompt = self.prompt + f"\nCURRENT STEP = {await self.db.get_step_passed(chat_id)}"
-        gemini_input = chat_history + "\n" + final_prompt 
-        gemini_response = self.gemini_client.communicate(gemini_input)
-        
-        print(f"GEMINI response: {gemini_response}")
+        current_step = await self.db.get_step_passed(chat_id)
+
+        # Predictable turns are answered from templates without calling Gemini
+        intent = self.intents.classify(current_step, user_input) if INTENT_FAST_PATH else None
+        INTENTS.inc(intent=intent.intent if intent else "llm")
+        if intent:
+            if intent.next_step is not None:
+                await self.db.set_step_passed(chat_id, intent.next_step)
+            await self.reply(update, intent.reply)
+            await self.db.add_message(chat_id, user_input, intent.reply)
+        else:
+            await self.reply_with_gemini(update, chat_id, user_input, current_step)
+
+        # The policy is rendered locally when the user accepts the price at step 5
+        if current_step == 5 and await self.db.get_step_passed(chat_id) >= 6:
+            await self.send_policy(update, chat_id)
+
+    async def reply_with_gemini(self, update: Update, chat_id: str, user_input: str, current_step: int):
+        with stage("prompt_build"):
+            # Summary plus the newest turns that fit the budget, so prompt size stays flat in long chats
+            summary, turns = await self.db.get_prompt_context(chat_id)
+            turns = fit_turns(turns, PROMPT_HISTORY_TOKENS - estimate_tokens(summary))
+            # Compact typed fields instead of the OCR text, so the model can answer questions about the data
+            documents = ""
+            if current_step >= 3:
+                documents = documents_summary(
+                    await self.db.get_document_data(chat_id, "passport"),
+                    await self.db.get_document_data(chat_id, "vehicle"),
+                )
+            contents = build_contents(turns, user_input, current_step, summary, documents)
+        try:
+            async with self.outbox.chat_action(update.message, ChatAction.TYPING):
+                with stage("llm"):
+                    if GEMINI_STREAMING:
+                        # The relay shows the reply as it is generated, without the step marker
+                        relay = StreamRelay(update.message, self.outbox)
+                        gemini_response = await relay.relay(self.gemini_client.stream(contents, self.prompt))
+                    else:
+                        gemini_response = await self.gemini_client.communicate(contents, self.prompt)
+        except GeminiError as e:
+            # The failed turn is not saved, so the next message is answered with a clean history
+            ERRORS.inc(where="llm", type=type(e).__name__)
+            logger.error("Gemini call failed", extra={"chat_id": chat_id, "error": str(e)})
+            await self.reply(update, "Sorry, I can't answer right now. Please send your message again in a moment.")
+            return
+
+        logger.debug("Gemini response", extra={"chat_id": chat_id, "response": redact(gemini_response)})
         match = re.search(r"\[STEP COMPLETED: (-?\d)\]", gemini_response)
         if match:
             step_passed = int(match.group(1))
-            if (step_passed != -1):
+            if step_passed >= 6 and current_step < 5:
+                # Only accepting the price at step 5 can complete the purchase
+                logger.warning("Ignored step jump", extra={"chat_id": chat_id, "from_step": current_step, "to_step": step_passed})
+            elif (step_passed != -1):
                 await self.db.set_step_passed(chat_id, step_passed)
-            print(f"Step completed: {step_passed}")
-            print(f"Step passed: {await self.db.get_step_passed(chat_id)}")
             gemini_response = re.sub(r"\[STEP COMPLETED: -?\d+\]", "", gemini_response).strip()
 
-        await update.message.reply_text(gemini_response)
+        if not GEMINI_STREAMING:
+            await self.reply(update, gemini_response)
         await self.db.add_message(chat_id, user_input, gemini_response)
-
-    
\ No newline at end of file
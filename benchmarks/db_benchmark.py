@@ -0,0 +1,56 @@
+# Micro-benchmark of ChatHistoryDB hot-path calls, default databases setup vs. tuned SQLite.
+# Run from the project root: python -m benchmarks.db_benchmark [--messages N] [--chats N] [--concurrency N]
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+from database import ChatHistoryDB
+
+
+async def run_mode(tuned: bool, messages: int, chats: int, concurrency: int) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        db = ChatHistoryDB(f"sqlite:///{os.path.join(directory, 'bench.db')}", sqlite_tuned=tuned)
+        await db.connect()
+        try:
+            for chat in range(chats):
+                await db.set_step_passed(str(chat), 1)
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def timed(operation, count: int) -> float:
+                async def one(i: int):
+                    async with semaphore:
+                        await operation(str(i % chats), i)
+
+                start = time.perf_counter()
+                await asyncio.gather(*(one(i) for i in range(count)))
+                return count / (time.perf_counter() - start)
+
+            add_message_rate = await timed(lambda chat_id, i: db.add_message(chat_id, f"message {i}", f"response {i}"), messages)
+            get_step_rate = await timed(lambda chat_id, i: db.get_step_passed(chat_id), messages)
+        finally:
+            await db.disconnect()
+    return {
+        "mode": "tuned" if tuned else "default",
+        "add_message_per_sec": round(add_message_rate, 1),
+        "get_step_passed_per_sec": round(get_step_rate, 1),
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=16)
+    args = parser.parse_args()
+
+    results = [await run_mode(tuned, args.messages, args.chats, args.concurrency) for tuned in (False, True)]
+    for result in results:
+        print(f"{result['mode']:>8}: add_message {result['add_message_per_sec']:>9.1f}/s  "
+              f"get_step_passed {result['get_step_passed_per_sec']:>9.1f}/s")
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,126 @@
+# Local HTTP server speaking the Gemini generateContent / streamGenerateContent API with
+# injectable faults, to exercise GeminiClient's timeouts, retries, hedging, circuit breaker and fallbacks.
+# Run from the project root:
+#   python -m benchmarks.fake_gemini_server --port 8081 --error-rate 0.1 --rate-limit-rate 0.05
+# and point the bot or the load test at it with GEMINI_BASE_URL=http://127.0.0.1:8081/v1beta
+import argparse
+import asyncio
+import json
+import random
+from aiohttp import web
+from benchmarks.fakes import LatencyDistribution, scripted_reply
+
+
+def model_name(model: str) -> str:
+    # "gemini-2.0-flash" and "models/gemini-2.0-flash" name the same model
+    return model if model.startswith("models/") else f"models/{model}"
+
+
+class FakeGeminiServer:
+    def __init__(
+        self,
+        latency: LatencyDistribution,
+        error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        hang_rate: float = 0.0,
+        hang_seconds: float = 300.0,
+        failing_models=(),
+        seed: int = None,
+    ):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.hang_rate = hang_rate
+        self.hang_seconds = hang_seconds
+        # Models that always answer 503, e.g. to force a fallback
+        self.failing_models = {model_name(model) for model in failing_models}
+        self._random = random.Random(seed)
+        self.requests = {}
+        self.app = web.Application()
+        self.app.router.add_post("/v1beta/models/{method}", self.generate)
+        self.app.router.add_post("/v1beta/cachedContents", self.cached_contents)
+
+    async def _fault(self, model: str):
+        # Returns an error response to send, or None to answer normally
+        self.requests[model] = self.requests.get(model, 0) + 1
+        if model in self.failing_models:
+            return web.json_response({"error": {"message": "The model is overloaded."}}, status=503)
+        roll = self._random.random()
+        if roll < self.rate_limit_rate:
+            return web.json_response({"error": {"message": "Resource has been exhausted."}}, status=429, headers={"Retry-After": "1"})
+        roll -= self.rate_limit_rate
+        if roll < self.error_rate:
+            return web.json_response({"error": {"message": "Internal error."}}, status=500)
+        roll -= self.error_rate
+        if roll < self.hang_rate:
+            await asyncio.sleep(self.hang_seconds)
+        return None
+
+    async def generate(self, request: web.Request) -> web.StreamResponse:
+        # The route strips the "models/" prefix of the model name
+        model, _, method = request.match_info["method"].partition(":")
+        model = model_name(model)
+        payload = await request.json()
+        fault = await self._fault(model)
+        if fault is not None:
+            return fault
+        reply = scripted_reply(payload["contents"])
+        usage = {"promptTokenCount": len(json.dumps(payload)) // 4, "candidatesTokenCount": len(reply) // 4}
+        usage["totalTokenCount"] = usage["promptTokenCount"] + usage["candidatesTokenCount"]
+
+        if method == "streamGenerateContent":
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+            await response.prepare(request)
+            words = reply.split(" ")
+            for i, word in enumerate(words):
+                await asyncio.sleep(self.latency.sample() / len(words))
+                chunk = {"candidates": [{"content": {"parts": [{"text": word + (" " if i < len(words) - 1 else "")}], "role": "model"}}]}
+                if i == len(words) - 1:
+                    chunk["usageMetadata"] = usage
+                await response.write(f"data: {json.dumps(chunk)}\r\n\r\n".encode("utf-8"))
+            await response.write_eof()
+            return response
+
+        await asyncio.sleep(self.latency.sample())
+        return web.json_response({
+            "candidates": [{"content": {"parts": [{"text": reply}], "role": "model"}, "finishReason": "STOP"}],
+            "usageMetadata": usage,
+        })
+
+    async def cached_contents(self, request: web.Request) -> web.Response:
+        payload = await request.json()
+        return web.json_response({"name": f"cachedContents/fake-{abs(hash(json.dumps(payload))) % 10**8}"})
+
+
+async def start_server(server: FakeGeminiServer, port: int, host: str = "127.0.0.1") -> web.AppRunner:
+    runner = web.AppRunner(server.app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", default="800:0.5", help="median[:sigma] of the log-normal latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument("--hang-rate", type=float, default=0.0, help="share of requests that never answer in time")
+    parser.add_argument("--failing-model", action="append", default=[], help="model that always answers 503, with or without models/")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    server = FakeGeminiServer(
+        LatencyDistribution.parse(args.latency_ms, args.seed),
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        hang_rate=args.hang_rate,
+        failing_models=args.failing_model,
+        seed=args.seed,
+    )
+    print(f"Fake Gemini listening on http://127.0.0.1:{args.port}/v1beta")
+    web.run_app(server.app, host="127.0.0.1", port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
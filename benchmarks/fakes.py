@@ -0,0 +1,175 @@
+# Offline stand-ins for Telegram, Gemini and Mindee used by the load test.
+import asyncio
+import itertools
+import os
+import random
+import re
+import time
+
+
+class LatencyDistribution:
+    # Log-normal latency around a median, a common shape for remote API response times
+    def __init__(self, median_ms: float, sigma: float = 0.5, seed: int = None):
+        self.median_ms = median_ms
+        self.sigma = sigma
+        self._random = random.Random(seed)
+
+    def sample(self) -> float:
+        if self.median_ms <= 0:
+            return 0.0
+        return self._random.lognormvariate(0, self.sigma) * self.median_ms / 1000
+
+    @classmethod
+    def parse(cls, spec: str, seed: int = None) -> "LatencyDistribution":
+        # "800" or "800:0.6" -> median 800 ms, sigma 0.6
+        median, _, sigma = spec.partition(":")
+        return cls(float(median), float(sigma) if sigma else 0.5, seed)
+
+
+def scripted_reply(contents) -> str:
+    # Answers like the real scenario: completes the current step when the user agrees.
+    # The last part of the last turn is the user's message, the parts before it carry the step note.
+    last_turn = contents[-1]["parts"] if isinstance(contents, list) else [{"text": contents}]
+    match = re.search(r"CURRENT STEP = (-?\d+)", " ".join(part["text"] for part in last_turn))
+    step = int(match.group(1)) if match else 0
+    if re.search(r"\b(yes|ok|confirm|correct|agree)\b", last_turn[-1]["text"], re.I):
+        return f"Thank you, let's continue. [STEP COMPLETED: {step + 1}]"
+    return "This is comprehensive car insurance covering liability, collision and theft. [STEP COMPLETED: -1]"
+
+
+class FakeGemini:
+    # In-process stand-in for GeminiClient; see fake_gemini_server.py to exercise the real client
+    def __init__(self, latency: LatencyDistribution, chunks: int = 5):
+        self.latency = latency
+        self.chunks = chunks
+        self.calls = 0
+
+    async def communicate(self, message, system_instruction: str = None) -> str:
+        self.calls += 1
+        await asyncio.sleep(self.latency.sample())
+        return scripted_reply(message)
+
+    async def stream(self, message, system_instruction: str = None):
+        self.calls += 1
+        reply = scripted_reply(message)
+        size = max(1, len(reply) // self.chunks)
+        for start in range(0, len(reply), size):
+            await asyncio.sleep(self.latency.sample() / self.chunks)
+            yield reply[start:start + size]
+
+    async def close(self):
+        pass
+
+
+class FakeMindee:
+    # parse() blocks like the real SDK, it runs on the OCR scheduler's threads
+    def __init__(self, latency: LatencyDistribution):
+        self.latency = latency
+        self.calls = 0
+
+    def parse(self, data: bytes, doc_type: str, filename: str = "document.jpg") -> dict:
+        self.calls += 1
+        time.sleep(self.latency.sample())
+        if doc_type == "passport":
+            fields = {"name": "TEST USER", "document_id": "AB123456"}
+        else:
+            fields = {"make_model": "Test Car", "vin": "1HGCM82633A004352", "year": "2020"}
+        return {"document_type": doc_type, "product": "fake", "fields": fields, "confidence": {name: 0.99 for name in fields}}
+
+
+class FakeTelegramAPI:
+    # Simulated Bot API round-trip shared by all fake messages
+    def __init__(self, latency: LatencyDistribution):
+        self.latency = latency
+        self.calls = 0
+        self._message_ids = itertools.count(1)
+
+    async def call(self):
+        self.calls += 1
+        await asyncio.sleep(self.latency.sample())
+        return next(self._message_ids)
+
+
+class FakeMessage:
+    def __init__(self, api: FakeTelegramAPI, chat_id: int, text: str = None, photo=None, message_id: int = 0, media_group_id: str = None):
+        self.api = api
+        self.chat_id = chat_id
+        self.text = text
+        self.photo = photo or []
+        self.message_id = message_id
+        self.media_group_id = media_group_id
+
+    async def reply_text(self, text: str, **kwargs) -> "FakeMessage":
+        return FakeMessage(self.api, self.chat_id, text, message_id=await self.api.call())
+
+    async def reply_document(self, document, filename: str = None, **kwargs) -> "FakeMessage":
+        return FakeMessage(self.api, self.chat_id, message_id=await self.api.call())
+
+    async def edit_text(self, text: str, **kwargs) -> "FakeMessage":
+        await self.api.call()
+        self.text = text
+        return self
+
+    async def reply_chat_action(self, action: str, **kwargs) -> bool:
+        await self.api.call()
+        return True
+
+
+class FakePhotoSize:
+    def __init__(self, file_id: str):
+        self.file_id = file_id
+        self.file_unique_id = file_id
+
+
+class FakeFile:
+    def __init__(self, api: FakeTelegramAPI, size: int = 64 * 1024):
+        self.api = api
+        self.size = size
+
+    async def download_as_bytearray(self) -> bytearray:
+        await self.api.call()
+        # Random content so every upload misses the OCR cache like a fresh photo would
+        return bytearray(os.urandom(self.size))
+
+
+class FakeBot:
+    def __init__(self, api: FakeTelegramAPI):
+        self.api = api
+
+    async def get_file(self, file_id: str) -> FakeFile:
+        await self.api.call()
+        return FakeFile(self.api)
+
+    async def send_chat_action(self, chat_id, action, **kwargs):
+        await self.api.call()
+        return True
+
+    async def send_message(self, chat_id, text: str, **kwargs) -> FakeMessage:
+        return FakeMessage(self.api, chat_id, text, message_id=await self.api.call())
+
+    async def send_document(self, chat_id, document, filename: str = None, **kwargs) -> FakeMessage:
+        return FakeMessage(self.api, chat_id, message_id=await self.api.call())
+
+    async def edit_message_text(self, text: str, chat_id=None, message_id=None, **kwargs):
+        await self.api.call()
+        return True
+
+
+class FakeChat:
+    def __init__(self, chat_id: int):
+        self.id = chat_id
+
+
+class FakeUpdate:
+    _update_ids = itertools.count(1)
+
+    def __init__(self, message: FakeMessage):
+        self.update_id = next(self._update_ids)
+        self.message = message
+        self.effective_chat = FakeChat(message.chat_id)
+        self.effective_message = message
+
+
+class FakeContext:
+    def __init__(self, bot: FakeBot):
+        self.bot = bot
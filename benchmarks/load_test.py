@@ -0,0 +1,213 @@
+# End-to-end load test of the bot handlers with offline Telegram, Gemini and Mindee fakes.
+# Every simulated user walks the whole scenario: /start, passport photo, vehicle photo,
+# a free-form question, data confirmation and price agreement (policy issued).
+# Run from the project root: python -m benchmarks.load_test [--users N] [--gemini-ms 800:0.5] [--output FILE]
+# With --gemini-base-url the real GeminiClient is used, e.g. against benchmarks.fake_gemini_server.
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import tempfile
+import time
+from collections import defaultdict
+from benchmarks.fakes import (
+    FakeBot,
+    FakeContext,
+    FakeGemini,
+    FakeMessage,
+    FakeMindee,
+    FakePhotoSize,
+    FakeTelegramAPI,
+    FakeUpdate,
+    LatencyDistribution,
+)
+
+SCENARIO = [
+    ("start", "/start"),
+    ("handle_photo", "passport"),
+    ("handle_photo", "vehicle"),
+    ("handle_text", "What does the insurance cover?"),
+    ("handle_text", "Yes"),
+    ("handle_text", "Yes"),
+]
+
+
+def percentiles(samples) -> dict:
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def at(fraction: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000, 2)
+
+    return {
+        "count": len(ordered),
+        "p50_ms": at(0.50),
+        "p95_ms": at(0.95),
+        "p99_ms": at(0.99),
+        "max_ms": round(ordered[-1] * 1000, 2),
+    }
+
+
+def instrument_db(db, samples: list):
+    # Times every statement ChatHistoryDB sends, whichever query method issued it
+    for name in ("_fetch_one", "_fetch_all", "_execute", "execute_batch"):
+        method = getattr(db, name)
+
+        async def timed(*args, _method=method, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await _method(*args, **kwargs)
+            finally:
+                samples.append(time.perf_counter() - start)
+
+        setattr(db, name, timed)
+
+
+async def monitor_loop_lag(samples: list, interval: float = 0.01):
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - start - interval))
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+async def run(args) -> dict:
+    # Imported here so the environment overrides from the command line are seen by config
+    from database import ChatHistoryDB
+    from gemini_client import GeminiClient
+    from InsuranceBot import InsuranceBot
+    from metrics import STAGE_SECONDS
+
+    api = FakeTelegramAPI(LatencyDistribution.parse(args.telegram_ms, args.seed))
+    bot_api = FakeBot(api)
+    context = FakeContext(bot_api)
+
+    with tempfile.TemporaryDirectory() as directory:
+        db = ChatHistoryDB(args.database_url or f"sqlite:///{os.path.join(directory, 'load_test.db')}")
+        db_samples = []
+        instrument_db(db, db_samples)
+        await db.connect()
+        bot = InsuranceBot(db)
+        if args.gemini_base_url:
+            bot.gemini_client = GeminiClient(base_url=args.gemini_base_url)
+        else:
+            bot.gemini_client = FakeGemini(LatencyDistribution.parse(args.gemini_ms, args.seed))
+        bot.mindee_client = FakeMindee(LatencyDistribution.parse(args.mindee_ms, args.seed))
+
+        handler_samples = defaultdict(list)
+        errors = defaultdict(int)
+        lag_samples = []
+        lag_monitor = asyncio.get_running_loop().create_task(monitor_loop_lag(lag_samples))
+
+        async def simulate_user(user: int):
+            chat_id = 10_000_000 + user
+            for handler_name, payload in SCENARIO:
+                if handler_name == "handle_photo":
+                    message = FakeMessage(api, chat_id, photo=[FakePhotoSize(f"user{user}-{payload}")])
+                else:
+                    message = FakeMessage(api, chat_id, text=payload)
+                start = time.perf_counter()
+                try:
+                    await getattr(bot, handler_name)(FakeUpdate(message), context)
+                except Exception as e:
+                    errors[type(e).__name__] += 1
+                handler_samples[handler_name].append(time.perf_counter() - start)
+                if args.think_ms:
+                    await asyncio.sleep(args.think_ms / 1000)
+
+        async def arrivals():
+            users = []
+            for user in range(args.users):
+                users.append(asyncio.get_running_loop().create_task(simulate_user(user)))
+                if args.arrival_rate:
+                    await asyncio.sleep(1 / args.arrival_rate)
+            await asyncio.gather(*users)
+
+        start = time.perf_counter()
+        await arrivals()
+        elapsed = time.perf_counter() - start
+
+        completed = 0
+        for user in range(args.users):
+            if await bot.db.get_step_passed(str(10_000_000 + user)) >= 6:
+                completed += 1
+        lag_monitor.cancel()
+        await bot.close()
+        await db.disconnect()
+
+    updates = sum(len(samples) for samples in handler_samples.values())
+    all_samples = [sample for samples in handler_samples.values() for sample in samples]
+    return {
+        "revision": git_revision(),
+        "config": vars(args),
+        "elapsed_seconds": round(elapsed, 3),
+        "users_completed": completed,
+        "updates": updates,
+        "updates_per_sec": round(updates / elapsed, 2),
+        "users_per_sec": round(completed / elapsed, 2),
+        "handler_latency": percentiles(all_samples),
+        "handlers": {name: percentiles(samples) for name, samples in handler_samples.items()},
+        "db": dict(percentiles(db_samples), total_seconds=round(sum(db_samples), 3)),
+        "event_loop_lag": percentiles(lag_samples),
+        # Mean time per stage from the bot's own instrumentation
+        "stages": {
+            key[0]: {"count": count, "mean_ms": round(total / count * 1000, 2)}
+            for key, (_, total, count) in STAGE_SECONDS.values.items() if count
+        },
+        "external_calls": {
+            "telegram": api.calls,
+            "gemini": getattr(bot.gemini_client, "calls", None) or bot.gemini_client.usage_totals["requests"],
+            "mindee": bot.mindee_client.calls,
+        },
+        "ocr_scheduler": bot.ocr_scheduler.stats(),
+        "outbox": bot.outbox.stats(),
+        "errors": dict(errors),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--arrival-rate", type=float, default=0, help="users per second, 0 starts all at once")
+    parser.add_argument("--think-ms", type=float, default=0, help="pause between a user's messages")
+    parser.add_argument("--gemini-ms", default="800:0.5", help="median[:sigma] of the log-normal latency")
+    parser.add_argument("--mindee-ms", default="1500:0.4")
+    parser.add_argument("--telegram-ms", default="40:0.3")
+    parser.add_argument("--gemini-base-url", default=None, help="use the real client against this API base URL")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--database-url", default=None, help="defaults to a temporary SQLite file")
+    parser.add_argument("--streaming", action="store_true")
+    parser.add_argument("--no-fast-path", action="store_true")
+    parser.add_argument("--output", default=None, help="also write the JSON report to this file")
+    args = parser.parse_args()
+
+    if args.streaming:
+        os.environ["GEMINI_STREAMING"] = "true"
+    if args.no_fast_path:
+        os.environ["INTENT_FAST_PATH"] = "false"
+
+    report = asyncio.run(run(args))
+    print(
+        f"{report['users_completed']}/{args.users} users in {report['elapsed_seconds']}s, "
+        f"{report['updates_per_sec']} updates/s, handler p95 {report['handler_latency'].get('p95_ms')} ms, "
+        f"db p95 {report['db'].get('p95_ms')} ms, loop lag p99 {report['event_loop_lag'].get('p99_ms')} ms"
+    )
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from contextlib import asynccontextmanager
+from config import CHAT_LOCK_BACKEND, CHAT_LOCK_LEASE_SECONDS
+from database import ChatHistoryDB
+from metrics import ERRORS
+
+logger = logging.getLogger(__name__)
+
+
+# Yielded by hold(); lost is set when a distributed lease was taken over while held,
+# after which the holder must not write the chat's state back
+class ChatLease:
+    def __init__(self):
+        self.lost = False
+
+
+# Serializes work on one chat inside this process
+class LocalChatLocks:
+    distributed = False
+
+    def __init__(self):
+        self._locks = {}
+        self._waiters = {}
+
+    @asynccontextmanager
+    async def hold(self, chat_id: str):
+        lock = self._locks.setdefault(chat_id, asyncio.Lock())
+        self._waiters[chat_id] = self._waiters.get(chat_id, 0) + 1
+        try:
+            async with lock:
+                yield ChatLease()
+        finally:
+            self._waiters[chat_id] -= 1
+            if not self._waiters[chat_id]:
+                del self._waiters[chat_id]
+                del self._locks[chat_id]
+
+
+# Serializes work on one chat across processes with lease rows in the shared database.
+# Leases expire so a crashed worker cannot block a chat forever, and are renewed while held.
+class DatabaseChatLocks:
+    distributed = True
+
+    def __init__(self, db: ChatHistoryDB, lease_seconds: float = CHAT_LOCK_LEASE_SECONDS, poll_interval: float = 0.05):
+        self.db = db
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        # Tasks of this process queue up locally instead of polling the database
+        self._local = LocalChatLocks()
+
+    async def _renew(self, chat_id: str, lease: ChatLease):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                held = await self.db.try_acquire_chat_lease(chat_id, self.owner, time.time(), self.lease_seconds)
+            except Exception:
+                logger.warning("Error renewing chat lease", exc_info=True, extra={"chat_id": chat_id})
+                continue
+            if not held:
+                # The lease expired and another worker took the chat
+                lease.lost = True
+                ERRORS.inc(where="chat_lock", type="LeaseLost")
+                logger.error("Chat lease lost", extra={"chat_id": chat_id, "owner": self.owner})
+                return
+
+    @asynccontextmanager
+    async def hold(self, chat_id: str):
+        async with self._local.hold(chat_id):
+            delay = self.poll_interval
+            while not await self.db.try_acquire_chat_lease(chat_id, self.owner, time.time(), self.lease_seconds):
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 1.0)
+            lease = ChatLease()
+            renew = asyncio.get_running_loop().create_task(self._renew(chat_id, lease))
+            try:
+                yield lease
+            finally:
+                renew.cancel()
+                await self.db.release_chat_lease(chat_id, self.owner)
+
+
+def create_chat_locks(db: ChatHistoryDB, backend: str = CHAT_LOCK_BACKEND):
+    if backend == "database":
+        return DatabaseChatLocks(db)
+    return LocalChatLocks()
@@ -8,4 +8,110 @@ MINDEE_API_KEY = os.getenv("MINDEE_API_KEY")
 INSURANCE_PRICE_USD = int(os.getenv("INSURANCE_PRICE_USD", 100))
 MINDEE_ENDPOINT = os.getenv("MINDEE_ENDPOINT")
 HUGGING_FACE_API_KEY = os.getenv("HUGGING_FACE_API_KEY")
-GOOGLE_GEMINI_API_KEY = os.getenv("GOOGLE_GEMINI_API_KEY")
\ No newline at end of file
+GOOGLE_GEMINI_API_KEY = os.getenv("GOOGLE_GEMINI_API_KEY")
+
+# Gemini HTTP client
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", 8))
+GEMINI_POOL_SIZE = int(os.getenv("GEMINI_POOL_SIZE", 16))
+GEMINI_TIMEOUT_SECONDS = float(os.getenv("GEMINI_TIMEOUT_SECONDS", 60))
+
+# Per-chat session cache
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", 1000))
+SESSION_CACHE_TTL_SECONDS = float(os.getenv("SESSION_CACHE_TTL_SECONDS", 1800))
+SESSION_FLUSH_INTERVAL_SECONDS = float(os.getenv("SESSION_FLUSH_INTERVAL_SECONDS", 2))
+
+# Streaming replies
+GEMINI_STREAMING = os.getenv("GEMINI_STREAMING", "false").lower() in ("1", "true", "yes")
+STREAM_EDIT_INTERVAL_SECONDS = float(os.getenv("STREAM_EDIT_INTERVAL_SECONDS", 1.5))
+
+# Outbound Telegram messages; the Bot API allows about 30 messages/s overall and 1/s per chat
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", 25))
+OUTBOX_CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", 1))
+OUTBOX_CHAT_BURST = int(os.getenv("OUTBOX_CHAT_BURST", 3))
+OUTBOX_MAX_RETRIES = int(os.getenv("OUTBOX_MAX_RETRIES", 3))  # resends after a RetryAfter
+
+# Gemini context caching of the static system instruction
+GEMINI_CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "false").lower() in ("1", "true", "yes")
+GEMINI_CONTEXT_CACHE_TTL_SECONDS = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL_SECONDS", 3600))
+
+# Rule-based intent fast path before the Gemini call
+INTENT_FAST_PATH = os.getenv("INTENT_FAST_PATH", "true").lower() in ("1", "true", "yes")
+
+# OCR result cache
+OCR_CACHE_SIZE = int(os.getenv("OCR_CACHE_SIZE", 500))
+OCR_CACHE_TTL_SECONDS = float(os.getenv("OCR_CACHE_TTL_SECONDS", 7 * 24 * 3600))
+# Rows kept in the ocr_results table; the oldest are deleted beyond it (0 disables)
+OCR_CACHE_DB_MAX_ENTRIES = int(os.getenv("OCR_CACHE_DB_MAX_ENTRIES", 20000))
+
+# Client-side image downscaling before OCR upload (0 disables)
+OCR_MAX_IMAGE_SIDE = int(os.getenv("OCR_MAX_IMAGE_SIDE", 1600))
+OCR_JPEG_QUALITY = int(os.getenv("OCR_JPEG_QUALITY", 85))
+
+# OCR worker pool
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", 4))
+OCR_QUEUE_SIZE = int(os.getenv("OCR_QUEUE_SIZE", 20))
+
+# Mindee products tried in order per document type (comma-separated, names under mindee.product)
+MINDEE_PASSPORT_PRODUCTS = [name.strip() for name in os.getenv("MINDEE_PASSPORT_PRODUCTS", "PassportV1,DriverLicenseV1").split(",") if name.strip()]
+MINDEE_VEHICLE_PRODUCTS = [name.strip() for name in os.getenv("MINDEE_VEHICLE_PRODUCTS", "fr.CarteGriseV1,FullTextOCR").split(",") if name.strip()]
+# Extracted fields below this confidence are marked for the user to check
+OCR_LOW_CONFIDENCE = float(os.getenv("OCR_LOW_CONFIDENCE", 0.5))
+
+# Update delivery: "polling" or "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+# Updates handled at once when polling; same-chat updates stay ordered by the chat locks
+POLLING_CONCURRENCY = int(os.getenv("POLLING_CONCURRENCY", 32))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", os.getenv("RENDER_EXTERNAL_URL", ""))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+PORT = int(os.getenv("PORT", 8080))
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", 32))
+WEBHOOK_MAX_PENDING = int(os.getenv("WEBHOOK_MAX_PENDING", 256))
+
+# Shared state backend
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./chat_history.db")
+DATABASE_POOL_MIN_SIZE = int(os.getenv("DATABASE_POOL_MIN_SIZE", 1))
+DATABASE_POOL_MAX_SIZE = int(os.getenv("DATABASE_POOL_MAX_SIZE", 10))
+# "local" serializes chats within one process, "database" across workers sharing DATABASE_URL
+CHAT_LOCK_BACKEND = os.getenv("CHAT_LOCK_BACKEND", "local").lower()
+CHAT_LOCK_LEASE_SECONDS = float(os.getenv("CHAT_LOCK_LEASE_SECONDS", 30))
+
+# SQLite tuning: persistent WAL connections with a single writer
+SQLITE_TUNED = os.getenv("SQLITE_TUNED", "true").lower() in ("1", "true", "yes")
+SQLITE_READERS = int(os.getenv("SQLITE_READERS", 4))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 5000))
+
+# Observability: leveled logs ("json" or "text") and Prometheus metrics
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+# Logs OCR payloads and replies unredacted; never enable in production
+LOG_DOCUMENT_DATA = os.getenv("LOG_DOCUMENT_DATA", "false").lower() in ("1", "true", "yes")
+# Standalone /metrics endpoint (port 0 disables), local-only unless METRICS_HOST is changed
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9090))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# When set, the public webhook server also serves /metrics to requests with "Authorization: Bearer <token>"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+# Gemini call resilience
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL", "https://generativelanguage.googleapis.com/v1beta")
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "models/gemini-2.0-flash")
+# Comma-separated models tried in order when the primary one keeps failing
+GEMINI_FALLBACK_MODELS = [model.strip() for model in os.getenv("GEMINI_FALLBACK_MODELS", "").split(",") if model.strip()]
+GEMINI_ATTEMPT_TIMEOUT_SECONDS = float(os.getenv("GEMINI_ATTEMPT_TIMEOUT_SECONDS", 20))
+GEMINI_CONNECT_TIMEOUT_SECONDS = float(os.getenv("GEMINI_CONNECT_TIMEOUT_SECONDS", 5))
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", 2))
+GEMINI_BACKOFF_BASE_SECONDS = float(os.getenv("GEMINI_BACKOFF_BASE_SECONDS", 0.5))
+GEMINI_BACKOFF_MAX_SECONDS = float(os.getenv("GEMINI_BACKOFF_MAX_SECONDS", 8))
+# Sends a duplicate request when the first one is slower than this latency percentile (0 disables)
+GEMINI_HEDGE_PERCENTILE = float(os.getenv("GEMINI_HEDGE_PERCENTILE", 0))
+GEMINI_CIRCUIT_FAILURES = int(os.getenv("GEMINI_CIRCUIT_FAILURES", 5))
+GEMINI_CIRCUIT_RESET_SECONDS = float(os.getenv("GEMINI_CIRCUIT_RESET_SECONDS", 30))
+
+# Rolling conversation summary: prompts carry the summary plus the newest turns
+SUMMARY_ENABLED = os.getenv("SUMMARY_ENABLED", "true").lower() in ("1", "true", "yes")
+# Turns kept verbatim, and how many more accumulate before they are folded into the summary
+SUMMARY_RECENT_TURNS = int(os.getenv("SUMMARY_RECENT_TURNS", 4))
+SUMMARY_INTERVAL_TURNS = int(os.getenv("SUMMARY_INTERVAL_TURNS", 6))
+# Budget for summary plus history in a prompt, estimated as characters / 4
+PROMPT_HISTORY_TOKENS = int(os.getenv("PROMPT_HISTORY_TOKENS", 1500))
@@ -1,9 +1,46 @@
+import logging
+import re
+import time
 import sqlalchemy
 from databases import Database
-from sqlalchemy import MetaData, Table, Column, Integer, String, Text, select, insert, update, JSON
+from sqlalchemy import MetaData, Table, Column, Float, Index, Integer, String, Text, select, insert, update, delete, func, JSON
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.schema import CreateIndex, CreateTable
+from config import DATABASE_URL, DATABASE_POOL_MIN_SIZE, DATABASE_POOL_MAX_SIZE, SQLITE_BUSY_TIMEOUT_MS, SQLITE_TUNED
+from sqlite_pool import SQLitePool
+from metrics import stage
+
+logger = logging.getLogger(__name__)
+
+LEGACY_TURN_PATTERN = re.compile(r"User: (.*?)\nBot: (.*?)\n(?=User: |\Z)", re.S)
+
+
+def trim_turns(turns, max_length: int = 2048) -> list:
+    # turns are (user_message, bot_response) pairs, oldest first; keeps the newest that fit
+    trimmed = []
+    current_length = 0
+
+    for user_message, bot_response in reversed(turns):
+        entry_length = len(f"User: {user_message}\nBot: {bot_response}\n")
+        if current_length + entry_length > max_length:
+            break
+        trimmed.append((user_message, bot_response))
+        current_length += entry_length
+
+    trimmed.reverse()
+    return trimmed
+
+
+def format_trimmed_history(turns, max_length: int = 2048) -> str:
+    return "".join(
+        f"User: {user_message}\nBot: {bot_response}\n"
+        for user_message, bot_response in trim_turns(turns, max_length)
+    )
+
 
 class ChatHistoryDB:
-    def __init__(self, database_url="sqlite:///./chat_history.db"):
+    def __init__(self, database_url=DATABASE_URL, sqlite_tuned: bool = SQLITE_TUNED):
         self.database_url = database_url
         self.metadata = MetaData()
         self.chat_histories = Table(
@@ -14,81 +51,270 @@ class ChatHistoryDB:
             Column("chat_history", Text, default=""),
             Column("step_passed", Integer, nullable=True),
             Column("passport_data", JSON, nullable=True),
-            Column("vehicle_data", JSON, nullable=True)
+            Column("vehicle_data", JSON, nullable=True),
+            # Rolling summary of the turns up to and including summary_sequence
+            Column("summary", Text, nullable=True),
+            Column("summary_sequence", Integer, nullable=True),
+            # Number and issue date of the chat's policy, generated once when it is first issued
+            Column("policy", JSON, nullable=True)
+        )
+        # One row per turn; chat_histories.chat_history is only kept for migration
+        self.chat_messages = Table(
+            "chat_messages",
+            self.metadata,
+            Column("id", Integer, primary_key=True),
+            Column("chat_id", String, nullable=False),
+            Column("sequence", Integer, nullable=False),
+            Column("user_message", Text, nullable=False),
+            Column("bot_response", Text, nullable=False),
+            Index("ix_chat_messages_chat_id_sequence", "chat_id", "sequence", unique=True)
+        )
+        self.ocr_results = Table(
+            "ocr_results",
+            self.metadata,
+            Column("cache_key", String, primary_key=True),
+            Column("doc_type", String, nullable=False),
+            Column("result", JSON, nullable=False),
+            Column("expires_at", Float, nullable=False, index=True)
+        )
+        # Per-chat leases that serialize updates of one chat across workers
+        self.chat_leases = Table(
+            "chat_leases",
+            self.metadata,
+            Column("chat_id", String, primary_key=True),
+            Column("owner", String, nullable=False),
+            Column("expires_at", Float, nullable=False)
+        )
+        self.schema_migrations = Table(
+            "schema_migrations",
+            self.metadata,
+            Column("version", Integer, primary_key=True),
+            Column("applied_at", Float, nullable=False)
         )
-        self.database = Database(self.database_url)
-        self.engine = sqlalchemy.create_engine(self.database_url)
-        self.metadata.create_all(self.engine)
+        # Applied in order on connect; versions are never reused
+        self.migrations = [
+            (1, self._migrate_legacy_history),
+            (2, self._add_summary_columns),
+            (3, self._add_policy_column),
+        ]
+        self.pool = None
+        if self.database_url.startswith("sqlite"):
+            # busy timeout for connections that databases opens outside the pool
+            self.database = Database(self.database_url, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000)
+            self._insert = sqlite_insert
+            if sqlite_tuned:
+                self.pool = SQLitePool(self.database)
+        else:
+            # Server databases (e.g. postgresql://) get a connection pool
+            self.database = Database(self.database_url, min_size=DATABASE_POOL_MIN_SIZE, max_size=DATABASE_POOL_MAX_SIZE)
+            self._insert = postgresql_insert
 
     async def connect(self):
         await self.database.connect()
+        if self.pool is not None:
+            await self.pool.open()
+        await self.create_schema()
+        await self.migrate()
 
     async def disconnect(self):
+        if self.pool is not None:
+            await self.pool.close()
         await self.database.disconnect()
 
-    
-    
-    async def get_trimmed_chat_history(self, chat_id: str, max_length: int = 2048) -> str:
-        history = await self.get_chat_history(chat_id)
-        entries = history.strip().split("\n")
-        entries = [line for line in entries if line]
-
-        pairs = []
-        i = 0
-        while i < len(entries) - 1:
-            if entries[i].startswith("User:") and entries[i + 1].startswith("Bot:"):
-                pairs.append(f"{entries[i]}\n{entries[i+1]}\n")
-                i += 2
-            else:
-                i += 1
-
-        trimmed_history = ""
-        current_length = 0
-
-        for entry in reversed(pairs):
-            entry_length = len(entry)
-            if current_length + entry_length > max_length:
-                break
-            trimmed_history = entry + trimmed_history
-            current_length += entry_length
-
-        return trimmed_history
-
-    
-    
-    async def get_chat_history(self, chat_id: str) -> str:
-        query = select(self.chat_histories.c.chat_history).where(self.chat_histories.c.chat_id == chat_id)
-        result = await self.database.fetch_one(query)
-        return result[0] if result else ""
+    async def _fetch_one(self, query):
+        with stage("db_read"):
+            return await (self.pool or self.database).fetch_one(query)
 
-    async def add_message(self, chat_id: str, user_message: str, bot_response: str):
-        existing_history = await self.get_chat_history(chat_id)
-        new_entry = f"User: {user_message}\nBot: {bot_response}\n"
-        updated_history = existing_history + new_entry
+    async def _fetch_all(self, query):
+        with stage("db_read"):
+            return await (self.pool or self.database).fetch_all(query)
+
+    async def _execute(self, query):
+        with stage("db_write"):
+            return await (self.pool or self.database).execute(query)
+
+    async def execute_batch(self, queries):
+        with stage("db_write"):
+            if self.pool is not None:
+                await self.pool.execute_batch(queries)
+                return
+            async with self.database.transaction():
+                for query in queries:
+                    await self.database.execute(query)
 
-        query_check = select(self.chat_histories.c.id).where(self.chat_histories.c.chat_id == chat_id)
-        exists = await self.database.fetch_one(query_check)
+    async def create_schema(self):
+        for table in self.metadata.sorted_tables:
+            await self._execute(CreateTable(table, if_not_exists=True))
+            for index in table.indexes:
+                await self._execute(CreateIndex(index, if_not_exists=True))
 
-        if exists:
-            query_update = (
+    async def migrate(self):
+        rows = await self._fetch_all(select(self.schema_migrations.c.version))
+        applied = {row["version"] for row in rows}
+        for version, migration in self.migrations:
+            if version in applied:
+                continue
+            await migration()
+            await self._execute(insert(self.schema_migrations).values(version=version, applied_at=time.time()))
+            logger.info("Applied database migration", extra={"version": version, "migration": migration.__name__})
+
+    async def _migrate_legacy_history(self):
+        # Move turns out of the old single-blob chat_history column into chat_messages
+        rows = await self._fetch_all(
+            select(self.chat_histories.c.chat_id, self.chat_histories.c.chat_history)
+            .where(self.chat_histories.c.chat_history.is_not(None))
+            .where(self.chat_histories.c.chat_history != "")
+        )
+        for row in rows:
+            chat_id = row["chat_id"]
+            already_migrated = await self._fetch_one(
+                select(self.chat_messages.c.id).where(self.chat_messages.c.chat_id == chat_id).limit(1)
+            )
+            queries = []
+            if not already_migrated:
+                for sequence, (user_message, bot_response) in enumerate(LEGACY_TURN_PATTERN.findall(row["chat_history"]), start=1):
+                    queries.append(insert(self.chat_messages).values(
+                        chat_id=chat_id,
+                        sequence=sequence,
+                        user_message=user_message,
+                        bot_response=bot_response
+                    ))
+            queries.append(
                 update(self.chat_histories)
                 .where(self.chat_histories.c.chat_id == chat_id)
-                .values(chat_history=updated_history)
+                .values(chat_history="")
             )
-            await self.database.execute(query_update)
-        else:
-            query_insert = insert(self.chat_histories).values(
-                chat_id=chat_id,
-                chat_history=new_entry,
-                step_passed=1,
-                passport_data={},
-                vehicle_data={}
+            await self.execute_batch(queries)
+        if rows:
+            logger.info("Migrated legacy chat history to chat_messages", extra={"chats": len(rows)})
+
+    async def _has_column(self, table: Table, column: str) -> bool:
+        # Portable check: selecting a missing column fails on every backend
+        try:
+            await self._fetch_one(sqlalchemy.text(f"SELECT {column} FROM {table.name} LIMIT 1"))
+            return True
+        except Exception:
+            return False
+
+    async def _add_summary_columns(self):
+        # Tables created by this version already have them
+        for column, column_type in (("summary", "TEXT"), ("summary_sequence", "INTEGER")):
+            if not await self._has_column(self.chat_histories, column):
+                await self._execute(sqlalchemy.text(f"ALTER TABLE chat_histories ADD COLUMN {column} {column_type}"))
+
+    async def _add_policy_column(self):
+        if not await self._has_column(self.chat_histories, "policy"):
+            await self._execute(sqlalchemy.text("ALTER TABLE chat_histories ADD COLUMN policy JSON"))
+
+    async def get_recent_turns(self, chat_id: str, max_length: int = 2048, max_turns: int = 20) -> list:
+        query = (
+            select(self.chat_messages.c.user_message, self.chat_messages.c.bot_response)
+            .where(self.chat_messages.c.chat_id == chat_id)
+            .order_by(self.chat_messages.c.sequence.desc())
+            .limit(max_turns)
+        )
+        rows = await self._fetch_all(query)
+        turns = [(row["user_message"], row["bot_response"]) for row in reversed(rows)]
+        return trim_turns(turns, max_length)
+
+    async def get_turns(self, chat_id: str, after_sequence: int, upto_sequence: int) -> list:
+        # Turns after_sequence+1..upto_sequence, oldest first
+        query = (
+            select(self.chat_messages.c.user_message, self.chat_messages.c.bot_response)
+            .where(
+                (self.chat_messages.c.chat_id == chat_id)
+                & (self.chat_messages.c.sequence > after_sequence)
+                & (self.chat_messages.c.sequence <= upto_sequence)
             )
-            await self.database.execute(query_insert)
+            .order_by(self.chat_messages.c.sequence)
+        )
+        rows = await self._fetch_all(query)
+        return [(row["user_message"], row["bot_response"]) for row in rows]
+
+    async def get_trimmed_chat_history(self, chat_id: str, max_length: int = 2048, max_turns: int = 20) -> str:
+        turns = await self.get_recent_turns(chat_id, max_length, max_turns)
+        return format_trimmed_history(turns, max_length)
+
+    async def get_chat_history(self, chat_id: str) -> str:
+        query = (
+            select(self.chat_messages.c.user_message, self.chat_messages.c.bot_response)
+            .where(self.chat_messages.c.chat_id == chat_id)
+            .order_by(self.chat_messages.c.sequence)
+        )
+        rows = await self._fetch_all(query)
+        return "".join(f"User: {row['user_message']}\nBot: {row['bot_response']}\n" for row in rows)
+
+    async def load_session(self, chat_id: str, max_turns: int = 20):
+        # Chat state and its newest turns in a single round-trip
+        recent = (
+            select(self.chat_messages)
+            .where(self.chat_messages.c.chat_id == chat_id)
+            .order_by(self.chat_messages.c.sequence.desc())
+            .limit(max_turns)
+            .subquery()
+        )
+        query = (
+            select(
+                self.chat_histories.c.step_passed,
+                self.chat_histories.c.passport_data,
+                self.chat_histories.c.vehicle_data,
+                self.chat_histories.c.summary,
+                self.chat_histories.c.summary_sequence,
+                self.chat_histories.c.policy,
+                recent.c.sequence,
+                recent.c.user_message,
+                recent.c.bot_response,
+            )
+            .select_from(self.chat_histories.outerjoin(recent, sqlalchemy.true()))
+            .where(self.chat_histories.c.chat_id == chat_id)
+            .order_by(recent.c.sequence)
+        )
+        rows = await self._fetch_all(query)
+        if not rows:
+            return None
+        return {
+            "step_passed": rows[0]["step_passed"] or 0,
+            "passport_data": rows[0]["passport_data"] or {},
+            "vehicle_data": rows[0]["vehicle_data"] or {},
+            "summary": rows[0]["summary"] or "",
+            "summary_sequence": rows[0]["summary_sequence"] or 0,
+            "policy": rows[0]["policy"] or {},
+            # Sequences are 1..N per chat, so the newest sequence is the number of turns
+            "turn_count": rows[-1]["sequence"] or 0,
+            "turns": [
+                (row["user_message"], row["bot_response"])
+                for row in rows
+                if row["user_message"] is not None
+            ],
+        }
+
+    def add_message_query(self, chat_id: str, user_message: str, bot_response: str):
+        next_sequence = (
+            select(func.coalesce(func.max(self.chat_messages.c.sequence), 0) + 1)
+            .where(self.chat_messages.c.chat_id == chat_id)
+            .scalar_subquery()
+        )
+        return insert(self.chat_messages).values(
+            chat_id=chat_id,
+            sequence=next_sequence,
+            user_message=user_message,
+            bot_response=bot_response
+        )
+
+    async def add_message(self, chat_id: str, user_message: str, bot_response: str):
+        await self._execute(self.add_message_query(chat_id, user_message, bot_response))
+
+    def upsert_chat_query(self, chat_id: str, **values):
+        # Chat rows are created on first write instead of checking for existence first
+        query = self._insert(self.chat_histories).values(chat_id=chat_id, **values)
+        return query.on_conflict_do_update(
+            index_elements=[self.chat_histories.c.chat_id],
+            set_=values
+        )
 
     async def get_data_confirmed(self, chat_id: str):
         query = select(self.chat_histories.c.data_confirmed).where(self.chat_histories.c.chat_id == chat_id)
-        result = await self.database.fetch_one(query)
+        result = await self._fetch_one(query)
         return result[0] if result else None
 
     async def set_data_confirmed(self, chat_id: str, data: str):
@@ -97,33 +323,89 @@ class ChatHistoryDB:
             .where(self.chat_histories.c.chat_id == chat_id)
             .values(data_confirmed=data)
         )
-        await self.database.execute(query)
+        await self._execute(query)
 
     async def get_step_passed(self, chat_id: str):
         query = select(self.chat_histories.c.step_passed).where(self.chat_histories.c.chat_id == chat_id)
-        result = await self.database.fetch_one(query)
+        result = await self._fetch_one(query)
         return result[0] or 0 if result else 0
 
 
     async def set_step_passed(self, chat_id: str, step: int):
-        query = (
-            update(self.chat_histories)
-            .where(self.chat_histories.c.chat_id == chat_id)
-            .values(step_passed=step)
-        )
-        await self.database.execute(query)
+        query = self.upsert_chat_query(chat_id, step_passed=step)
+        await self._execute(query)
 
     async def set_document_data(self, chat_id: str, doc_type: str, data: dict):
         column = "passport_data" if doc_type == "passport" else "vehicle_data"
-        query = (
-            update(self.chat_histories)
-            .where(self.chat_histories.c.chat_id == chat_id)
-            .values(**{column: data})
-        )
-        await self.database.execute(query)
+        query = self.upsert_chat_query(chat_id, **{column: data})
+        await self._execute(query)
+
+    async def set_summary(self, chat_id: str, summary: str, summary_sequence: int):
+        query = self.upsert_chat_query(chat_id, summary=summary, summary_sequence=summary_sequence)
+        await self._execute(query)
 
     async def get_document_data(self, chat_id: str, doc_type: str) -> dict:
         column = "passport_data" if doc_type == "passport" else "vehicle_data"
         query = select(getattr(self.chat_histories.c, column)).where(self.chat_histories.c.chat_id == chat_id)
-        result = await self.database.fetch_one(query)
-        return result[0] if result else {}
+        result = await self._fetch_one(query)
+        return (result[0] or {}) if result else {}
+
+    async def get_policy(self, chat_id: str) -> dict:
+        query = select(self.chat_histories.c.policy).where(self.chat_histories.c.chat_id == chat_id)
+        result = await self._fetch_one(query)
+        return (result[0] or {}) if result else {}
+
+    async def set_policy(self, chat_id: str, policy: dict):
+        query = self.upsert_chat_query(chat_id, policy=policy)
+        await self._execute(query)
+
+    async def get_ocr_result(self, cache_key: str, now: float):
+        query = (
+            select(self.ocr_results.c.result, self.ocr_results.c.expires_at)
+            .where(self.ocr_results.c.cache_key == cache_key)
+            .where(self.ocr_results.c.expires_at > now)
+        )
+        result = await self._fetch_one(query)
+        return (result["result"], result["expires_at"]) if result else None
+
+    async def put_ocr_results(self, cache_keys, doc_type: str, result: dict, expires_at: float):
+        queries = []
+        for cache_key in cache_keys:
+            query = self._insert(self.ocr_results).values(
+                cache_key=cache_key, doc_type=doc_type, result=result, expires_at=expires_at
+            )
+            queries.append(query.on_conflict_do_update(
+                index_elements=[self.ocr_results.c.cache_key],
+                set_={"result": result, "expires_at": expires_at}
+            ))
+        await self.execute_batch(queries)
+
+    async def purge_ocr_results(self, now: float, max_entries: int = 0):
+        # Drops expired rows, then the oldest beyond max_entries (expires_at grows with write time)
+        queries = [delete(self.ocr_results).where(self.ocr_results.c.expires_at <= now)]
+        if max_entries:
+            newest = select(self.ocr_results.c.cache_key).order_by(self.ocr_results.c.expires_at.desc()).limit(max_entries)
+            queries.append(delete(self.ocr_results).where(self.ocr_results.c.cache_key.not_in(newest.scalar_subquery())))
+        await self.execute_batch(queries)
+
+    async def try_acquire_chat_lease(self, chat_id: str, owner: str, now: float, lease_seconds: float) -> bool:
+        # Takes a free or expired lease, or extends our own; then reads back who holds it
+        query = self._insert(self.chat_leases).values(chat_id=chat_id, owner=owner, expires_at=now + lease_seconds)
+        query = query.on_conflict_do_update(
+            index_elements=[self.chat_leases.c.chat_id],
+            set_={"owner": owner, "expires_at": now + lease_seconds},
+            where=(self.chat_leases.c.expires_at < now) | (self.chat_leases.c.owner == owner)
+        )
+        await self._execute(query)
+        result = await self._fetch_one(
+            select(self.chat_leases.c.owner).where(self.chat_leases.c.chat_id == chat_id)
+        )
+        return result is not None and result["owner"] == owner
+
+    async def release_chat_lease(self, chat_id: str, owner: str):
+        query = (
+            delete(self.chat_leases)
+            .where(self.chat_leases.c.chat_id == chat_id)
+            .where(self.chat_leases.c.owner == owner)
+        )
+        await self._execute(query)
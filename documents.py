@@ -0,0 +1,96 @@
+import re
+from config import OCR_LOW_CONFIDENCE
+
+# Normalized fields kept per document type, with their display labels
+DOCUMENT_FIELDS = {
+    "passport": {
+        "name": "Full Name",
+        "document_id": "Document ID",
+        "birth_date": "Date of Birth",
+        "expiry_date": "Expiry Date",
+        "country": "Country",
+        "address": "Address",
+    },
+    "vehicle": {
+        "make_model": "Make and Model",
+        "vin": "VIN",
+        "year": "Year",
+        "registration_number": "Registration Number",
+    },
+}
+
+VIN_PATTERN = re.compile(r"\b[A-HJ-NPR-Z0-9]{17}\b")
+YEAR_PATTERN = re.compile(r"\b(?:19|20)\d{2}\b")
+
+
+def _text_field(full_text: str, *labels: str) -> str:
+    # Mindee renders documents as ":Label: value" lines
+    for label in labels:
+        match = re.search(rf"^:{re.escape(label)}:[ \t]*(.+)$", full_text, re.M | re.I)
+        if match and match.group(1).strip():
+            return match.group(1).strip()
+    return ""
+
+
+def _pattern_field(full_text: str, pattern: re.Pattern) -> str:
+    match = pattern.search(full_text)
+    return match.group(0) if match else ""
+
+
+def fields_from_text(full_text: str, doc_type: str, patterns=()) -> dict:
+    # Fallback for results without typed fields, e.g. generic OCR or rows stored before they existed.
+    # patterns names the fields ("vin", "year") that may also be taken from unlabeled text; only
+    # safe when the text is known to be a vehicle document, a licence holds e.g. a birth year.
+    full_text = full_text or ""
+    if doc_type == "passport":
+        name = _text_field(full_text, "Full Name", "Name") or " ".join(
+            part for part in (_text_field(full_text, "First Name", "Given Names"), _text_field(full_text, "Last Name", "Surname")) if part
+        )
+        fields = {
+            "name": name,
+            "document_id": _text_field(full_text, "Document ID", "ID Number", "ID"),
+            "birth_date": _text_field(full_text, "Date of Birth", "Birth Date"),
+            "expiry_date": _text_field(full_text, "Expiry Date", "Date of Expiry"),
+            "country": _text_field(full_text, "Country", "Issuing Country"),
+            "address": _text_field(full_text, "Address"),
+        }
+    else:
+        fields = {
+            "make_model": _text_field(full_text, "Make and Model", "Make", "Model"),
+            "vin": _text_field(full_text, "VIN", "Vehicle ID") or (_pattern_field(full_text, VIN_PATTERN) if "vin" in patterns else ""),
+            "year": _text_field(full_text, "Year") or (_pattern_field(full_text, YEAR_PATTERN) if "year" in patterns else ""),
+            "registration_number": _text_field(full_text, "Registration Number", "Plate Number"),
+        }
+    return {name: value for name, value in fields.items() if value}
+
+
+def document_fields(data: dict, doc_type: str) -> dict:
+    # Typed fields of a stored result, completed from its text where a field is missing
+    data = data or {}
+    fields = dict(fields_from_text(data.get("full_text"), doc_type))
+    fields.update({name: value for name, value in (data.get("fields") or {}).items() if value})
+    return fields
+
+
+def format_document(data: dict, doc_type: str) -> str:
+    # Compact "Label: value" lines shown to the user and kept in the history
+    fields = document_fields(data, doc_type)
+    confidence = (data or {}).get("confidence") or {}
+    lines = []
+    for name, label in DOCUMENT_FIELDS[doc_type].items():
+        if name not in fields:
+            continue
+        line = f"{label}: {fields[name]}"
+        if confidence.get(name) is not None and confidence[name] < OCR_LOW_CONFIDENCE:
+            line += " (please check)"
+        lines.append(line)
+    return "\n".join(lines) or "No data extracted"
+
+
+def documents_summary(passport_data: dict, vehicle_data: dict) -> str:
+    # One line with every known field, for prompts
+    parts = []
+    for doc_type, data in (("passport", passport_data), ("vehicle", vehicle_data)):
+        fields = document_fields(data, doc_type)
+        parts.extend(f"{label}: {fields[name]}" for name, label in DOCUMENT_FIELDS[doc_type].items() if name in fields)
+    return "; ".join(parts)
@@ -1,82 +1,406 @@
-import requests
-from config import GOOGLE_GEMINI_API_KEY
+import asyncio
+import hashlib
+import logging
+import time
+import aiohttp
+from config import (
+    GOOGLE_GEMINI_API_KEY,
+    GEMINI_ATTEMPT_TIMEOUT_SECONDS,
+    GEMINI_BACKOFF_BASE_SECONDS,
+    GEMINI_BACKOFF_MAX_SECONDS,
+    GEMINI_BASE_URL,
+    GEMINI_CIRCUIT_FAILURES,
+    GEMINI_CIRCUIT_RESET_SECONDS,
+    GEMINI_CONNECT_TIMEOUT_SECONDS,
+    GEMINI_CONTEXT_CACHE,
+    GEMINI_CONTEXT_CACHE_TTL_SECONDS,
+    GEMINI_FALLBACK_MODELS,
+    GEMINI_HEDGE_PERCENTILE,
+    GEMINI_MAX_CONCURRENCY,
+    GEMINI_MAX_RETRIES,
+    GEMINI_MODEL,
+    GEMINI_POOL_SIZE,
+    GEMINI_TIMEOUT_SECONDS,
+)
+from metrics import GEMINI_ATTEMPTS, GEMINI_CIRCUIT_OPENED, GEMINI_HEDGES, GEMINI_REQUEST_TOKENS, GEMINI_TOKENS
+from resilience import CircuitBreaker, LatencyTracker, backoff_delay
 import json
 
+logger = logging.getLogger(__name__)
+
+# How long a transient failure to create the context cache is remembered before retrying
+CONTEXT_CACHE_RETRY_SECONDS = 60
+
+
+class GeminiError(Exception):
+    # retryable: the same request may succeed later (timeouts, 429, 5xx, connection errors)
+    retryable = False
+
+    def __init__(self, message: str, status: int = None, retry_after: float = None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class GeminiAuthError(GeminiError):
+    pass
+
+
+class GeminiBadRequest(GeminiError):
+    pass
+
+
+class GeminiRateLimited(GeminiError):
+    retryable = True
+
+
+class GeminiServerError(GeminiError):
+    retryable = True
+
+
+class GeminiTimeout(GeminiError):
+    retryable = True
+
+
+class GeminiNetworkError(GeminiError):
+    retryable = True
+
+
+class GeminiResponseError(GeminiError):
+    # Unparseable response or no candidates; another model may still answer
+    retryable = True
+
+
+class GeminiBlocked(GeminiError):
+    # The prompt or the answer was blocked by safety filters
+    pass
+
+
+class GeminiUnavailable(GeminiError):
+    # Every model's circuit breaker is open
+    pass
+
+
+def _retry_after(response: aiohttp.ClientResponse):
+    try:
+        return float(response.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
 class GeminiClient:
-    def __init__(self):
+    def __init__(
+        self,
+        max_concurrency: int = GEMINI_MAX_CONCURRENCY,
+        pool_size: int = GEMINI_POOL_SIZE,
+        timeout: float = GEMINI_TIMEOUT_SECONDS,
+        base_url: str = GEMINI_BASE_URL,
+        model: str = GEMINI_MODEL,
+        fallback_models=GEMINI_FALLBACK_MODELS,
+    ):
         self.api_key = GOOGLE_GEMINI_API_KEY
-        self.base_url = "https://generativelanguage.googleapis.com/v1beta"
-        self.model = "models/gemini-2.0-flash"
+        self.base_url = base_url.rstrip("/")
+        self.model = model
+        self.fallback_models = [m for m in fallback_models if m != model]
         self.headers = {
             'Content-Type': 'application/json'
         }
-    
-    def test_gemini(self):
+        self.pool_size = pool_size
+        # Deadline for one call, retries and fallback models included
+        self.deadline = timeout
+        self.attempt_timeout = GEMINI_ATTEMPT_TIMEOUT_SECONDS
+        self.connect_timeout = GEMINI_CONNECT_TIMEOUT_SECONDS
+        self.max_retries = GEMINI_MAX_RETRIES
+        self.backoff_base = GEMINI_BACKOFF_BASE_SECONDS
+        self.backoff_max = GEMINI_BACKOFF_MAX_SECONDS
+        self.hedge_percentile = GEMINI_HEDGE_PERCENTILE
+        self.breakers = {
+            m: CircuitBreaker(GEMINI_CIRCUIT_FAILURES, GEMINI_CIRCUIT_RESET_SECONDS)
+            for m in [self.model] + self.fallback_models
+        }
+        self.latency = {m: LatencyTracker() for m in self.breakers}
+        # Caps the number of in-flight requests across all chats
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._session = None
+        self.context_cache = GEMINI_CONTEXT_CACHE
+        self.context_cache_ttl = GEMINI_CONTEXT_CACHE_TTL_SECONDS
+        # System instruction digest -> (cachedContents name or None when unavailable, valid until)
+        self._cached_contents = {}
+        # Digests whose cachedContents is being created
+        self._cache_creating = set()
+        self.last_usage = {}
+        self.usage_totals = {"requests": 0, "promptTokenCount": 0, "cachedContentTokenCount": 0, "candidatesTokenCount": 0}
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # The session is created lazily so it binds to the running event loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                keepalive_timeout=60,
+                ttl_dns_cache=300,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers=self.headers,
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def _attempt_timeout(self, remaining: float) -> aiohttp.ClientTimeout:
+        return aiohttp.ClientTimeout(total=min(self.attempt_timeout, remaining), connect=self.connect_timeout)
+
+    async def _status_error(self, response: aiohttp.ClientResponse) -> GeminiError:
+        try:
+            message = (await response.json(content_type=None)).get("error", {}).get("message", "")
+        except Exception:
+            message = ""
+        message = f"Gemini returned {response.status}: {message}".strip()
+        status = response.status
+        if status in (401, 403):
+            return GeminiAuthError(message, status)
+        if status == 429:
+            return GeminiRateLimited(message, status, _retry_after(response))
+        if status >= 500:
+            return GeminiServerError(message, status, _retry_after(response))
+        return GeminiBadRequest(message, status)
+
+    async def _request(self, model: str, payload: dict, remaining: float) -> str:
+        # One HTTP attempt; every failure is raised as a GeminiError
+        url = f"{self.base_url}/{model}:generateContent?key={self.api_key}"
+        start = time.perf_counter()
         try:
-            url = f"{self.base_url}/{self.model}:generateContent?key={self.api_key}"
-            payload = {
-                "contents": [{
-                    "parts": [{
-                        "text": "Explain how AI works in a few words"
-                    }]
-                }]
-            }
-            
-            response = requests.post(url, headers=self.headers, json=payload)
-            
-            if response.status_code == 401:
-                return "Authentication error: Please check your API key"
-            elif response.status_code == 400:
-                return "Invalid request: Please check your request format"
-            
-            response.raise_for_status()
-            
-            result = response.json()
-            if 'candidates' in result and len(result['candidates']) > 0:
-                return result['candidates'][0]['content']['parts'][0]['text']
-            return "No response generated"
-        except requests.exceptions.RequestException as e:
-            print(f"Network error: {str(e)}")
-            return f"Network error occurred: {str(e)}"
+            async with self._semaphore:
+                session = self._get_session()
+                async with session.post(url, json=payload, timeout=self._attempt_timeout(remaining)) as response:
+                    if response.status != 200:
+                        raise await self._status_error(response)
+                    result = await response.json(content_type=None)
+        except asyncio.TimeoutError:
+            raise GeminiTimeout(f"Gemini request timed out ({model})")
+        except aiohttp.ClientError as e:
+            raise GeminiNetworkError(f"Network error: {str(e)}")
         except json.JSONDecodeError as e:
-            print(f"JSON parsing error: {str(e)}")
-            return "Error parsing API response"
-        except Exception as e:
-            print(f"Unexpected error: {str(e)}")
-            return f"Unexpected error: {str(e)}"
-    
-    def communicate(self, message: str) -> str:
+            raise GeminiResponseError(f"Error parsing API response: {str(e)}")
+        self.latency[model].record(time.perf_counter() - start)
+        self._report_usage(result.get('usageMetadata'))
+        candidates = result.get('candidates') or []
+        if not candidates:
+            block_reason = result.get('promptFeedback', {}).get('blockReason')
+            if block_reason:
+                raise GeminiBlocked(f"Prompt blocked: {block_reason}")
+            raise GeminiResponseError("No response generated")
+        parts = candidates[0].get('content', {}).get('parts', [])
+        text = "".join(part.get('text', '') for part in parts)
+        if not text:
+            if candidates[0].get('finishReason') == "SAFETY":
+                raise GeminiBlocked("Response blocked by safety filters")
+            raise GeminiResponseError("Empty response")
+        return text
+
+    async def _hedged_request(self, model: str, payload: dict, remaining: float) -> str:
+        # Sends a second identical request if the first is slower than the usual latency percentile
+        threshold = self.latency[model].percentile(self.hedge_percentile) if self.hedge_percentile else None
+        first = asyncio.ensure_future(self._request(model, payload, remaining))
+        if threshold is None or threshold >= remaining:
+            return await first
+        done, _ = await asyncio.wait({first}, timeout=threshold)
+        if done:
+            return first.result()
+        GEMINI_HEDGES.inc(model=model)
+        pending = {first, asyncio.ensure_future(self._request(model, payload, remaining - threshold))}
+        error = None
         try:
-            url = f"{self.base_url}/{self.model}:generateContent?key={self.api_key}"
-            payload = {
-                "contents": [{
-                    "parts": [{
-                        "text": message
-                    }]
-                }]
-            }
-            
-            response = requests.post(url, headers=self.headers, json=payload)
-            
-            if response.status_code == 401:
-                return "Authentication error: Please check your API key"
-            elif response.status_code == 400:
-                return "Invalid request: Please check your request format"
-                
-            response.raise_for_status()
-            
-            result = response.json()
-            if 'candidates' in result and len(result['candidates']) > 0:
-                return result['candidates'][0]['content']['parts'][0]['text']
-            return "No response generated"
-        except requests.exceptions.RequestException as e:
-            print(f"Network error: {str(e)}")
-            return f"Network error occurred: {str(e)}"
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _call(self, message, system_instruction: str, request):
+        # Runs request(model, payload, remaining) with retries, backoff, circuit breakers and fallbacks
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline
+        error = None
+        for model in [self.model] + self.fallback_models:
+            breaker = self.breakers[model]
+            if not breaker.allow():
+                GEMINI_ATTEMPTS.inc(model=model, outcome="circuit_open")
+                error = error or GeminiUnavailable(f"Circuit open for {model}")
+                continue
+            payload = await self._payload(message, system_instruction, model, deadline - loop.time())
+            for attempt in range(self.max_retries + 1):
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise GeminiTimeout(f"Gemini call exceeded {self.deadline}s") from error
+                try:
+                    result = await request(model, payload, remaining)
+                except GeminiError as e:
+                    error = e
+                    GEMINI_ATTEMPTS.inc(model=model, outcome=type(e).__name__)
+                    logger.warning("Gemini attempt failed", extra={"model": model, "attempt": attempt + 1, "error": str(e)})
+                    if not e.retryable:
+                        # The model answered, the request itself is at fault
+                        breaker.record_success()
+                        if isinstance(e, (GeminiAuthError, GeminiBlocked)):
+                            # Another model would fail the same way
+                            raise
+                        break
+                    if breaker.record_failure():
+                        GEMINI_CIRCUIT_OPENED.inc(model=model)
+                        logger.error("Gemini circuit opened", extra={"model": model})
+                        break
+                    if attempt < self.max_retries:
+                        delay = e.retry_after if e.retry_after is not None else backoff_delay(attempt, self.backoff_base, self.backoff_max)
+                        await asyncio.sleep(max(0.0, min(delay, deadline - loop.time())))
+                    continue
+                breaker.record_success()
+                GEMINI_ATTEMPTS.inc(model=model, outcome="ok")
+                return result
+        raise error
+
+    async def _stream(self, model: str, payload: dict, remaining: float):
+        # Opens the SSE stream; failures before the first chunk are raised so the call can be retried
+        url = f"{self.base_url}/{model}:streamGenerateContent?alt=sse&key={self.api_key}"
+        try:
+            await self._semaphore.acquire()
+            session = self._get_session()
+            response = await session.post(url, json=payload, timeout=self._attempt_timeout(remaining))
+        except asyncio.TimeoutError:
+            self._semaphore.release()
+            raise GeminiTimeout(f"Gemini stream timed out ({model})")
+        except aiohttp.ClientError as e:
+            self._semaphore.release()
+            raise GeminiNetworkError(f"Network error: {str(e)}")
+        if response.status != 200:
+            error = await self._status_error(response)
+            response.release()
+            self._semaphore.release()
+            raise error
+        return self._stream_chunks(response)
+
+    async def _stream_chunks(self, response: aiohttp.ClientResponse):
+        try:
+            # Server-sent events, one JSON chunk per "data:" line
+            usage = None
+            async for line in response.content:
+                line = line.decode("utf-8").strip()
+                if not line.startswith("data:"):
+                    continue
+                chunk = json.loads(line[len("data:"):])
+                if 'usageMetadata' in chunk:
+                    usage = chunk['usageMetadata']
+                for candidate in chunk.get('candidates', [])[:1]:
+                    for part in candidate.get('content', {}).get('parts', []):
+                        if part.get('text'):
+                            yield part['text']
+            # The final chunk carries the usage for the whole response
+            self._report_usage(usage)
+        except asyncio.TimeoutError:
+            raise GeminiTimeout("Gemini stream timed out")
+        except aiohttp.ClientError as e:
+            raise GeminiNetworkError(f"Network error: {str(e)}")
         except json.JSONDecodeError as e:
-            print(f"JSON parsing error: {str(e)}")
-            return "Error parsing API response"
-        except Exception as e:
-            print(f"Unexpected error: {str(e)}")
-            return f"Unexpected error: {str(e)}"
+            raise GeminiResponseError(f"Error parsing API response: {str(e)}")
+        finally:
+            response.release()
+            self._semaphore.release()
+
+    def _report_usage(self, usage):
+        if not usage:
+            return
+        self.last_usage = usage
+        self.usage_totals["requests"] += 1
+        for key in ("promptTokenCount", "cachedContentTokenCount", "candidatesTokenCount"):
+            self.usage_totals[key] += usage.get(key, 0)
+        GEMINI_TOKENS.inc(usage.get("promptTokenCount", 0), kind="prompt")
+        GEMINI_TOKENS.inc(usage.get("cachedContentTokenCount", 0), kind="cached")
+        GEMINI_TOKENS.inc(usage.get("candidatesTokenCount", 0), kind="output")
+        GEMINI_REQUEST_TOKENS.observe(usage.get("totalTokenCount", 0))
+        logger.info("Gemini tokens", extra={
+            "prompt_tokens": usage.get("promptTokenCount", 0),
+            "cached_tokens": usage.get("cachedContentTokenCount", 0),
+            "output_tokens": usage.get("candidatesTokenCount", 0),
+            "total_tokens": usage.get("totalTokenCount", 0),
+        })
+
+    async def _cached_content(self, system_instruction: str, remaining: float):
+        # Context caching of the static prefix. Returns None (send the instruction inline) while
+        # the cache is unavailable or being created by another call, so no call waits on another.
+        key = hashlib.sha256(system_instruction.encode("utf-8")).hexdigest()
+        entry = self._cached_contents.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            return entry[0]
+        if key in self._cache_creating:
+            return None
+        self._cache_creating.add(key)
+        try:
+            name, valid_seconds = await self._create_cached_content(system_instruction, remaining)
+        finally:
+            self._cache_creating.discard(key)
+        self._cached_contents[key] = (name, time.monotonic() + valid_seconds)
+        return name
+
+    async def _create_cached_content(self, system_instruction: str, remaining: float):
+        # Returns (name or None, seconds to keep the answer). Takes at most half of the calling
+        # request's remaining time, the rest is left for the request itself.
+        url = f"{self.base_url}/cachedContents?key={self.api_key}"
+        payload = {
+            "model": self.model,
+            "systemInstruction": {"parts": [{"text": system_instruction}]},
+            "ttl": f"{int(self.context_cache_ttl)}s",
+        }
+        try:
+            session = self._get_session()
+            async with session.post(url, json=payload, timeout=self._attempt_timeout(remaining / 2)) as response:
+                result = await response.json(content_type=None)
+                if response.status in (400, 404):
+                    # Prompt below the minimum size or model without caching: will not change
+                    logger.warning("Context cache not available: %s", result.get('error', {}).get('message', response.status))
+                    return None, float("inf")
+                if response.status != 200:
+                    logger.warning("Context cache creation failed, retrying later: %s", result.get('error', {}).get('message', response.status))
+                    return None, CONTEXT_CACHE_RETRY_SECONDS
+        except (aiohttp.ClientError, asyncio.TimeoutError, json.JSONDecodeError) as e:
+            logger.warning("Context cache error, retrying later: %s", e)
+            return None, CONTEXT_CACHE_RETRY_SECONDS
+        # Refresh a minute before the server expires it
+        return result["name"], self.context_cache_ttl - 60
+
+    async def _payload(self, message, system_instruction: str = None, model: str = None, remaining: float = None) -> dict:
+        if isinstance(message, str):
+            contents = [{"role": "user", "parts": [{"text": message}]}]
+        else:
+            contents = message
+        payload = {"contents": contents}
+        if system_instruction:
+            # Cached contents belong to the primary model, fallbacks get the instruction inline
+            use_cache = self.context_cache and (model or self.model) == self.model
+            cached_content = await self._cached_content(system_instruction, remaining or self.deadline) if use_cache else None
+            if cached_content:
+                payload["cachedContent"] = cached_content
+            else:
+                payload["systemInstruction"] = {"parts": [{"text": system_instruction}]}
+        return payload
+
+    async def test_gemini(self):
+        return await self.communicate("Explain how AI works in a few words")
 
+    async def communicate(self, message, system_instruction: str = None) -> str:
+        # message is either plain text or a list of multi-turn Gemini contents; raises GeminiError
+        return await self._call(message, system_instruction, self._hedged_request)
 
+    async def stream(self, message, system_instruction: str = None):
+        # Async iterator of text chunks as they are generated. Opening the stream is retried
+        # like communicate(); once text has been yielded, a failure is raised as is.
+        chunks = await self._call(message, system_instruction, self._stream)
+        async for chunk in chunks:
+            yield chunk
@@ -0,0 +1,111 @@
+import re
+from collections import Counter
+from config import INSURANCE_PRICE_USD
+
+AFFIRMATIVE_PATTERN = (
+    r"^\s*(yes|yeah|yep|yup|y|ok|okay|sure|confirm|confirmed|i confirm|correct|right|"
+    r"that's right|all good|looks good|everything is correct|agree|i agree|proceed|let's go|go ahead)"
+    r"[\s.!]*$"
+)
+PRICE_QUESTION_PATTERN = r"\b(price|cost|costs|how much|premium)\b"
+QUESTION_PATTERN = r"\?|^\s*(what|why|how|when|where|who|which|can|could|do|does|is|are)\b"
+# A further sentence or clause means the message says more than the matched intent
+OTHER_CONTENT_PATTERN = r"[.!?;,\n]\s*\S|\b(and|but|also|wrong|incorrect|mistake)\b"
+PRICE_OBJECTION_PATTERN = r"\b(too|expensive|cheaper|discount|lower|reduce|negotiate)\b"
+
+# What the bot asks for next at each step; used to bring the user back to the scenario
+FOLLOW_UPS = {
+    0: "Please send me a photo of your passport to get started.",
+    1: "Please send me a photo of your passport.",
+    2: "Please send me a photo of your passport.",
+    3: "Please send me a photo of your vehicle identification document.",
+    4: "Please check if everything is correct. If there are any mistakes, you can send either photo again.",
+    5: "Are you ready to proceed?",
+}
+
+
+class IntentMatch:
+    def __init__(self, intent: str, reply: str, next_step: int = None):
+        self.intent = intent
+        self.reply = reply
+        self.next_step = next_step
+
+
+class IntentRule:
+    # steps: steps the rule applies to; the text must match pattern and require (if given) and
+    # must not match exclude; reply may use {price} and {follow_up}
+    def __init__(self, name: str, steps, pattern: str, reply: str, next_step: int = None, exclude: str = None, require: str = None):
+        self.name = name
+        self.steps = set(steps)
+        self.pattern = re.compile(pattern, re.I)
+        self.exclude = re.compile(exclude, re.I) if exclude else None
+        self.require = re.compile(require, re.I) if require else None
+        self.reply = reply
+        self.next_step = next_step
+
+    def match(self, step: int, text: str):
+        if step not in self.steps or not self.pattern.search(text):
+            return None
+        if self.require and not self.require.search(text):
+            return None
+        if self.exclude and self.exclude.search(text):
+            return None
+        reply = self.reply.format(price=INSURANCE_PRICE_USD, follow_up=FOLLOW_UPS.get(self.next_step if self.next_step is not None else step, ""))
+        return IntentMatch(self.name, reply.strip(), self.next_step)
+
+
+DEFAULT_RULES = [
+    IntentRule(
+        "confirm_data", [4], AFFIRMATIVE_PATTERN,
+        "Thank you for confirming. The insurance price is {price} USD. This is a fixed rate. {follow_up}",
+        next_step=5,
+    ),
+    IntentRule(
+        "accept_price", [5], AFFIRMATIVE_PATTERN,
+        "Great, I am issuing your policy now.",
+        next_step=6,
+    ),
+    # Only a plain price question; corrections or objections mentioning the price go to Gemini
+    IntentRule(
+        "price_question", [0, 1, 2, 3, 4, 5], PRICE_QUESTION_PATTERN,
+        "The insurance price is {price} USD. This is a fixed rate. {follow_up}",
+        require=QUESTION_PATTERN,
+        exclude=f"{OTHER_CONTENT_PATTERN}|{PRICE_OBJECTION_PATTERN}",
+    ),
+    # Anything that is not a question while a document photo is expected
+    IntentRule(
+        "photo_required", [1, 2, 3], r"\S",
+        "{follow_up}",
+        exclude=QUESTION_PATTERN,
+    ),
+]
+
+
+class IntentClassifier:
+    # Rule-based fast path in front of Gemini; rules are tried in order
+    def __init__(self, rules=None):
+        self.rules = list(DEFAULT_RULES if rules is None else rules)
+        self.counts = Counter()
+
+    def register(self, rule: IntentRule, first: bool = False):
+        if first:
+            self.rules.insert(0, rule)
+        else:
+            self.rules.append(rule)
+
+    def classify(self, step: int, text: str):
+        self.counts["total"] += 1
+        for rule in self.rules:
+            match = rule.match(step, text or "")
+            if match:
+                self.counts["fast_path"] += 1
+                self.counts[f"intent:{rule.name}"] += 1
+                return match
+        self.counts["llm"] += 1
+        return None
+
+    def stats(self) -> dict:
+        total = self.counts["total"]
+        stats = dict(self.counts)
+        stats["fast_path_ratio"] = self.counts["fast_path"] / total if total else 0.0
+        return stats
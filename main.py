@@ -1,11 +1,22 @@
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters
-from config import TELEGRAM_BOT_TOKEN
-from InsuranceBot import InsuranceBot
-from database import ChatHistoryDB
+# Imported first so the start-up profile covers every import below
+from startup import STARTUP
+
+with STARTUP.phase("import_telegram"):
+    from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters
+with STARTUP.phase("import_bot"):
+    from config import TELEGRAM_BOT_TOKEN, BOT_MODE, METRICS_HOST, METRICS_PORT, POLLING_CONCURRENCY
+    from InsuranceBot import InsuranceBot
+    from database import ChatHistoryDB
+    from webhook import run_webhook
+    from metrics import start_metrics_server
+    from logs import configure_logging
 import asyncio
 import aiohttp
+import logging
 import os
 
+logger = logging.getLogger(__name__)
+
 async def ping_server():
     if "RENDER_EXTERNAL_URL" in os.environ:
         async with aiohttp.ClientSession() as session:
@@ -13,16 +24,55 @@ async def ping_server():
                 try:
                     url = os.environ["RENDER_EXTERNAL_URL"]
                     async with session.get(url) as response:
-                        print(f"Ping server response: {response.status}")
+                        logger.debug("Ping server response", extra={"status": response.status})
                 except Exception as e:
-                    print(f"Ping error: {e}")
+                    logger.warning("Ping error: %s", e)
                 await asyncio.sleep(60 * 14)  # Ping every 14 minutes
 
 def main():
-    # Initialize bot and database
-    chat_history_db = ChatHistoryDB()
-    application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
-    bot_instance = InsuranceBot(chat_history_db)
+    configure_logging()
+    # Initialize bot and database; nothing connects until on_startup
+    with STARTUP.phase("bot_init"):
+        chat_history_db = ChatHistoryDB()
+        bot_instance = InsuranceBot(chat_history_db)
+    metrics_runner = None
+    background_tasks = []
+
+    async def on_startup(application):
+        nonlocal metrics_runner
+        # Opens the connections and creates/migrates the schema
+        with STARTUP.phase("db_connect"):
+            await chat_history_db.connect()
+        if METRICS_PORT:
+            with STARTUP.phase("metrics_server"):
+                metrics_runner = await start_metrics_server(METRICS_PORT, METRICS_HOST)
+        # Polling receives no inbound traffic, so keep the Render instance awake
+        if BOT_MODE == "polling" and "RENDER_EXTERNAL_URL" in os.environ:
+            background_tasks.append(asyncio.create_task(ping_server()))
+        STARTUP.log_ready()
+        # The Mindee and Gemini clients are built off the start-up path
+        background_tasks.append(asyncio.create_task(bot_instance.warm_up()))
+
+    async def on_shutdown(application):
+        for task in background_tasks:
+            task.cancel()
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await bot_instance.close()
+        await chat_history_db.disconnect()
+
+    with STARTUP.phase("application_build"):
+        application = (
+            ApplicationBuilder()
+            .token(TELEGRAM_BOT_TOKEN)
+            # Without this the polling loop awaits every update before fetching the next,
+            # so one slow Gemini or OCR call would hold up all chats
+            .concurrent_updates(POLLING_CONCURRENCY)
+            .post_init(on_startup)
+            .post_shutdown(on_shutdown)
+            .build()
+        )
 
     # Add handlers
     application.add_handler(CommandHandler("start", bot_instance.start))
@@ -30,13 +80,14 @@ def main():
     application.add_handler(MessageHandler(filters.PHOTO, bot_instance.handle_photo))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, bot_instance.handle_text))
 
-    # Start the ping service if running on Render
-    if "RENDER_EXTERNAL_URL" in os.environ:
-        application.loop.create_task(ping_server())
-
     # Start the bot
-    print("Starting bot...")
-    application.run_polling(drop_pending_updates=True)
+    if BOT_MODE == "webhook":
+        logger.info("Starting bot in webhook mode")
+        # Lets a newer photo cancel the chat's OCR job while it waits behind the chat's earlier updates
+        asyncio.run(run_webhook(application, on_update=bot_instance.update_received))
+    else:
+        logger.info("Starting bot in polling mode")
+        application.run_polling(drop_pending_updates=True)
 
 if __name__ == "__main__":
     main()
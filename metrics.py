@@ -0,0 +1,240 @@
+import contextvars
+import hmac
+import logging
+import time
+from contextlib import contextmanager
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None) -> str:
+    pairs = list(zip(names, values)) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_number(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        # Label values tuple -> series
+        self.values = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self.values.get(self._key(labels), 0)
+
+    def render(self) -> list:
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_number(value)}" for key, value in self.values.items()]
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        self.values[self._key(labels)] = value
+
+    def set_function(self, fn, **labels):
+        # fn() is called at scrape time, for values owned by another object such as a queue length
+        self.values[self._key(labels)] = fn
+
+    def value(self, **labels) -> float:
+        value = self.values.get(self._key(labels), 0)
+        return value() if callable(value) else value
+
+    def render(self) -> list:
+        lines = []
+        for key, value in self.values.items():
+            if callable(value):
+                try:
+                    value = value()
+                except Exception:
+                    logger.warning("Gauge callback failed", exc_info=True, extra={"metric": self.name})
+                    continue
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {_format_number(value)}")
+        return lines
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self.values.get(key)
+        if series is None:
+            # Per-bucket counts (not cumulative), sum, count
+            series = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][i] += 1
+                break
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> list:
+        lines = []
+        for key, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labels, key, ("le", _format_number(bound)))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_number(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+
+    def _register(self, metric):
+        self.metrics.setdefault(metric.name, metric)
+        return self.metrics[metric.name]
+
+    def counter(self, name: str, help: str, labels=()) -> Counter:
+        return self._register(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels=()) -> Gauge:
+        return self._register(Gauge(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        # Prometheus text exposition format
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+UPDATE_SECONDS = REGISTRY.histogram("bot_update_seconds", "Time to handle one update, lock wait included", ["handler"])
+STAGE_SECONDS = REGISTRY.histogram("bot_stage_seconds", "Time spent per processing stage", ["stage"])
+ERRORS = REGISTRY.counter("bot_errors_total", "Errors by where they were handled and exception type", ["where", "type"])
+STEP_TRANSITIONS = REGISTRY.counter("bot_step_transitions_total", "Scenario step changes", ["from_step", "to_step"])
+INTENTS = REGISTRY.counter("bot_intents_total", "Text messages by intent, llm when Gemini answered", ["intent"])
+SESSION_CACHE_LOOKUPS = REGISTRY.counter("bot_session_cache_lookups_total", "Session cache lookups", ["result"])
+OCR_CACHE_LOOKUPS = REGISTRY.counter("bot_ocr_cache_lookups_total", "OCR cache lookups per photo", ["result"])
+OCR_QUEUE_DEPTH = REGISTRY.gauge("bot_ocr_queue_depth", "OCR jobs waiting for a worker")
+OCR_RUNNING = REGISTRY.gauge("bot_ocr_running_jobs", "OCR jobs running on a worker")
+GEMINI_TOKENS = REGISTRY.counter("bot_gemini_tokens_total", "Gemini tokens by kind", ["kind"])
+GEMINI_REQUEST_TOKENS = REGISTRY.histogram("bot_gemini_request_tokens", "Total tokens per Gemini request", buckets=TOKEN_BUCKETS)
+GEMINI_ATTEMPTS = REGISTRY.counter("bot_gemini_attempts_total", "Gemini attempts by model and outcome", ["model", "outcome"])
+GEMINI_HEDGES = REGISTRY.counter("bot_gemini_hedges_total", "Duplicate Gemini requests sent because the first was slow", ["model"])
+GEMINI_CIRCUIT_OPENED = REGISTRY.counter("bot_gemini_circuit_opened_total", "Times a model's circuit breaker opened", ["model"])
+
+_current_span = contextvars.ContextVar("update_span", default=None)
+
+
+class UpdateSpan:
+    def __init__(self, handler: str, chat_id: str):
+        self.handler = handler
+        self.chat_id = chat_id
+        self.stages = {}
+
+    def add(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def update_span(handler: str, chat_id: str):
+    # Collects the stage timings of one update and logs them together when it is done
+    span = UpdateSpan(handler, chat_id)
+    token = _current_span.set(span)
+    start = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield span
+    except Exception as e:
+        outcome = "error"
+        ERRORS.inc(where=handler, type=type(e).__name__)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        _current_span.reset(token)
+        UPDATE_SECONDS.observe(elapsed, handler=handler)
+        logger.log(logging.INFO if outcome == "ok" else logging.WARNING, "update handled", extra={
+            "handler": handler,
+            "chat_id": chat_id,
+            "outcome": outcome,
+            "duration_ms": round(elapsed * 1000, 1),
+            "stages_ms": {stage: round(seconds * 1000, 1) for stage, seconds in span.stages.items()},
+        })
+
+
+@contextmanager
+def stage(name: str):
+    # Times a block into bot_stage_seconds and the current update's span; stages may nest
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=name)
+        span = _current_span.get()
+        if span is not None:
+            span.add(name, elapsed)
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(body=REGISTRY.render().encode("utf-8"), headers={"Content-Type": CONTENT_TYPE})
+
+
+def authorized_metrics_handler(token: str):
+    # /metrics for a public server: only requests carrying the bearer token get the metrics
+    expected = f"Bearer {token}"
+
+    async def handler(request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get("Authorization", ""), expected):
+            return web.Response(status=401)
+        return await metrics_handler(request)
+    return handler
+
+
+async def start_metrics_server(port: int, host: str = "127.0.0.1") -> web.AppRunner:
+    # Standalone /metrics endpoint, local-only by default
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Metrics endpoint listening", extra={"port": port})
+    return runner
@@ -1,58 +1,185 @@
 import asyncio
-from mindee import Client, product, AsyncPredictResponse
-from config import MINDEE_API_KEY
-import traceback
-import os
+import functools
+import io
+import logging
+from config import MINDEE_API_KEY, MINDEE_PASSPORT_PRODUCTS, MINDEE_VEHICLE_PRODUCTS, OCR_MAX_IMAGE_SIDE, OCR_JPEG_QUALITY
+from documents import DOCUMENT_FIELDS, YEAR_PATTERN, fields_from_text
+from logs import redact
+
+logger = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=None)
+def _image_module():
+    # Pillow is optional and imported on first use to keep start-up fast
+    try:
+        from PIL import Image
+    except ImportError:  # images are then uploaded as received
+        return None
+    return Image
+
+
+def downscale_image(data: bytes, max_side: int = OCR_MAX_IMAGE_SIDE, quality: int = OCR_JPEG_QUALITY) -> bytes:
+    # Shrinks and recompresses the photo before upload; returns the input if it would not get smaller
+    Image = _image_module() if max_side else None
+    if Image is None:
+        return data
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            if max(image.size) <= max_side and image.format == "JPEG":
+                return data
+            image.thumbnail((max_side, max_side))
+            output = io.BytesIO()
+            image.convert("RGB").save(output, format="JPEG", quality=quality, optimize=True)
+    except Exception as e:
+        logger.warning("Error downscaling image: %s", e)
+        return data
+    resized = output.getvalue()
+    return resized if len(resized) < len(data) else data
+
+
+# Prediction attributes making up each normalized field, per Mindee product
+PRODUCT_FIELDS = {
+    "PassportV1": {
+        "name": ("given_names", "surname"),
+        "document_id": ("id_number",),
+        "birth_date": ("birth_date",),
+        "expiry_date": ("expiry_date",),
+        "country": ("country",),
+    },
+    "DriverLicenseV1": {
+        "name": ("first_name", "last_name"),
+        "document_id": ("id",),
+        "birth_date": ("date_of_birth",),
+        "expiry_date": ("expiry_date",),
+        "country": ("country_code",),
+    },
+    "InternationalIdV2": {
+        "name": ("given_names", "surnames"),
+        "document_id": ("document_number",),
+        "birth_date": ("birth_date",),
+        "expiry_date": ("expiry_date",),
+        "country": ("country_of_issue",),
+        "address": ("address",),
+    },
+    "fr.CarteGriseV1": {
+        "registration_number": ("a",),
+        "make_model": ("d1", "d3"),
+        "vin": ("e",),
+        "year": ("b",),
+    },
+}
+# Products only available through Mindee's async queue; the others are parsed synchronously
+ASYNC_PRODUCTS = {"DriverLicenseV1", "InternationalIdV2"}
+# Generic fallback: Mindee's full-text OCR extra (served with InternationalIdV2), fields are read from the text
+GENERIC_OCR_PRODUCT = "FullTextOCR"
+# Fields that may be matched by pattern in a product's text, for products reading vehicle documents
+TEXT_PATTERNS = {
+    "fr.CarteGriseV1": ("vin", "year"),
+    # A 17-character VIN is distinctive enough in arbitrary text, a 4-digit year is not
+    GENERIC_OCR_PRODUCT: ("vin",),
+}
+
+
+def _field_value(field):
+    # Mindee fields carry value and confidence; list fields (e.g. given names) are joined
+    fields = field if isinstance(field, list) else [field]
+    values = [str(f.value).strip() for f in fields if f is not None and getattr(f, "value", None) not in (None, "")]
+    confidences = [f.confidence for f in fields if f is not None and getattr(f, "confidence", None) is not None]
+    return " ".join(values), (min(confidences) if confidences else None)
+
+
+def normalize_prediction(product_name: str, prediction, doc_type: str):
+    # Returns (fields, confidence) with the normalized fields of the document type
+    fields, confidence = {}, {}
+    for name, attributes in PRODUCT_FIELDS.get(product_name, {}).items():
+        if name not in DOCUMENT_FIELDS[doc_type]:
+            continue
+        parts = [_field_value(getattr(prediction, attribute, None)) for attribute in attributes]
+        value = " ".join(value for value, _ in parts if value)
+        if name == "year":
+            match = YEAR_PATTERN.search(value)
+            value = match.group(0) if match else ""
+        if value:
+            fields[name] = value
+            scores = [score for _, score in parts if score is not None]
+            confidence[name] = round(min(scores), 3) if scores else None
+    return fields, confidence
+
 
 class MindeeClient:
+    PRODUCTS = {
+        "passport": MINDEE_PASSPORT_PRODUCTS,
+        "vehicle": MINDEE_VEHICLE_PRODUCTS,
+    }
+
     def __init__(self):
         try:
+            # The SDK is slow to import, so it is loaded with the first client
+            from mindee import Client, product
+            self.products = product
             self.client = Client(api_key=MINDEE_API_KEY)
-            print("Mindee client initialized successfully")
-        except Exception as e:
-            print(f"Error initializing Mindee client: {str(e)}")
-            raise e
+            logger.info("Mindee client initialized")
+        except Exception:
+            logger.exception("Error initializing Mindee client")
+            raise
 
-    async def recognize_document(self, filepath: str, doc_type: str) -> dict:
-        loop = asyncio.get_event_loop()
+    def _predict(self, product_name: str, input_doc):
+        if product_name == GENERIC_OCR_PRODUCT:
+            return self.client.enqueue_and_parse(self.products.InternationalIdV2, input_doc, full_text=True)
+        product_class = functools.reduce(getattr, product_name.split("."), self.products)
+        if product_name in ASYNC_PRODUCTS:
+            return self.client.enqueue_and_parse(product_class, input_doc)
+        return self.client.parse(product_class, input_doc)
 
-        def _sync_call():
+    def parse(self, data: bytes, doc_type: str, filename: str = "document.jpg") -> dict:
+        # Blocking: uploads the image and waits for the prediction. Products are tried in order
+        # until one yields typed fields; the rendered text fills in fields a product lacks.
+        doc_type = "passport" if doc_type == "passport" else "vehicle"
+        image = downscale_image(bytes(data))
+        logger.debug("Processing document", extra={"doc_type": doc_type, "bytes": len(image)})
+        readable_data = None
+        last_error = None
+        for product_name in self.PRODUCTS[doc_type]:
             try:
-                print(f"Processing {doc_type} document: {filepath}")
-                input_doc = self.client.source_from_path(filepath)
-                print("Document loaded successfully")
-                
-                # Use DriverLicenseV1 for document processing
-                result: AsyncPredictResponse = self.client.enqueue_and_parse(
-                    product.DriverLicenseV1,
-                    input_doc
-                )
-                
-                # Extract text from the document
-                readable_data = {
-                    "full_text": str(result.document) if result.document else "No text extracted",
-                    "document_type": doc_type
-                }
-                
-                print(f"Extracted data from {doc_type}: {readable_data}")
-                return readable_data
-                
+                input_doc = self.client.source_from_bytes(image, filename)
+                result = self._predict(product_name, input_doc)
             except Exception as e:
-                print(f"Error in document recognition: {str(e)}")
-                print("Full traceback:")
-                print(traceback.format_exc())
-                raise e
-            finally:
-                # Clean up the temporary file
-                try:
-                    if os.path.exists(filepath):
-                        os.remove(filepath)
-                        print(f"Cleaned up temporary file: {filepath}")
-                except Exception as e:
-                    print(f"Error cleaning up file {filepath}: {str(e)}")
+                last_error = e
+                logger.warning("Mindee product failed", exc_info=True, extra={"doc_type": doc_type, "product": product_name})
+                continue
+            if not result.document:
+                continue
+            patterns = TEXT_PATTERNS.get(product_name, ())
+            if product_name == GENERIC_OCR_PRODUCT:
+                text = str(result.document.extras.full_text_ocr)
+                fields, confidence = fields_from_text(text, doc_type, patterns), {}
+            else:
+                text = str(result.document)
+                fields, confidence = normalize_prediction(product_name, result.document.inference.prediction, doc_type)
+            if not fields:
+                # Nothing of this document type was read, e.g. a licence product on a vehicle document
+                continue
+            readable_data = {
+                "document_type": doc_type,
+                "product": product_name,
+                "fields": {**fields_from_text(text, doc_type, patterns), **fields},
+                "confidence": confidence,
+            }
+            break
 
+        if readable_data is None:
+            if last_error is not None:
+                logger.error("Error in document recognition", extra={"doc_type": doc_type})
+                raise last_error
+            return {}
+        logger.debug("Extracted document data", extra={"doc_type": doc_type, "data": redact(readable_data)})
+        return readable_data
+
+    async def recognize_document(self, data: bytes, doc_type: str, filename: str = "document.jpg", executor=None) -> dict:
+        loop = asyncio.get_event_loop()
         try:
-            return await loop.run_in_executor(None, _sync_call)
-        except Exception as e:
-            print(f"Error in async execution: {str(e)}")
-            raise e
+            return await loop.run_in_executor(executor, self.parse, data, doc_type, filename)
+        except Exception:
+            logger.exception("Error in async execution")
+            raise
@@ -0,0 +1,95 @@
+import hashlib
+import time
+from collections import OrderedDict
+from config import OCR_CACHE_DB_MAX_ENTRIES, OCR_CACHE_SIZE, OCR_CACHE_TTL_SECONDS
+from database import ChatHistoryDB
+from metrics import OCR_CACHE_LOOKUPS
+
+
+# OCR results keyed by image content hash (and Telegram file_unique_id) plus doc_type.
+# An in-memory LRU sits in front of the ocr_results table so entries survive restarts.
+class OCRCache:
+    def __init__(
+        self,
+        db: ChatHistoryDB = None,
+        max_entries: int = OCR_CACHE_SIZE,
+        ttl: float = OCR_CACHE_TTL_SECONDS,
+        max_db_entries: int = OCR_CACHE_DB_MAX_ENTRIES,
+    ):
+        self.db = db
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_db_entries = max_db_entries
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._next_purge = 0.0
+        # The table is purged hourly, or sooner when this many rows were written since
+        self._purge_every = max(1, max_db_entries // 10) if max_db_entries else 0
+        self._writes_since_purge = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def content_key(data: bytes, doc_type: str) -> str:
+        return f"sha256:{hashlib.sha256(data).hexdigest()}:{doc_type}"
+
+    @staticmethod
+    def file_key(file_unique_id: str, doc_type: str) -> str:
+        return f"file:{file_unique_id}:{doc_type}"
+
+    def _remember(self, key: str, result: dict, expires_at: float):
+        self._entries[key] = (result, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get(self, key: str):
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] <= now:
+            del self._entries[key]
+            entry = None
+        if entry is None and self.db is not None:
+            stored = await self.db.get_ocr_result(key, now)
+            if stored is not None:
+                entry = stored
+                self._remember(key, *stored)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def record_lookup(self, hit: bool):
+        # Counted once per photo, however many keys were tried
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        OCR_CACHE_LOOKUPS.inc(result="hit" if hit else "miss")
+
+    async def put(self, keys, doc_type: str, result: dict):
+        expires_at = time.time() + self.ttl
+        for key in keys:
+            self._remember(key, result, expires_at)
+        if self.db is not None:
+            await self.db.put_ocr_results(keys, doc_type, result, expires_at)
+            self._writes_since_purge += len(keys)
+        if time.time() >= self._next_purge or (self._purge_every and self._writes_since_purge >= self._purge_every):
+            self._next_purge = time.time() + 3600
+            self._writes_since_purge = 0
+            await self.purge_expired()
+
+    async def purge_expired(self):
+        now = time.time()
+        for key in [key for key, (_, expires_at) in self._entries.items() if expires_at <= now]:
+            del self._entries[key]
+        if self.db is not None:
+            await self.db.purge_ocr_results(now, self.max_db_entries)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,154 @@
+import asyncio
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from config import OCR_WORKERS, OCR_QUEUE_SIZE
+from metrics import OCR_QUEUE_DEPTH, OCR_RUNNING, STAGE_SECONDS
+
+
+class OCRQueueFull(Exception):
+    pass
+
+
+class OCRJobCancelled(Exception):
+    pass
+
+
+class OCRJob:
+    def __init__(self, chat_id: str, fn, on_progress=None, tag=None):
+        self.chat_id = chat_id
+        self.tag = tag
+        self.fn = fn
+        self.on_progress = on_progress
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+        self.position = None
+
+    def cancel(self):
+        if not self.future.done():
+            self.future.set_exception(OCRJobCancelled(f"Superseded by a newer upload in chat {self.chat_id}"))
+
+
+# Dedicated, bounded executor for blocking OCR calls (Mindee polls its queue synchronously).
+# Jobs wait in a FIFO of at most max_queue entries; each chat keeps only its newest job.
+class OCRScheduler:
+    def __init__(self, workers: int = OCR_WORKERS, max_queue: int = OCR_QUEUE_SIZE):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ocr")
+        self._queue = deque()
+        self._available = None
+        self._worker_tasks = []
+        self._jobs = {}
+        self.running = 0
+        self.started = 0
+        self.completed = 0
+        self.rejected = 0
+        self.cancelled = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        OCR_QUEUE_DEPTH.set_function(lambda: len(self._queue))
+        OCR_RUNNING.set_function(lambda: self.running)
+
+    def _ensure_workers(self):
+        if self._worker_tasks:
+            return
+        self._available = asyncio.Semaphore(0)
+        loop = asyncio.get_running_loop()
+        self._worker_tasks = [loop.create_task(self._worker()) for _ in range(self.workers)]
+
+    def _notify(self, job: OCRJob, position: int):
+        if job.on_progress is None or job.position == position:
+            return
+        job.position = position
+        task = asyncio.get_running_loop().create_task(job.on_progress(position))
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    def _notify_queue(self):
+        for position, job in enumerate(self._queue, start=1):
+            self._notify(job, position)
+
+    async def submit(self, chat_id: str, fn, on_progress=None, tag=None):
+        # on_progress(position) is awaited in the background: N >= 1 while queued, 0 once started
+        self._ensure_workers()
+        previous = self._jobs.get(chat_id)
+        previous_queued = previous is not None and previous in self._queue
+        if len(self._queue) - previous_queued >= self.max_queue:
+            self.rejected += 1
+            raise OCRQueueFull(f"OCR queue is full ({self.max_queue} jobs)")
+        self.cancel(chat_id)
+
+        job = OCRJob(chat_id, fn, on_progress, tag)
+        self._jobs[chat_id] = job
+        self._queue.append(job)
+        self._available.release()
+        self._notify(job, len(self._queue))
+        try:
+            return await job.future
+        finally:
+            if self._jobs.get(chat_id) is job:
+                del self._jobs[chat_id]
+
+    def cancel(self, chat_id: str, tag=None) -> bool:
+        # Fails the chat's queued or running job (only if it has the given tag, when one is given)
+        # with OCRJobCancelled; a running Mindee call still finishes in its thread but the result is dropped
+        job = self._jobs.get(chat_id)
+        if job is None or job.future.done() or (tag is not None and job.tag != tag):
+            return False
+        self.cancelled += 1
+        job.cancel()
+        if job in self._queue:
+            self._queue.remove(job)
+            self._notify_queue()
+        return True
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._available.acquire()
+            if not self._queue:
+                continue
+            job = self._queue.popleft()
+            self._notify_queue()
+            if job.future.done():
+                continue
+
+            wait = time.monotonic() - job.enqueued_at
+            self.started += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            STAGE_SECONDS.observe(wait, stage="ocr_queue")
+            self._notify(job, 0)
+            self.running += 1
+            try:
+                result = await loop.run_in_executor(self.executor, job.fn)
+            except Exception as e:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                if not job.future.done():
+                    job.future.set_result(result)
+            finally:
+                self.running -= 1
+                self.completed += 1
+
+    async def close(self):
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+        for job in self._queue:
+            job.cancel()
+        self._queue.clear()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": len(self._queue),
+            "running": self.running,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "cancelled": self.cancelled,
+            "avg_wait_seconds": self.total_wait / self.started if self.started else 0.0,
+            "max_wait_seconds": self.max_wait,
+        }
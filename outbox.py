@@ -0,0 +1,190 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from telegram import Message
+from telegram.constants import MessageLimit
+from telegram.error import RetryAfter, TelegramError
+from config import OUTBOX_CHAT_BURST, OUTBOX_CHAT_RATE, OUTBOX_GLOBAL_RATE, OUTBOX_MAX_RETRIES
+from metrics import ERRORS, stage
+
+logger = logging.getLogger(__name__)
+
+# Telegram shows a chat action for about five seconds
+CHAT_ACTION_INTERVAL_SECONDS = 4.5
+
+
+def split_text(text: str, limit: int = MessageLimit.MAX_TEXT_LENGTH) -> list:
+    # Splits at the last paragraph, line or word break that fits; hard cut as a last resort
+    chunks = []
+    while len(text) > limit:
+        cut = max(text.rfind("\n\n", 0, limit), text.rfind("\n", 0, limit), text.rfind(" ", 0, limit))
+        if cut <= 0:
+            cut = limit
+        chunks.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text:
+        chunks.append(text)
+    return chunks
+
+
+def coalesce_texts(texts, limit: int = MessageLimit.MAX_TEXT_LENGTH) -> list:
+    # Joins adjacent texts into as few messages as fit the limit, keeping their order
+    messages = []
+    for text in texts:
+        for chunk in split_text(text, limit):
+            if messages and len(messages[-1]) + 2 + len(chunk) <= limit:
+                messages[-1] += "\n\n" + chunk
+            else:
+                messages.append(chunk)
+    return messages
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        # Takes a token and returns how long to wait before using it; reservations queue up in order
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    def idle(self, now: float) -> bool:
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+# Outbound Telegram traffic: per-chat and global token buckets, coalescing of queued
+# replies, splitting of long texts, RetryAfter handling and chat action indicators.
+class Outbox:
+    def __init__(
+        self,
+        global_rate: float = OUTBOX_GLOBAL_RATE,
+        chat_rate: float = OUTBOX_CHAT_RATE,
+        chat_burst: int = OUTBOX_CHAT_BURST,
+        max_retries: int = OUTBOX_MAX_RETRIES,
+        max_chat_buckets: int = 1024,
+    ):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_chat_buckets = max_chat_buckets
+        self._chat_buckets = {}
+        # Replies queued per chat with the message to answer, sent together by flush()
+        self._pending = {}
+        # Newest text of each message with an edit in progress
+        self._edits = {}
+        self.sent = 0
+        self.coalesced = 0
+        self.retries = 0
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= self.max_chat_buckets:
+                # Full buckets carry no state, drop them
+                now = time.monotonic()
+                for idle_chat_id in [key for key, value in self._chat_buckets.items() if value.idle(now)]:
+                    del self._chat_buckets[idle_chat_id]
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _acquire(self, chat_id):
+        await asyncio.sleep(self._chat_bucket(chat_id).reserve())
+        await asyncio.sleep(self.global_bucket.reserve())
+
+    async def _send(self, chat_id, method, *args, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            try:
+                with stage("send"):
+                    result = await method(*args, **kwargs)
+                self.sent += 1
+                return result
+            except RetryAfter as e:
+                ERRORS.inc(where="telegram", type="RetryAfter")
+                if attempt == self.max_retries:
+                    raise
+                self.retries += 1
+                logger.warning("Telegram flood limit, retrying", extra={"chat_id": chat_id, "retry_after": e.retry_after})
+                await asyncio.sleep(e.retry_after)
+
+    async def call(self, chat_id, method, *args, **kwargs):
+        # Runs a Bot API method once both buckets allow it, retrying when Telegram asks to wait
+        await self._acquire(chat_id)
+        return await self._send(chat_id, method, *args, **kwargs)
+
+    async def send_text(self, message: Message, text: str):
+        # Sends now, after anything queued for the chat; returns the last message sent
+        await self.flush(message.chat_id)
+        sent = None
+        for chunk in split_text(text):
+            sent = await self.call(message.chat_id, message.reply_text, chunk)
+        return sent
+
+    def queue_text(self, message: Message, text: str):
+        self._pending.setdefault(message.chat_id, []).append((message, text))
+
+    async def flush(self, chat_id):
+        pending = self._pending.pop(chat_id, None)
+        if not pending:
+            return
+        message = pending[-1][0]
+        texts = coalesce_texts([text for _, text in pending])
+        self.coalesced += len(pending) - len(texts)
+        for text in texts:
+            await self.call(chat_id, message.reply_text, text)
+
+    async def send_document(self, message: Message, document, filename: str):
+        await self.flush(message.chat_id)
+        return await self.call(message.chat_id, message.reply_document, document=document, filename=filename)
+
+    async def edit_text(self, message: Message, text: str):
+        # Edits waiting for their turn are merged, only the newest text is sent.
+        # Returns None when the edit was merged into one already in progress.
+        key = (message.chat_id, message.message_id)
+        if key in self._edits:
+            self._edits[key] = text
+            self.coalesced += 1
+            return None
+        self._edits[key] = text
+        sent_text = result = None
+        try:
+            while self._edits[key] != sent_text:
+                await self._acquire(message.chat_id)
+                sent_text = self._edits[key]
+                result = await self._send(message.chat_id, message.edit_text, sent_text)
+        finally:
+            del self._edits[key]
+        return result
+
+    async def _repeat_chat_action(self, message: Message, action: str):
+        while True:
+            try:
+                await message.reply_chat_action(action)
+            except TelegramError as e:
+                # Indicators are best effort and never retried
+                logger.debug("Chat action not sent: %s", e)
+            await asyncio.sleep(CHAT_ACTION_INTERVAL_SECONDS)
+
+    @asynccontextmanager
+    async def chat_action(self, message: Message, action: str):
+        # Shows e.g. "typing..." for as long as the block runs
+        task = asyncio.get_running_loop().create_task(self._repeat_chat_action(message, action))
+        try:
+            yield
+        finally:
+            task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "retries": self.retries,
+            "pending_chats": len(self._pending),
+        }
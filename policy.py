@@ -0,0 +1,112 @@
+import secrets
+from datetime import date
+from config import INSURANCE_PRICE_USD
+from documents import document_fields
+
+POLICY_TEMPLATE = (
+    "CAR INSURANCE POLICY\n"
+    "Policy Number: {policy_number}\n"
+    "Issue Date: {issue_date}\n\n"
+    "INSURED DETAILS\n"
+    "Full Name: {full_name}\n"
+    "Document ID: {document_id}\n"
+    "Address: {address}\n\n"
+    "VEHICLE DETAILS\n"
+    "Make and Model: {make_model}\n"
+    "Vehicle ID/VIN: {vin}\n"
+    "Year: {year}\n\n"
+    "COVERAGE DETAILS\n"
+    "Type: Comprehensive Car Insurance\n"
+    "Coverage Period: 12 months from issue date\n"
+    "Premium Amount: {price} USD\n"
+    "Coverage Includes:\n"
+    "- Third Party Liability (up to $100,000)\n"
+    "- Collision Damage\n"
+    "- Natural Disasters\n"
+    "- Theft Protection\n"
+    "- 24/7 Roadside Assistance\n\n"
+    "TERMS AND CONDITIONS\n"
+    "1. This policy is valid for 12 months from the issue date\n"
+    "2. Claims must be reported within 24 hours of incident\n"
+    "3. Deductible: $500 per claim\n"
+    "4. Policy is non-transferable\n"
+    "5. Coverage is valid within the territory of operation\n\n"
+    "For assistance, contact:\n"
+    "Phone: +1-800-INSURE\n"
+    "Email: support@carinsurance.com\n"
+    "---END OF POLICY---"
+)
+
+NOT_AVAILABLE = "N/A"
+
+
+def generate_policy_number(issue_date: date) -> str:
+    # Random, so numbers never repeat; store it with the chat to render the same policy again
+    return f"POL-{issue_date.year}-{secrets.token_hex(5).upper()}"
+
+
+def new_policy(issue_date: date = None) -> dict:
+    issue_date = issue_date or date.today()
+    return {"number": generate_policy_number(issue_date), "issue_date": issue_date.isoformat()}
+
+
+def render_policy(policy: dict, passport_data: dict, vehicle_data: dict) -> str:
+    # policy is the stored dict from new_policy()
+    passport = document_fields(passport_data, "passport")
+    vehicle = document_fields(vehicle_data, "vehicle")
+    text = POLICY_TEMPLATE.format(
+        policy_number=policy["number"],
+        issue_date=policy["issue_date"],
+        full_name=passport.get("name", NOT_AVAILABLE),
+        document_id=passport.get("document_id", NOT_AVAILABLE),
+        address=passport.get("address", NOT_AVAILABLE),
+        make_model=vehicle.get("make_model", NOT_AVAILABLE),
+        vin=vehicle.get("vin", NOT_AVAILABLE),
+        year=vehicle.get("year", NOT_AVAILABLE),
+        price=INSURANCE_PRICE_USD,
+    )
+    return text
+
+
+def _pdf_escape(line: str) -> str:
+    line = line.encode("latin-1", "replace").decode("latin-1")
+    return line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def render_policy_pdf(text: str, lines_per_page: int = 60, max_line_length: int = 90) -> bytes:
+    # Minimal single-font PDF writer; CPU bound, so call it from a worker thread
+    lines = []
+    for line in text.split("\n"):
+        while len(line) > max_line_length:
+            lines.append(line[:max_line_length])
+            line = line[max_line_length:]
+        lines.append(line)
+    pages = [lines[i:i + lines_per_page] for i in range(0, len(lines), lines_per_page)] or [[]]
+
+    # Object ids: 1 catalog, 2 page tree, 3 font, then a page and a content stream per page
+    page_ids = [4 + 2 * i for i in range(len(pages))]
+    objects = {
+        1: b"<< /Type /Catalog /Pages 2 0 R >>",
+        2: ("<< /Type /Pages /Kids [%s] /Count %d >>" % (" ".join(f"{pid} 0 R" for pid in page_ids), len(pages))).encode("latin-1"),
+        3: b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>",
+    }
+    for page_id, page_lines in zip(page_ids, pages):
+        content = "BT /F1 11 Tf 13 TL 50 800 Td\n" + "".join(f"({_pdf_escape(line)}) Tj T*\n" for line in page_lines) + "ET"
+        stream = content.encode("latin-1")
+        objects[page_id] = (
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {page_id + 1} 0 R >>"
+        ).encode("latin-1")
+        objects[page_id + 1] = b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream"
+
+    output = bytearray(b"%PDF-1.4\n")
+    offsets = {}
+    for object_id in sorted(objects):
+        offsets[object_id] = len(output)
+        output += b"%d 0 obj\n" % object_id + objects[object_id] + b"\nendobj\n"
+    xref_offset = len(output)
+    output += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for object_id in sorted(objects):
+        output += b"%010d 00000 n \n" % offsets[object_id]
+    output += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref_offset)
+    return bytes(output)
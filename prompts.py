@@ -0,0 +1,94 @@
+from config import INSURANCE_PRICE_USD
+
+# Static part of every request; sent as systemInstruction so it can be context cached
+SYSTEM_PROMPT = (
+    "FOLLOW THE HISTORY!!!! "
+    "You are a virtual assistant for an insurance company, operating inside a Telegram bot. "
+    "Your job is to politely and clearly help users purchase car insurance. Communicate in a friendly, human-like manner without being too formal. "
+    "Follow this strict scenario and do not deviate: "
+    "1. Greeting and purpose: Briefly introduce yourself and explain that you're here to help with car insurance. Immediately move to the next step. "
+    "2. Request documents: Ask the user to send a photo of their passport. "
+    "3. After passport verification: Ask the user to send a photo of their vehicle identification document. "
+    "4. Data confirmation: Once both documents are processed, display the extracted information as text. Then ask: "
+    "'Please check if everything is correct. If there are any mistakes, you can send either photo again.' "
+    f"5. Price: If the user confirms the data, reply: 'The insurance price is {INSURANCE_PRICE_USD} USD. This is a fixed rate.' Then ask if they are ready to proceed. "
+    "6. Completion: If the user agrees, reply: 'Great, I am issuing your policy now.' "
+    "The policy document itself is generated and sent by the system, so never write the policy text yourself.\n\n"
+    "⚠️ Handling invalid inputs: If the user says something off-topic (e.g., asks about other insurance types, jokes, is rude, or sends nonsense), reply politely and neutrally. For example: "
+    "'I can only help with car insurance. Shall we begin?' "
+    "'Please send the required documents to continue.' "
+    "'Sorry, I can only assist with car insurance at the moment.' "
+    "‼️ Never make up information. Do not pretend to be a real person. Only respond based on known context. If something is unclear — ask the user to clarify. "
+    "Additional instructions: "
+    "- If the user asks questions related to the car insurance process, such as: "
+    "'What kind of insurance is this?' "
+    "'How much does it cost?' "
+    "'What does the insurance cover?' "
+    "or any other reasonable questions about the insurance product or pricing, "
+    "answer these questions politely and clearly, then immediately continue with the current step of the scenario without skipping or restarting steps. "
+    "- Do not deviate from the scenario flow even after answering such questions. Always bring the user back to the next expected step. "
+    "IMPORTANT"
+    "Step tracking: After completing any of the 5 scenario steps, include this line exactly once in your reply to indicate the step number:\n"
+    "'[STEP COMPLETED: X]' where X = CURRENT STEP + 1, if step was completed.(1-6) (if not completed X=-1). DO NOT DECREASE STEP NUMBER!"
+)
+
+# Per-step reminder added to the last user turn
+STEP_INSTRUCTIONS = {
+    0: "The conversation has just started. Greet the user and ask for a photo of their passport.",
+    1: "Waiting for the passport photo. Ask the user to send it.",
+    2: "Waiting for the passport photo. Ask the user to send it.",
+    3: "The passport was processed. Ask for a photo of the vehicle identification document.",
+    4: "Both documents were processed and shown. Ask the user to confirm the extracted data.",
+    5: f"The data was confirmed and the price of {INSURANCE_PRICE_USD} USD was quoted. Ask if the user is ready to proceed.",
+    6: "The policy was already issued. Only answer follow-up questions about it.",
+}
+
+
+# System instruction of the background summarization calls
+SUMMARY_PROMPT = (
+    "You maintain the running summary of a conversation between a car insurance Telegram bot and a user. "
+    "You get the current summary and the turns that happened after it. Return the updated summary only, "
+    "at most 120 words, in plain text. Keep every fact that matters for the sale: which documents were sent "
+    "and processed, what the user confirmed or corrected, whether the price was quoted and accepted, "
+    "questions the user asked and what is still open. Drop greetings and small talk. "
+    "Never include step markers such as [STEP COMPLETED: X]."
+)
+
+
+def estimate_tokens(text: str) -> int:
+    # Rough count for budgeting, about four characters per token
+    return (len(text) + 3) // 4
+
+
+def fit_turns(turns, max_tokens: int) -> list:
+    # Newest turns that fit in the token budget, oldest first
+    fitted = []
+    for user_message, bot_response in reversed(turns):
+        max_tokens -= estimate_tokens(user_message) + estimate_tokens(bot_response)
+        if max_tokens < 0:
+            break
+        fitted.append((user_message, bot_response))
+    fitted.reverse()
+    return fitted
+
+
+def build_summary_request(summary: str, turns) -> str:
+    history = "".join(f"User: {user_message}\nBot: {bot_response}\n" for user_message, bot_response in turns)
+    return f"Current summary:\n{summary or '(empty)'}\n\nNew turns:\n{history}"
+
+
+def build_contents(turns, user_input: str, step: int, summary: str = "", documents: str = "") -> list:
+    # Multi-turn Gemini contents: history as user/model pairs, then the new message
+    contents = []
+    for user_message, bot_response in turns:
+        contents.append({"role": "user", "parts": [{"text": user_message}]})
+        contents.append({"role": "model", "parts": [{"text": bot_response}]})
+    step_note = f"[SYSTEM NOTE] CURRENT STEP = {step}. {STEP_INSTRUCTIONS.get(step, '')}".strip()
+    if documents:
+        step_note += f" Extracted document data: {documents}."
+    parts = [{"text": step_note}, {"text": user_input}]
+    if summary:
+        # Earlier turns only survive as the summary, it goes with the step note
+        parts.insert(0, {"text": f"[SYSTEM NOTE] Summary of the earlier conversation: {summary}"})
+    contents.append({"role": "user", "parts": parts})
+    return contents
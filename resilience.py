@@ -0,0 +1,68 @@
+import random
+import time
+from collections import deque
+
+
+def backoff_delay(attempt: int, base: float, maximum: float) -> float:
+    # Exponential backoff with full jitter: uniform in [0, min(maximum, base * 2^attempt)]
+    return random.uniform(0, min(maximum, base * (2 ** attempt)))
+
+
+class LatencyTracker:
+    # Sliding window of recent successful call latencies
+    def __init__(self, window: int = 200):
+        self.samples = deque(maxlen=window)
+
+    def record(self, seconds: float):
+        self.samples.append(seconds)
+
+    def percentile(self, percentile: float, min_samples: int = 20):
+        if len(self.samples) < min_samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+
+# Stops calling a failing backend for reset_timeout seconds after failure_threshold
+# consecutive failures, then lets a single trial call through (half-open).
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        # Start of the half-open trial call, None when no trial is running
+        self._trial_started_at = None
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        now = time.monotonic()
+        if self.state == self.OPEN and now - self.opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+            self._trial_started_at = None
+        # A trial that never reported back (e.g. cancelled) is replaced after reset_timeout
+        if self.state == self.HALF_OPEN and (self._trial_started_at is None or now - self._trial_started_at >= self.reset_timeout):
+            self._trial_started_at = now
+            return True
+        return False
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self._trial_started_at = None
+
+    def record_failure(self) -> bool:
+        # Returns True when this failure opened the circuit
+        self.failures += 1
+        if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self._trial_started_at = None
+            return True
+        return False
@@ -0,0 +1,311 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from config import SESSION_CACHE_SIZE, SESSION_CACHE_TTL_SECONDS, SESSION_FLUSH_INTERVAL_SECONDS
+from database import ChatHistoryDB, format_trimmed_history, trim_turns
+from metrics import ERRORS, SESSION_CACHE_LOOKUPS, STEP_TRANSITIONS
+
+logger = logging.getLogger(__name__)
+
+
+class ChatSession:
+    def __init__(
+        self,
+        chat_id: str,
+        step_passed: int = 0,
+        passport_data=None,
+        vehicle_data=None,
+        turns=(),
+        max_turns: int = 20,
+        summary: str = "",
+        summary_sequence: int = 0,
+        turn_count: int = 0,
+        policy=None,
+    ):
+        self.chat_id = chat_id
+        self.step_passed = step_passed
+        self.documents = {
+            "passport": passport_data or {},
+            "vehicle": vehicle_data or {},
+        }
+        self.turns = deque(turns, maxlen=max_turns)
+        # The summary covers turns 1..summary_sequence; turn_count is the sequence of the newest turn
+        self.summary = summary
+        self.summary_sequence = summary_sequence
+        self.turn_count = turn_count or len(self.turns)
+        self.policy = policy or {}
+        self.pending_turns = []
+        self.dirty_fields = set()
+        # Set while a flush of this session's writes is in flight
+        self.flushing = False
+        self.last_access = time.monotonic()
+
+    @property
+    def is_dirty(self) -> bool:
+        return bool(self.dirty_fields or self.pending_turns)
+
+    @property
+    def first_cached_sequence(self) -> int:
+        # Sequence of the oldest turn still in the deque
+        return self.turn_count - len(self.turns) + 1
+
+    def turns_after(self, sequence: int) -> list:
+        # Cached turns newer than the given sequence
+        return list(self.turns)[max(0, sequence + 1 - self.first_cached_sequence):]
+
+
+# Write-behind LRU of per-chat state exposing the same API as ChatHistoryDB.
+# Writes are buffered and flushed in one transaction every flush_interval seconds.
+class SessionCache:
+    def __init__(
+        self,
+        db: ChatHistoryDB,
+        max_sessions: int = SESSION_CACHE_SIZE,
+        ttl: float = SESSION_CACHE_TTL_SECONDS,
+        flush_interval: float = SESSION_FLUSH_INTERVAL_SECONDS,
+        max_turns: int = 20,
+    ):
+        self.db = db
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.max_turns = max_turns
+        self._sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+        # Dirty sessions dropped from the LRU that still have to be written
+        self._evicted = {}
+        self._loading = {}
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.flushes = 0
+
+    async def _get(self, chat_id: str) -> ChatSession:
+        self._ensure_flush_task()
+        session = self._sessions.get(chat_id)
+        if session is None and chat_id in self._evicted:
+            session = self._evicted.pop(chat_id)
+            self._sessions[chat_id] = session
+        if session is not None:
+            self.hits += 1
+            SESSION_CACHE_LOOKUPS.inc(result="hit")
+            self._sessions.move_to_end(chat_id)
+            session.last_access = time.monotonic()
+            return session
+
+        self.misses += 1
+        SESSION_CACHE_LOOKUPS.inc(result="miss")
+        loading = self._loading.get(chat_id)
+        if loading is None:
+            loading = asyncio.ensure_future(self._load(chat_id))
+            self._loading[chat_id] = loading
+            try:
+                session = await loading
+            finally:
+                self._loading.pop(chat_id, None)
+            self._sessions[chat_id] = session
+            self._evict_overflow()
+            return session
+        return await loading
+
+    async def _load(self, chat_id: str) -> ChatSession:
+        state = await self.db.load_session(chat_id, self.max_turns)
+        if state is None:
+            return ChatSession(chat_id, max_turns=self.max_turns)
+        return ChatSession(chat_id, max_turns=self.max_turns, **state)
+
+    def _evict(self, chat_id: str):
+        session = self._sessions.pop(chat_id)
+        # Kept until written, or a reload could read the row from before the flush in flight
+        if session.is_dirty or session.flushing:
+            self._evicted[chat_id] = session
+        self.evictions += 1
+
+    def _evict_overflow(self):
+        while len(self._sessions) > self.max_sessions:
+            self._evict(next(iter(self._sessions)))
+
+    def _evict_expired(self):
+        deadline = time.monotonic() - self.ttl
+        for chat_id in [chat_id for chat_id, session in self._sessions.items() if session.last_access < deadline]:
+            self._evict(chat_id)
+
+    def _ensure_flush_task(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                self._evict_expired()
+                await self.flush()
+            except Exception as e:
+                ERRORS.inc(where="session_flush", type=type(e).__name__)
+                logger.error("Session flush error", exc_info=True)
+
+    def _session_queries(self, session: ChatSession):
+        # The chat row is always upserted so turns never exist without it
+        values = {"step_passed": session.step_passed}
+        for doc_type in ("passport", "vehicle"):
+            if doc_type in session.dirty_fields:
+                values[f"{doc_type}_data"] = session.documents[doc_type]
+        if "summary" in session.dirty_fields:
+            values["summary"] = session.summary
+            values["summary_sequence"] = session.summary_sequence
+        if "policy" in session.dirty_fields:
+            values["policy"] = session.policy
+        queries = [self.db.upsert_chat_query(session.chat_id, **values)]
+        for user_message, bot_response in session.pending_turns:
+            queries.append(self.db.add_message_query(session.chat_id, user_message, bot_response))
+        return queries
+
+    async def flush(self, chat_id: str = None):
+        # Flushes every dirty session, or only the given chat's
+        async with self._flush_lock:
+            sessions = [s for s in self._sessions.values() if s.is_dirty] + list(self._evicted.values())
+            if chat_id is not None:
+                sessions = [s for s in sessions if s.chat_id == chat_id]
+            if not sessions:
+                return
+            queries = []
+            snapshot = []
+            for session in sessions:
+                queries.extend(self._session_queries(session))
+                snapshot.append((session, session.dirty_fields, session.pending_turns))
+                session.dirty_fields = set()
+                session.pending_turns = []
+                session.flushing = True
+            try:
+                await self.db.execute_batch(queries)
+            except Exception:
+                # Put the state back so the next flush retries it
+                for session, dirty_fields, pending_turns in snapshot:
+                    session.dirty_fields |= dirty_fields
+                    session.pending_turns = pending_turns + session.pending_turns
+                raise
+            finally:
+                for session in sessions:
+                    session.flushing = False
+                    # Evicted sessions are dropped once their state is in the database
+                    if self._evicted.get(session.chat_id) is session and not session.is_dirty:
+                        del self._evicted[session.chat_id]
+            self.flushes += 1
+
+    async def invalidate(self, chat_id: str):
+        # Drops the cached state so the next access reloads it, e.g. after another worker wrote it
+        await self.flush(chat_id)
+        session = self._sessions.get(chat_id)
+        if session is not None and not session.is_dirty and not session.flushing:
+            del self._sessions[chat_id]
+
+    def discard(self, chat_id: str):
+        # Drops the cached state and its unwritten changes, e.g. after the chat's lease was lost
+        self._sessions.pop(chat_id, None)
+        self._evicted.pop(chat_id, None)
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "sessions": len(self._sessions),
+            "dirty": sum(1 for s in self._sessions.values() if s.is_dirty) + len(self._evicted),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "flushes": self.flushes,
+        }
+
+    def peek_step_passed(self, chat_id: str):
+        # Cached step without loading the session, None when the chat is not cached
+        session = self._sessions.get(chat_id) or self._evicted.get(chat_id)
+        return session.step_passed if session is not None else None
+
+    async def get_step_passed(self, chat_id: str):
+        return (await self._get(chat_id)).step_passed
+
+    async def set_step_passed(self, chat_id: str, step: int):
+        session = await self._get(chat_id)
+        if session.step_passed != step:
+            STEP_TRANSITIONS.inc(from_step=session.step_passed, to_step=step)
+            logger.info("Step changed", extra={"chat_id": chat_id, "from_step": session.step_passed, "to_step": step})
+        session.step_passed = step
+        session.dirty_fields.add("step_passed")
+
+    async def get_document_data(self, chat_id: str, doc_type: str) -> dict:
+        session = await self._get(chat_id)
+        return session.documents["passport" if doc_type == "passport" else "vehicle"]
+
+    async def set_document_data(self, chat_id: str, doc_type: str, data: dict):
+        session = await self._get(chat_id)
+        doc_type = "passport" if doc_type == "passport" else "vehicle"
+        session.documents[doc_type] = data
+        session.dirty_fields.add(doc_type)
+
+    async def get_policy(self, chat_id: str) -> dict:
+        return (await self._get(chat_id)).policy
+
+    async def set_policy(self, chat_id: str, policy: dict):
+        session = await self._get(chat_id)
+        session.policy = policy
+        session.dirty_fields.add("policy")
+
+    async def add_message(self, chat_id: str, user_message: str, bot_response: str):
+        session = await self._get(chat_id)
+        session.turns.append((user_message, bot_response))
+        session.pending_turns.append((user_message, bot_response))
+        session.turn_count += 1
+
+    async def get_trimmed_chat_history(self, chat_id: str, max_length: int = 2048) -> str:
+        session = await self._get(chat_id)
+        return format_trimmed_history(list(session.turns), max_length)
+
+    async def get_recent_turns(self, chat_id: str, max_length: int = 2048) -> list:
+        session = await self._get(chat_id)
+        return trim_turns(list(session.turns), max_length)
+
+    async def get_prompt_context(self, chat_id: str):
+        # Rolling summary and the turns it does not cover yet
+        session = await self._get(chat_id)
+        return session.summary, session.turns_after(session.summary_sequence)
+
+    async def get_turns_to_summarize(self, chat_id: str, keep_recent: int, min_turns: int, max_turns: int = None):
+        # Returns (summary, summary_sequence, turns, new_sequence) once min_turns turns can be folded
+        # into the summary while keep_recent turns stay verbatim, otherwise None. At most max_turns
+        # of the oldest unsummarized turns are returned, so long backlogs are folded in several steps.
+        session = await self._get(chat_id)
+        base_sequence = session.summary_sequence
+        if session.turn_count - base_sequence < keep_recent + min_turns:
+            return None
+        upto_sequence = min(session.turn_count - keep_recent, base_sequence + (max_turns or self.max_turns))
+        if base_sequence + 1 >= session.first_cached_sequence:
+            turns = session.turns_after(base_sequence)[:upto_sequence - base_sequence]
+        else:
+            # Older turns than the cache holds (migrated chats, failed updates) are read back from the database
+            await self.flush(chat_id)
+            turns = await self.db.get_turns(chat_id, base_sequence, upto_sequence)
+            if len(turns) != upto_sequence - base_sequence:
+                logger.warning("Turns missing for summary", extra={"chat_id": chat_id, "from": base_sequence + 1, "to": upto_sequence})
+        return session.summary, base_sequence, turns, upto_sequence
+
+    async def set_summary(self, chat_id: str, summary: str, base_sequence: int, summary_sequence: int) -> bool:
+        # Only applies on top of the summary it was computed from
+        session = await self._get(chat_id)
+        if session.summary_sequence != base_sequence:
+            return False
+        session.summary = summary
+        session.summary_sequence = summary_sequence
+        session.dirty_fields.add("summary")
+        return True
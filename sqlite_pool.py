@@ -0,0 +1,99 @@
+import asyncio
+from databases import Database
+from databases.core import Connection
+from config import SQLITE_BUSY_TIMEOUT_MS, SQLITE_MMAP_SIZE, SQLITE_READERS
+
+
+# Persistent SQLite connections tuned for a single-host bot: WAL journal, one writer
+# connection fed by a queue (SQLite allows one writer at a time) and a few readers that
+# run concurrently with it. Without this, databases opens a new connection per query.
+class SQLitePool:
+    def __init__(
+        self,
+        database: Database,
+        readers: int = SQLITE_READERS,
+        mmap_size: int = SQLITE_MMAP_SIZE,
+        busy_timeout_ms: int = SQLITE_BUSY_TIMEOUT_MS,
+    ):
+        self.database = database
+        self.readers = readers
+        self.pragmas = [
+            f"PRAGMA busy_timeout = {int(busy_timeout_ms)}",
+            f"PRAGMA mmap_size = {int(mmap_size)}",
+            "PRAGMA synchronous = NORMAL",
+            "PRAGMA temp_store = MEMORY",
+        ]
+        self._writer = None
+        self._readers = []
+        self._idle_readers = None
+        self._write_queue = None
+        self._writer_task = None
+
+    async def _open_connection(self) -> Connection:
+        connection = Connection(self.database, self.database._backend)
+        await connection.__aenter__()
+        for pragma in self.pragmas:
+            await connection.execute(pragma)
+        return connection
+
+    async def open(self):
+        self._writer = await self._open_connection()
+        # WAL is persistent in the file and lets readers run while a write is in progress
+        await self._writer.execute("PRAGMA journal_mode = WAL")
+        self._idle_readers = asyncio.Queue()
+        for _ in range(self.readers):
+            reader = await self._open_connection()
+            self._readers.append(reader)
+            self._idle_readers.put_nowait(reader)
+        self._write_queue = asyncio.Queue()
+        self._writer_task = asyncio.get_running_loop().create_task(self._write_loop())
+
+    async def close(self):
+        if self._writer_task is not None:
+            self._writer_task.cancel()
+            await asyncio.gather(self._writer_task, return_exceptions=True)
+            self._writer_task = None
+        for connection in self._readers + ([self._writer] if self._writer else []):
+            await connection.__aexit__(None, None, None)
+        self._readers = []
+        self._writer = None
+
+    async def _write_loop(self):
+        while True:
+            queries, future = await self._write_queue.get()
+            if future.cancelled():
+                continue
+            try:
+                if len(queries) == 1:
+                    results = [await self._writer.execute(queries[0])]
+                else:
+                    async with self._writer.transaction():
+                        results = [await self._writer.execute(query) for query in queries]
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            else:
+                if not future.cancelled():
+                    future.set_result(results)
+
+    async def execute_batch(self, queries) -> list:
+        # Queries of one batch are applied atomically, batches one after another
+        future = asyncio.get_running_loop().create_future()
+        await self._write_queue.put((list(queries), future))
+        return await future
+
+    async def execute(self, query):
+        return (await self.execute_batch([query]))[0]
+
+    async def _read(self, method: str, query):
+        reader = await self._idle_readers.get()
+        try:
+            return await getattr(reader, method)(query)
+        finally:
+            self._idle_readers.put_nowait(reader)
+
+    async def fetch_one(self, query):
+        return await self._read("fetch_one", query)
+
+    async def fetch_all(self, query):
+        return await self._read("fetch_all", query)
@@ -0,0 +1,61 @@
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+def _process_age():
+    # Seconds since the process was created (Linux only), so interpreter start-up is counted too
+    try:
+        with open("/proc/self/stat") as f:
+            # Fields after the command name; starttime is field 22 of the whole line
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+# Where the time between process start and the first reply goes: imports, client and
+# database setup. Import this module first so the phases cover everything after it.
+class StartupProfile:
+    def __init__(self):
+        self.started = time.monotonic()
+        # Interpreter start-up and anything imported before this module
+        self.before_profile = _process_age() or 0.0
+        self.phases = {}
+        self.first_update_seen = False
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def elapsed(self) -> float:
+        return self.before_profile + time.monotonic() - self.started
+
+    def report(self) -> dict:
+        return {
+            "interpreter_ms": round(self.before_profile * 1000, 1),
+            "phases_ms": {name: round(seconds * 1000, 1) for name, seconds in self.phases.items()},
+            "elapsed_ms": round(self.elapsed() * 1000, 1),
+        }
+
+    def log_ready(self):
+        logger.info("Startup complete", extra=self.report())
+
+    def first_update(self, handler: str):
+        # Time to first reply after a deploy or wake-up, logged once per process
+        if self.first_update_seen:
+            return
+        self.first_update_seen = True
+        logger.info("First update handled", extra={"handler": handler, **self.report()})
+
+
+STARTUP = StartupProfile()
@@ -0,0 +1,63 @@
+import logging
+import re
+import time
+from telegram import Message
+from telegram.error import BadRequest
+from config import STREAM_EDIT_INTERVAL_SECONDS
+from outbox import Outbox, split_text
+
+logger = logging.getLogger(__name__)
+
+STEP_MARKER_PATTERN = re.compile(r"\[STEP COMPLETED: -?\d+\]")
+STEP_MARKER_PREFIX = "[STEP COMPLETED: "
+
+
+def visible_stream_text(text: str) -> str:
+    # Drop complete step markers and hold back a trailing partial one
+    text = STEP_MARKER_PATTERN.sub("", text)
+    start = text.rfind("[")
+    if start != -1:
+        tail = text[start:]
+        if STEP_MARKER_PREFIX.startswith(tail) or re.fullmatch(r"\[STEP COMPLETED: -?\d*", tail):
+            text = text[:start]
+    return text.strip()
+
+
+class StreamRelay:
+    # Relays a streamed Gemini reply to Telegram as throttled edits of one message;
+    # text beyond Telegram's message limit is sent as further messages at the end
+    def __init__(self, reply_to: Message, outbox: Outbox, edit_interval: float = STREAM_EDIT_INTERVAL_SECONDS):
+        self.reply_to = reply_to
+        self.outbox = outbox
+        self.edit_interval = edit_interval
+        self.message = None
+        self.shown_text = ""
+        self.last_edit = 0.0
+
+    async def _show(self, text: str):
+        text = split_text(text)[0] if text else text
+        if not text or text == self.shown_text:
+            return
+        try:
+            if self.message is None:
+                self.message = await self.outbox.send_text(self.reply_to, text)
+            else:
+                await self.outbox.edit_text(self.message, text)
+        except BadRequest as e:
+            logger.warning("Stream edit error: %s", e)
+            return
+        self.shown_text = text
+        self.last_edit = time.monotonic()
+
+    async def relay(self, chunks) -> str:
+        response = ""
+        async for chunk in chunks:
+            response += chunk
+            if time.monotonic() - self.last_edit >= self.edit_interval:
+                await self._show(visible_stream_text(response))
+
+        final_text = STEP_MARKER_PATTERN.sub("", response).strip() or "No response generated"
+        await self._show(final_text)
+        for overflow in split_text(final_text)[1:]:
+            await self.outbox.send_text(self.reply_to, overflow)
+        return response
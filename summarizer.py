@@ -0,0 +1,97 @@
+import asyncio
+import contextvars
+import logging
+import time
+from config import SUMMARY_ENABLED, SUMMARY_INTERVAL_TURNS, SUMMARY_RECENT_TURNS
+from gemini_client import GeminiError
+from metrics import ERRORS, STAGE_SECONDS
+from prompts import SUMMARY_PROMPT, build_summary_request
+from session_cache import SessionCache
+
+logger = logging.getLogger(__name__)
+
+
+# Folds older turns into each chat's rolling summary in the background, so prompts carry
+# the summary plus the newest turns. At most one update runs per chat at a time.
+class ChatSummarizer:
+    def __init__(
+        self,
+        db: SessionCache,
+        chat_locks,
+        keep_recent: int = SUMMARY_RECENT_TURNS,
+        interval: int = SUMMARY_INTERVAL_TURNS,
+        enabled: bool = SUMMARY_ENABLED,
+    ):
+        self.db = db
+        self.chat_locks = chat_locks
+        self.keep_recent = keep_recent
+        self.interval = max(1, interval)
+        self.enabled = enabled
+        self._tasks = {}
+        self.updates = 0
+        self.conflicts = 0
+
+    def schedule(self, chat_id: str, gemini_client):
+        if not self.enabled or chat_id in self._tasks:
+            return
+        # Started in an empty context so the update span that scheduled it does not get its stages
+        task = contextvars.Context().run(asyncio.get_running_loop().create_task, self._update(chat_id, gemini_client))
+        self._tasks[chat_id] = task
+        task.add_done_callback(lambda t: self._tasks.pop(chat_id, None))
+
+    async def _update(self, chat_id: str, gemini_client):
+        # A long backlog is folded in batches, one summary call each
+        while await self._update_once(chat_id, gemini_client):
+            pass
+
+    async def _update_once(self, chat_id: str, gemini_client) -> bool:
+        # Returns True when the summary moved forward and more turns may be waiting
+        try:
+            async with self.chat_locks.hold(chat_id):
+                if self.chat_locks.distributed:
+                    await self.db.invalidate(chat_id)
+                job = await self.db.get_turns_to_summarize(chat_id, self.keep_recent, self.interval)
+            if job is None:
+                return False
+            summary, base_sequence, turns, summary_sequence = job
+
+            # The chat is not locked while Gemini runs; set_summary drops the result if another update won
+            start = time.perf_counter()
+            try:
+                new_summary = await gemini_client.communicate(build_summary_request(summary, turns), SUMMARY_PROMPT)
+            finally:
+                STAGE_SECONDS.observe(time.perf_counter() - start, stage="summary")
+            new_summary = new_summary.strip()
+            if not new_summary:
+                return False
+
+            async with self.chat_locks.hold(chat_id) as lease:
+                if self.chat_locks.distributed:
+                    await self.db.invalidate(chat_id)
+                applied = await self.db.set_summary(chat_id, new_summary, base_sequence, summary_sequence)
+                if lease.lost:
+                    # Another worker owns the chat now, its state wins
+                    self.db.discard(chat_id)
+                    applied = False
+                elif self.chat_locks.distributed:
+                    await self.db.flush(chat_id)
+            if not applied:
+                self.conflicts += 1
+                return False
+            self.updates += 1
+            logger.info("Summary updated", extra={"chat_id": chat_id, "summary_sequence": summary_sequence, "turns": len(turns)})
+            return True
+        except GeminiError as e:
+            # The turns stay unsummarized and are retried after the next message
+            ERRORS.inc(where="summary", type=type(e).__name__)
+            logger.warning("Summary update failed", extra={"chat_id": chat_id, "error": str(e)})
+        except Exception as e:
+            ERRORS.inc(where="summary", type=type(e).__name__)
+            logger.error("Summary update error", exc_info=True, extra={"chat_id": chat_id})
+        return False
+
+    async def close(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,23 @@
+import os
+import sys
+import pytest
+
+# Modules live at the project root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import ChatHistoryDB
+
+
+@pytest.fixture
+def database_url(tmp_path):
+    return f"sqlite:///{tmp_path / 'test.db'}"
+
+
+@pytest.fixture
+def make_db(database_url):
+    # Returns a coroutine function opening a connected ChatHistoryDB on a fresh SQLite file
+    async def make():
+        db = ChatHistoryDB(database_url)
+        await db.connect()
+        return db
+    return make
@@ -0,0 +1,93 @@
+import asyncio
+import time
+from chat_lock import DatabaseChatLocks, LocalChatLocks
+from metrics import ERRORS
+
+
+async def hold_and_record(locks, chat_id, name, events, delay=0.01):
+    async with locks.hold(chat_id):
+        events.append(f"{name} start")
+        await asyncio.sleep(delay)
+        events.append(f"{name} end")
+
+
+def test_local_locks_serialize_a_chat_in_arrival_order():
+    async def run():
+        locks = LocalChatLocks()
+        events = []
+        await asyncio.gather(*(hold_and_record(locks, "1", name, events) for name in "abc"))
+        assert events == ["a start", "a end", "b start", "b end", "c start", "c end"]
+        # Nothing is kept for idle chats
+        assert not locks._locks and not locks._waiters
+
+    asyncio.run(run())
+
+
+def test_local_locks_do_not_block_other_chats():
+    async def run():
+        locks = LocalChatLocks()
+        events = []
+        await asyncio.gather(hold_and_record(locks, "1", "a", events), hold_and_record(locks, "2", "b", events))
+        assert events[:2] == ["a start", "b start"]
+
+    asyncio.run(run())
+
+
+def test_database_locks_exclude_other_workers(make_db):
+    async def run():
+        db = await make_db()
+        try:
+            # Two workers sharing the database
+            first = DatabaseChatLocks(db, lease_seconds=5, poll_interval=0.01)
+            second = DatabaseChatLocks(db, lease_seconds=5, poll_interval=0.01)
+            events = []
+            await asyncio.gather(
+                hold_and_record(first, "1", "a", events, delay=0.1),
+                hold_and_record(second, "1", "b", events),
+                hold_and_record(first, "2", "c", events),
+            )
+            assert events.index("b start") > events.index("a end")
+            assert events.index("c start") < events.index("a end")
+            # Leases are released on exit
+            assert await db.try_acquire_chat_lease("1", "other", 0, 5)
+        finally:
+            await db.disconnect()
+
+    asyncio.run(run())
+
+
+def test_database_locks_take_over_an_expired_lease(make_db):
+    async def run():
+        db = await make_db()
+        try:
+            # A crashed worker left a lease that has already run out
+            assert await db.try_acquire_chat_lease("1", "crashed", 0, 1)
+            locks = DatabaseChatLocks(db, lease_seconds=5, poll_interval=0.01)
+            async with asyncio.timeout(2):
+                async with locks.hold("1"):
+                    assert not await db.try_acquire_chat_lease("1", "other", time.time(), 5)
+        finally:
+            await db.disconnect()
+
+    asyncio.run(run())
+
+
+def test_database_locks_report_a_lost_lease(make_db):
+    async def run():
+        db = await make_db()
+        try:
+            locks = DatabaseChatLocks(db, lease_seconds=0.3, poll_interval=0.01)
+            errors = ERRORS.value(where="chat_lock", type="LeaseLost")
+            async with locks.hold("1") as lease:
+                assert not lease.lost
+                # Another worker takes the chat as if the lease had expired
+                assert await db.try_acquire_chat_lease("1", "other", time.time() + 10, 5)
+                await asyncio.sleep(0.25)
+                assert lease.lost
+            assert ERRORS.value(where="chat_lock", type="LeaseLost") == errors + 1
+            # Releasing does not remove the other worker's lease
+            assert not await db.try_acquire_chat_lease("1", "third", time.time(), 5)
+        finally:
+            await db.disconnect()
+
+    asyncio.run(run())
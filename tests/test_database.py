@@ -0,0 +1,52 @@
+import asyncio
+import sqlite3
+from sqlalchemy import select
+
+
+def create_legacy_database(path):
+    # Schema and rows as written by the single-blob version of ChatHistoryDB
+    connection = sqlite3.connect(path)
+    connection.execute(
+        "CREATE TABLE chat_histories (id INTEGER PRIMARY KEY, chat_id VARCHAR UNIQUE, chat_history TEXT,"
+        " step_passed INTEGER, passport_data JSON, vehicle_data JSON)"
+    )
+    history = "User: hi\nI have two cars\nBot: Hello!\nPlease send your passport.\nUser: what is the price?\nBot: 100 USD\n"
+    connection.execute(
+        "INSERT INTO chat_histories (chat_id, chat_history, step_passed, passport_data, vehicle_data) VALUES (?, ?, ?, ?, ?)",
+        ("1", history, 3, '{"full_text": "passport"}', "{}"),
+    )
+    connection.commit()
+    connection.close()
+
+
+def test_legacy_history_blob_is_migrated_to_turns(tmp_path, make_db):
+    create_legacy_database(tmp_path / "test.db")
+
+    async def run():
+        db = await make_db()
+        try:
+            session = await db.load_session("1")
+            assert session["turns"] == [
+                ("hi\nI have two cars", "Hello!\nPlease send your passport."),
+                ("what is the price?", "100 USD"),
+            ]
+            assert session["turn_count"] == 2
+            assert session["step_passed"] == 3
+            assert session["passport_data"] == {"full_text": "passport"}
+            assert session["summary"] == "" and session["policy"] == {}
+            # The blob is emptied and new turns continue the sequence
+            row = await db._fetch_one(select(db.chat_histories.c.chat_history).where(db.chat_histories.c.chat_id == "1"))
+            assert row["chat_history"] == ""
+            await db.add_message("1", "yes", "ok")
+            assert (await db.load_session("1"))["turn_count"] == 3
+        finally:
+            await db.disconnect()
+
+        # Migrations run once
+        db = await make_db()
+        try:
+            assert len((await db.load_session("1"))["turns"]) == 3
+        finally:
+            await db.disconnect()
+
+    asyncio.run(run())
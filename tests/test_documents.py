@@ -0,0 +1,71 @@
+from types import SimpleNamespace
+from documents import document_fields, fields_from_text
+from mindee_api import MindeeClient
+
+LICENCE_TEXT = ":First Name: JOHN\n:Last Name: DOE\n:Date of Birth: 1957-02-01\n:ID: D1234567\n"
+VIN = "1HGCM82633A004352"
+
+
+def test_years_in_unlabeled_text_are_not_taken_as_the_vehicle_year():
+    assert fields_from_text(LICENCE_TEXT, "vehicle") == {}
+    assert document_fields({"full_text": LICENCE_TEXT}, "vehicle") == {}
+    assert fields_from_text(LICENCE_TEXT, "vehicle", patterns=("vin", "year")) == {"year": "1957"}
+
+
+class FakeField:
+    def __init__(self, value, confidence=0.9):
+        self.value = value
+        self.confidence = confidence
+
+
+class FakeDocument:
+    def __init__(self, text, prediction=None, full_text=None):
+        self.text = text
+        self.inference = SimpleNamespace(prediction=prediction or SimpleNamespace())
+        self.extras = SimpleNamespace(full_text_ocr=full_text)
+
+    def __str__(self):
+        return self.text
+
+
+class FakeMindeeSDK:
+    # CarteGrise fails, the licence product reads the holder, the generic OCR reads a VIN
+    def __init__(self):
+        self.calls = []
+
+    def source_from_bytes(self, data, filename):
+        return data
+
+    def parse(self, product_class, input_doc):
+        self.calls.append(product_class)
+        raise RuntimeError("unsupported document")
+
+    def enqueue_and_parse(self, product_class, input_doc, full_text=False):
+        self.calls.append((product_class, full_text))
+        if full_text:
+            return SimpleNamespace(document=FakeDocument("", full_text=f"CERTIFICATE 1957\n{VIN}\n"))
+        prediction = SimpleNamespace(first_name=FakeField("JOHN"), last_name=FakeField("DOE"), date_of_birth=FakeField("1957-02-01"))
+        return SimpleNamespace(document=FakeDocument(LICENCE_TEXT, prediction))
+
+
+def make_client(products):
+    client = MindeeClient.__new__(MindeeClient)
+    client.client = FakeMindeeSDK()
+    client.products = SimpleNamespace(
+        fr=SimpleNamespace(CarteGriseV1="CarteGriseV1"), DriverLicenseV1="DriverLicenseV1", InternationalIdV2="InternationalIdV2"
+    )
+    client.PRODUCTS = {"vehicle": products}
+    return client
+
+
+def test_vehicle_results_without_vehicle_fields_are_skipped():
+    client = make_client(["fr.CarteGriseV1", "DriverLicenseV1", "FullTextOCR"])
+    result = client.parse(b"image", "vehicle")
+    assert result["product"] == "FullTextOCR"
+    assert result["fields"] == {"vin": VIN}
+    assert client.client.calls[-1] == ("InternationalIdV2", True)
+
+
+def test_a_licence_is_never_read_as_a_vehicle_document():
+    client = make_client(["DriverLicenseV1"])
+    assert client.parse(b"image", "vehicle") == {}
@@ -0,0 +1,23 @@
+import asyncio
+import pytest
+from benchmarks.fake_gemini_server import FakeGeminiServer, start_server
+from benchmarks.fakes import LatencyDistribution
+from gemini_client import GeminiClient
+
+
+@pytest.mark.parametrize("failing_model", ["models/primary", "primary"])
+def test_failing_model_is_matched_with_or_without_prefix(failing_model):
+    async def run():
+        server = FakeGeminiServer(LatencyDistribution(0), failing_models=[failing_model])
+        runner = await start_server(server, 0)
+        port = runner.addresses[0][1]
+        client = GeminiClient(base_url=f"http://127.0.0.1:{port}/v1beta", model="models/primary", fallback_models=["models/backup"])
+        try:
+            assert await client.communicate("hello")
+            assert server.requests["models/primary"] >= 1
+            assert server.requests["models/backup"] == 1
+        finally:
+            await client.close()
+            await runner.cleanup()
+
+    asyncio.run(run())
@@ -0,0 +1,131 @@
+import asyncio
+import time
+from aiohttp import web
+import gemini_client
+from benchmarks.fake_gemini_server import FakeGeminiServer
+from benchmarks.fakes import LatencyDistribution
+from gemini_client import GeminiBadRequest, GeminiClient, GeminiServerError
+
+SYSTEM_INSTRUCTION = "You are a helpful insurance assistant."
+
+
+def with_cache_endpoint(cached_contents, scenario, timeout: float = 5):
+    # Runs scenario(client, server) against the fake server with a custom cachedContents handler
+    async def run():
+        server = FakeGeminiServer(LatencyDistribution(0))
+        app = web.Application()
+        app.router.add_post("/v1beta/models/{method}", server.generate)
+        app.router.add_post("/v1beta/cachedContents", cached_contents)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        client = GeminiClient(base_url=f"http://127.0.0.1:{port}/v1beta", timeout=timeout, fallback_models=[])
+        client.context_cache = True
+        try:
+            await scenario(client)
+        finally:
+            await client.close()
+            await runner.cleanup()
+
+    asyncio.run(run())
+
+
+def test_a_hanging_cache_endpoint_does_not_hold_up_calls():
+    calls = []
+
+    async def cached_contents(request):
+        calls.append(request)
+        await asyncio.sleep(30)
+
+    async def scenario(client):
+        start = time.monotonic()
+        replies = await asyncio.gather(*(client.communicate("hello", SYSTEM_INSTRUCTION) for _ in range(3)))
+        assert all(replies)
+        # Creation gets half of the 2s deadline, the other calls send the instruction inline
+        assert time.monotonic() - start < 1.8
+        await client.communicate("hello", SYSTEM_INSTRUCTION)
+        assert len(calls) == 1
+
+    with_cache_endpoint(cached_contents, scenario, timeout=2)
+
+
+def test_transient_cache_failures_are_retried_later(monkeypatch):
+    monkeypatch.setattr(gemini_client, "CONTEXT_CACHE_RETRY_SECONDS", 0)
+    statuses = [503, 200]
+
+    async def cached_contents(request):
+        status = statuses.pop(0)
+        if status != 200:
+            return web.json_response({"error": {"message": "Unavailable"}}, status=status)
+        return web.json_response({"name": "cachedContents/abc"})
+
+    async def scenario(client):
+        assert await client._cached_content(SYSTEM_INSTRUCTION, 5) is None
+        assert await client._cached_content(SYSTEM_INSTRUCTION, 5) == "cachedContents/abc"
+        payload = await client._payload("hello", SYSTEM_INSTRUCTION, remaining=5)
+        assert payload["cachedContent"] == "cachedContents/abc" and "systemInstruction" not in payload
+
+    with_cache_endpoint(cached_contents, scenario)
+
+
+def test_refused_cache_is_not_retried(monkeypatch):
+    monkeypatch.setattr(gemini_client, "CONTEXT_CACHE_RETRY_SECONDS", 0)
+    calls = []
+
+    async def cached_contents(request):
+        calls.append(request)
+        return web.json_response({"error": {"message": "Cached content is too small"}}, status=400)
+
+    async def scenario(client):
+        assert await client._cached_content(SYSTEM_INSTRUCTION, 5) is None
+        assert await client._cached_content(SYSTEM_INSTRUCTION, 5) is None
+        assert len(calls) == 1
+
+    with_cache_endpoint(cached_contents, scenario)
+
+
+def with_request(outcomes, scenario):
+    # Runs scenario(client, request) where request(model, payload, remaining) plays back outcomes in order
+    async def run():
+        client = GeminiClient(model="primary", fallback_models=["fallback"], timeout=5)
+        client.context_cache = False
+        client.backoff_base = 0
+        calls = []
+
+        async def request(model, payload, remaining):
+            calls.append(model)
+            outcome = outcomes.pop(0)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+
+        try:
+            await scenario(client, request, calls)
+        finally:
+            await client.close()
+
+    asyncio.run(run())
+
+
+def test_retryable_errors_are_retried_on_the_same_model():
+    outcomes = [GeminiServerError("503", status=503), GeminiServerError("503", status=503), "reply"]
+
+    async def scenario(client, request, calls):
+        client.max_retries = 2
+        assert await client._call("hello", SYSTEM_INSTRUCTION, request) == "reply"
+        assert calls == ["primary", "primary", "primary"]
+        assert client.breakers["primary"].state == "closed"
+
+    with_request(outcomes, scenario)
+
+
+def test_a_bad_request_moves_on_to_the_fallback_model():
+    outcomes = [GeminiBadRequest("400", status=400), "reply"]
+
+    async def scenario(client, request, calls):
+        assert await client._call("hello", SYSTEM_INSTRUCTION, request) == "reply"
+        assert calls == ["primary", "fallback"]
+
+    with_request(outcomes, scenario)
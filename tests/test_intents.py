@@ -0,0 +1,41 @@
+import pytest
+from intents import IntentClassifier
+
+
+def intent(step, text):
+    match = IntentClassifier().classify(step, text)
+    return match.intent if match else None
+
+
+@pytest.mark.parametrize("text", ["How much does it cost?", "what is the price", "What's the premium?"])
+def test_plain_price_questions_take_the_fast_path(text):
+    assert intent(4, text) == "price_question"
+    assert intent(5, text) == "price_question"
+
+
+@pytest.mark.parametrize("step,text", [
+    (4, "the price is too high, the name is wrong"),
+    (4, "What is the price? Also my birth date is wrong"),
+    (4, "how much does it cost and when do I get the policy?"),
+    (5, "isn't the price too high?"),
+    (5, "the cost seems expensive"),
+])
+def test_price_mentions_with_other_content_go_to_the_llm(step, text):
+    assert intent(step, text) is None
+
+
+def test_price_question_while_a_photo_is_expected_keeps_the_follow_up():
+    match = IntentClassifier().classify(1, "What is the price?")
+    assert match.intent == "price_question"
+    assert match.reply.endswith("Please send me a photo of your passport.")
+
+
+@pytest.mark.parametrize("step,text,expected", [
+    (4, "yes", "confirm_data"),
+    (5, "I agree", "accept_price"),
+    (6, "yes", None),
+    (1, "hello there", "photo_required"),
+    (1, "what documents do you need?", None),
+])
+def test_scenario_rules(step, text, expected):
+    assert intent(step, text) == expected
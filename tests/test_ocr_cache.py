@@ -0,0 +1,36 @@
+import asyncio
+from sqlalchemy import select
+from metrics import OCR_CACHE_LOOKUPS
+from ocr_cache import OCRCache
+
+
+def test_a_photo_is_counted_once_whatever_keys_were_tried():
+    async def run():
+        cache = OCRCache()
+        misses = OCR_CACHE_LOOKUPS.value(result="miss")
+        # The bot tries the file key, then the content key
+        assert await cache.get(cache.file_key("f1", "passport")) is None
+        assert await cache.get(cache.content_key(b"image", "passport")) is None
+        cache.record_lookup(False)
+        assert (cache.hits, cache.misses) == (0, 1)
+        assert OCR_CACHE_LOOKUPS.value(result="miss") == misses + 1
+
+    asyncio.run(run())
+
+
+def test_persisted_results_are_bounded(make_db):
+    async def run():
+        db = await make_db()
+        try:
+            cache = OCRCache(db, max_entries=2, max_db_entries=5)
+            for n in range(12):
+                await cache.put([cache.file_key(f"f{n}", "passport")], "passport", {"n": n})
+            await cache.purge_expired()
+            rows = await db._fetch_all(select(db.ocr_results.c.result))
+            assert sorted(row["result"]["n"] for row in rows) == [7, 8, 9, 10, 11]
+            # The newest entries are still served from the table after a restart
+            assert await OCRCache(db).get(cache.file_key("f11", "passport")) == {"n": 11}
+        finally:
+            await db.disconnect()
+
+    asyncio.run(run())
@@ -0,0 +1,124 @@
+import asyncio
+import threading
+import pytest
+from benchmarks.fakes import FakeBot, FakeContext, FakeMessage, FakePhotoSize, FakeTelegramAPI, FakeUpdate, LatencyDistribution
+from InsuranceBot import InsuranceBot
+from metrics import OCR_QUEUE_DEPTH, OCR_RUNNING, REGISTRY
+from ocr_scheduler import OCRJobCancelled, OCRScheduler
+
+
+def test_cancel_fails_a_queued_job():
+    async def run():
+        scheduler = OCRScheduler(workers=1, max_queue=5)
+        release = threading.Event()
+        try:
+            running = asyncio.create_task(scheduler.submit("1", lambda: release.wait(5) and "first"))
+            queued = asyncio.create_task(scheduler.submit("2", lambda: "second"))
+            await asyncio.sleep(0.05)
+            assert scheduler.stats()["queue_depth"] == 1
+
+            assert scheduler.cancel("2")
+            with pytest.raises(OCRJobCancelled):
+                await queued
+            assert scheduler.stats()["queue_depth"] == 0
+            assert not scheduler.cancel("2")
+
+            release.set()
+            assert await running == "first"
+        finally:
+            release.set()
+            await scheduler.close()
+
+    asyncio.run(run())
+
+
+class BlockingMindee:
+    # The first call waits until released, like a slow Mindee job
+    def __init__(self):
+        self.release = threading.Event()
+        self.calls = 0
+
+    def parse(self, data: bytes, doc_type: str, filename: str = "document.jpg") -> dict:
+        self.calls += 1
+        if self.calls == 1:
+            self.release.wait(5)
+        return {"document_type": doc_type, "fields": {"name": f"call {self.calls}"}}
+
+
+def send_two_photos(make_db, media_group_id=None):
+    # Sends a second photo while the first one's OCR job holds the chat; returns what was stored
+    async def run():
+        db = await make_db()
+        bot = InsuranceBot(db)
+        mindee = bot.mindee_client = BlockingMindee()
+        api = FakeTelegramAPI(LatencyDistribution(0))
+        context = FakeContext(FakeBot(api))
+        try:
+            await bot.db.set_step_passed("1", 1)
+
+            def photo(message_id):
+                message = FakeMessage(
+                    api, 1, photo=[FakePhotoSize(f"photo{message_id}")], message_id=message_id, media_group_id=media_group_id
+                )
+                return FakeUpdate(message)
+
+            first = asyncio.create_task(bot.handle_photo(photo(10), context))
+            while mindee.calls == 0:
+                await asyncio.sleep(0.01)
+            second = asyncio.create_task(bot.handle_photo(photo(11), context))
+            await asyncio.sleep(0.05)
+            mindee.release.set()
+            async with asyncio.timeout(2):
+                await asyncio.gather(first, second)
+
+            assert not bot._latest_photos
+            return {
+                "cancelled": bot.ocr_scheduler.cancelled,
+                "calls": mindee.calls,
+                "passport": await bot.db.get_document_data("1", "passport"),
+                "vehicle": await bot.db.get_document_data("1", "vehicle"),
+            }
+        finally:
+            mindee.release.set()
+            await bot.close()
+            await db.disconnect()
+
+    return asyncio.run(run())
+
+
+def test_resent_photo_cancels_the_job_holding_the_chat(make_db):
+    # A second passport photo replaces the first, whose job is cancelled before it gets the lock back
+    result = send_two_photos(make_db)
+    assert result["cancelled"] == 1
+    assert result["calls"] == 2
+    assert result["passport"]["fields"]["name"] == "call 2"
+    assert result["vehicle"] == {}
+
+
+def test_album_photos_are_all_processed(make_db):
+    # Passport and vehicle document sent together: the first is read as the passport, the second as the vehicle
+    result = send_two_photos(make_db, media_group_id="album")
+    assert result["cancelled"] == 0
+    assert result["calls"] == 2
+    assert result["passport"]["fields"]["name"] == "call 1"
+    assert result["vehicle"]["document_type"] == "vehicle"
+
+
+def test_queue_depth_and_running_jobs_are_exported():
+    async def run():
+        scheduler = OCRScheduler(workers=1, max_queue=5)
+        release = threading.Event()
+        try:
+            jobs = [asyncio.create_task(scheduler.submit(str(n), lambda: release.wait(5))) for n in range(3)]
+            await asyncio.sleep(0.05)
+            rendered = REGISTRY.render()
+            assert "bot_ocr_queue_depth 2" in rendered
+            assert "bot_ocr_running_jobs 1" in rendered
+            release.set()
+            await asyncio.gather(*jobs)
+            assert OCR_QUEUE_DEPTH.value() == 0 and OCR_RUNNING.value() == 0
+        finally:
+            release.set()
+            await scheduler.close()
+
+    asyncio.run(run())
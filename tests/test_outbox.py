@@ -0,0 +1,113 @@
+import asyncio
+import pytest
+from telegram.error import RetryAfter
+from outbox import Outbox, coalesce_texts, split_text
+
+
+def fast_outbox(**kwargs):
+    # Buckets large enough that no test waits on them
+    return Outbox(global_rate=1000, chat_rate=1000, chat_burst=1000, **kwargs)
+
+
+class RecordingMessage:
+    def __init__(self, chat_id: int = 1, message_id: int = 1):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.replies = []
+        self.edits = []
+        self.edit_gate = None
+        self.editing = asyncio.Event()
+
+    async def reply_text(self, text: str, **kwargs):
+        self.replies.append(text)
+        return RecordingMessage(self.chat_id, len(self.replies) + 1)
+
+    async def edit_text(self, text: str, **kwargs):
+        self.editing.set()
+        if self.edit_gate is not None:
+            await self.edit_gate.wait()
+        self.edits.append(text)
+        return self
+
+
+def test_split_text_breaks_at_the_last_fitting_boundary():
+    assert split_text("first paragraph\n\nsecond paragraph", limit=20) == ["first paragraph", "second paragraph"]
+    assert split_text("one two three", limit=9) == ["one two", "three"]
+    # No break fits: hard cut at the limit
+    assert split_text("x" * 25, limit=10) == ["x" * 10, "x" * 10, "x" * 5]
+    assert split_text("exactly10!", limit=10) == ["exactly10!"]
+    assert all(len(chunk) <= 50 for chunk in split_text("word " * 100, limit=50))
+
+
+def test_coalesce_texts_keeps_order_and_respects_the_limit():
+    assert coalesce_texts(["a", "b", "c"]) == ["a\n\nb\n\nc"]
+    assert coalesce_texts(["aaaa", "bbbb", "cc"], limit=10) == ["aaaa\n\nbbbb", "cc"]
+    assert coalesce_texts(["a", "b" * 12, "c"], limit=10) == ["a", "b" * 10, "bb\n\nc"]
+
+
+def test_flush_sends_queued_replies_together():
+    async def run():
+        outbox = fast_outbox()
+        message = RecordingMessage()
+        for text in ("one", "two", "three"):
+            outbox.queue_text(message, text)
+        await outbox.flush(message.chat_id)
+        assert message.replies == ["one\n\ntwo\n\nthree"]
+        assert outbox.coalesced == 2
+        # send_text goes out after anything still queued
+        outbox.queue_text(message, "queued")
+        await outbox.send_text(message, "direct")
+        assert message.replies[1:] == ["queued", "direct"]
+
+    asyncio.run(run())
+
+
+def test_retry_after_is_waited_out_and_retried():
+    async def run():
+        outbox = fast_outbox(max_retries=2)
+        calls = []
+
+        async def method(text):
+            calls.append(text)
+            if len(calls) == 1:
+                raise RetryAfter(0)
+            return "sent"
+
+        assert await outbox.call(1, method, "hello") == "sent"
+        assert calls == ["hello", "hello"]
+        assert (outbox.retries, outbox.sent) == (1, 1)
+
+    asyncio.run(run())
+
+
+def test_retry_after_gives_up_after_max_retries():
+    async def run():
+        outbox = fast_outbox(max_retries=1)
+
+        async def method():
+            raise RetryAfter(0)
+
+        with pytest.raises(RetryAfter):
+            await outbox.call(1, method)
+        assert outbox.retries == 1
+
+    asyncio.run(run())
+
+
+def test_edits_in_progress_are_merged_into_the_newest_text():
+    async def run():
+        outbox = fast_outbox()
+        message = RecordingMessage()
+        message.edit_gate = asyncio.Event()
+        first = asyncio.create_task(outbox.edit_text(message, "1"))
+        await message.editing.wait()
+        # Arrive while "1" is being sent; only the newest one follows it
+        assert await outbox.edit_text(message, "2") is None
+        assert await outbox.edit_text(message, "3") is None
+        message.edit_gate.set()
+        assert await first is message
+        assert message.edits == ["1", "3"]
+        assert outbox.coalesced == 2
+        assert not outbox._edits
+
+    asyncio.run(run())
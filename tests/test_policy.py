@@ -0,0 +1,74 @@
+import asyncio
+from datetime import date
+from benchmarks.fakes import FakeBot, FakeContext, FakeMessage, FakeTelegramAPI, FakeUpdate, LatencyDistribution
+from InsuranceBot import InsuranceBot
+from policy import new_policy, render_policy
+
+PASSPORT = {"fields": {"name": "TEST USER", "document_id": "AB123456"}}
+VEHICLE = {"fields": {"make_model": "Test Car", "vin": "1HGCM82633A004352", "year": "2020"}}
+
+
+def test_policy_numbers_do_not_repeat_for_the_same_day():
+    numbers = {new_policy(date(2026, 1, 1))["number"] for _ in range(100)}
+    assert len(numbers) == 100
+
+
+def test_render_uses_the_stored_number_and_date():
+    policy = {"number": "POL-2025-ABC", "issue_date": "2025-03-04"}
+    text = render_policy(policy, PASSPORT, VEHICLE)
+    assert "Policy Number: POL-2025-ABC" in text
+    assert "Issue Date: 2025-03-04" in text
+    assert "Full Name: TEST USER" in text
+
+
+def run_chat(make_db, scenario):
+    async def run():
+        db = await make_db()
+        bot = InsuranceBot(db)
+        api = FakeTelegramAPI(LatencyDistribution(0))
+        context = FakeContext(FakeBot(api))
+
+        async def send(text):
+            await bot.handle_text(FakeUpdate(FakeMessage(api, 1, text=text)), context)
+
+        async def issued():
+            turns = await bot.db.get_recent_turns("1", max_length=100_000)
+            return [response for user_message, response in turns if user_message == "SYSTEM:**Policy issued**"]
+
+        try:
+            await scenario(bot, send, issued)
+        finally:
+            await bot.close()
+            await db.disconnect()
+
+    asyncio.run(run())
+
+
+def test_policy_is_issued_once_when_the_price_is_accepted(make_db):
+    async def scenario(bot, send, issued):
+        await bot.db.set_document_data("1", "passport", PASSPORT)
+        await bot.db.set_document_data("1", "vehicle", VEHICLE)
+        await bot.db.set_step_passed("1", 5)
+        await send("yes")
+        policy = await bot.db.get_policy("1")
+        assert policy["number"].startswith("POL-")
+        assert [f"Policy Number: {policy['number']}" in text for text in await issued()] == [True]
+
+        # Step 6 is final, agreeing again does not issue another policy
+        await send("yes")
+        assert len(await issued()) == 1
+        assert await bot.db.get_policy("1") == policy
+
+    run_chat(make_db, scenario)
+
+
+def test_policy_is_not_issued_without_both_documents(make_db):
+    async def scenario(bot, send, issued):
+        await bot.db.set_document_data("1", "passport", PASSPORT)
+        await bot.db.set_step_passed("1", 5)
+        await send("yes")
+        assert await issued() == []
+        assert await bot.db.get_policy("1") == {}
+        assert await bot.db.get_step_passed("1") == 3
+
+    run_chat(make_db, scenario)
@@ -0,0 +1,132 @@
+import asyncio
+from metrics import SESSION_CACHE_LOOKUPS
+from session_cache import SessionCache
+
+
+def turn(n):
+    return (f"question {n}", f"answer {n}")
+
+
+def test_summary_sequence_covers_turns_older_than_the_cache(make_db):
+    async def run():
+        db = await make_db()
+        try:
+            # 30 stored turns and no summary yet, e.g. a migrated chat; the cache only holds 20
+            await db.set_step_passed("1", 1)
+            for n in range(1, 31):
+                await db.add_message("1", *turn(n))
+            cache = SessionCache(db, max_turns=20)
+
+            summary, base, turns, upto = await cache.get_turns_to_summarize("1", keep_recent=4, min_turns=6)
+            assert base == 0
+            assert turns == [turn(n) for n in range(1, 21)]
+            assert upto == 20
+            assert await cache.set_summary("1", "first", base, upto)
+
+            # The prompt gets every turn the summary does not cover, exactly once
+            summary, prompt_turns = await cache.get_prompt_context("1")
+            assert summary == "first"
+            assert prompt_turns == [turn(n) for n in range(21, 31)]
+
+            summary, base, turns, upto = await cache.get_turns_to_summarize("1", keep_recent=4, min_turns=6)
+            assert (base, upto) == (20, 26)
+            assert turns == [turn(n) for n in range(21, 27)]
+            assert await cache.set_summary("1", "second", base, upto)
+
+            assert await cache.get_turns_to_summarize("1", keep_recent=4, min_turns=6) is None
+            assert (await cache.get_prompt_context("1"))[1] == [turn(n) for n in range(27, 31)]
+            await cache.close()
+
+            state = await db.load_session("1")
+            assert (state["summary"], state["summary_sequence"]) == ("second", 26)
+        finally:
+            await db.disconnect()
+
+    asyncio.run(run())
+
+
+def test_summary_is_not_applied_over_a_newer_one(make_db):
+    async def run():
+        db = await make_db()
+        try:
+            cache = SessionCache(db)
+            for n in range(1, 11):
+                await cache.add_message("1", *turn(n))
+            _, base, _, upto = await cache.get_turns_to_summarize("1", keep_recent=4, min_turns=6)
+            assert (base, upto) == (0, 6)
+            assert await cache.set_summary("1", "winner", base, upto)
+            assert not await cache.set_summary("1", "stale", base, upto)
+            assert (await cache.get_prompt_context("1"))[0] == "winner"
+            await cache.close()
+        finally:
+            await db.disconnect()
+
+    asyncio.run(run())
+
+
+def test_lookups_are_exported(make_db):
+    async def run():
+        db = await make_db()
+        try:
+            cache = SessionCache(db)
+            hits, misses = SESSION_CACHE_LOOKUPS.value(result="hit"), SESSION_CACHE_LOOKUPS.value(result="miss")
+            await cache.get_step_passed("1")
+            await cache.get_step_passed("1")
+            assert SESSION_CACHE_LOOKUPS.value(result="miss") == misses + 1
+            assert SESSION_CACHE_LOOKUPS.value(result="hit") == hits + 1
+            await cache.close()
+        finally:
+            await db.disconnect()
+
+    asyncio.run(run())
+
+
+def test_session_evicted_during_a_flush_is_not_reloaded_stale(make_db):
+    async def run():
+        db = await make_db()
+        execute_batch = db.execute_batch
+
+        async def slow_execute_batch(queries):
+            await asyncio.sleep(0.05)
+            await execute_batch(queries)
+
+        db.execute_batch = slow_execute_batch
+        try:
+            cache = SessionCache(db, max_sessions=1)
+            await cache.set_step_passed("A", 4)
+            await cache.add_message("A", *turn(1))
+            flush = asyncio.create_task(cache.flush())
+            await asyncio.sleep(0)
+            # B evicts A while A's batch is still in flight
+            await cache.get_step_passed("B")
+            assert await cache.get_step_passed("A") == 4
+            assert await cache.get_recent_turns("A") == [turn(1)]
+            await flush
+            await cache.flush()
+            await cache.close()
+
+            reloaded = SessionCache(db)
+            assert await reloaded.get_step_passed("A") == 4
+            assert await reloaded.get_recent_turns("A") == [turn(1)]
+            await reloaded.close()
+        finally:
+            await db.disconnect()
+
+    asyncio.run(run())
+
+
+def test_discard_drops_unwritten_changes(make_db):
+    async def run():
+        db = await make_db()
+        try:
+            await db.set_step_passed("1", 3)
+            cache = SessionCache(db)
+            await cache.set_step_passed("1", 4)
+            cache.discard("1")
+            await cache.flush()
+            assert await cache.get_step_passed("1") == 3
+            await cache.close()
+        finally:
+            await db.disconnect()
+
+    asyncio.run(run())
@@ -0,0 +1,42 @@
+import asyncio
+from benchmarks.fakes import FakeMessage, FakeTelegramAPI, LatencyDistribution
+from outbox import Outbox
+from streaming import StreamRelay, visible_stream_text
+
+
+def test_visible_stream_text_hides_complete_and_partial_markers():
+    assert visible_stream_text("Thanks! [STEP COMPLETED: 2]") == "Thanks!"
+    assert visible_stream_text("Thanks! [STEP COMPLETED: -1] Next") == "Thanks!  Next"
+    for partial in ("[", "[STE", "[STEP COMPLETED:", "[STEP COMPLETED: ", "[STEP COMPLETED: -", "[STEP COMPLETED: 1"):
+        assert visible_stream_text("Thanks! " + partial) == "Thanks!"
+    # Brackets that cannot become a marker stay visible
+    assert visible_stream_text("Price [USD]") == "Price [USD]"
+    assert visible_stream_text("Note [x") == "Note [x"
+
+
+def test_relay_never_shows_marker_fragments():
+    async def run():
+        api = FakeTelegramAPI(LatencyDistribution(0))
+        outbox = Outbox(global_rate=1000, chat_rate=1000, chat_burst=1000)
+        shown = []
+
+        class RecordingMessage(FakeMessage):
+            async def reply_text(self, text, **kwargs):
+                shown.append(text)
+                return RecordingMessage(self.api, self.chat_id, text, message_id=await self.api.call())
+
+            async def edit_text(self, text, **kwargs):
+                shown.append(text)
+                return await super().edit_text(text, **kwargs)
+
+        async def chunks():
+            for chunk in ("Your policy is ready", ". [STEP", " COMPLETED", ": 1", "2] Anything", " else?"):
+                yield chunk
+
+        relay = StreamRelay(RecordingMessage(api, 1), outbox, edit_interval=0)
+        response = await relay.relay(chunks())
+        assert response == "Your policy is ready. [STEP COMPLETED: 12] Anything else?"
+        assert shown[-1] == "Your policy is ready.  Anything else?"
+        assert all("[" not in text and "STEP" not in text for text in shown)
+
+    asyncio.run(run())
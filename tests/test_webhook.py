@@ -0,0 +1,35 @@
+import asyncio
+import aiohttp
+from aiohttp import web
+from webhook import WebhookServer
+
+
+class FakeApplication:
+    bot = None
+
+
+def request_metrics(metrics_token, headers=None):
+    async def run():
+        server = WebhookServer(FakeApplication(), path="telegram", secret="secret", metrics_token=metrics_token)
+        runner = web.AppRunner(server.app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", 0).start()
+        port = runner.addresses[0][1]
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(f"http://127.0.0.1:{port}/metrics", headers=headers or {}) as response:
+                    return response.status
+        finally:
+            await runner.cleanup()
+
+    return asyncio.run(run())
+
+
+def test_metrics_are_not_public_by_default():
+    assert request_metrics(None) == 404
+
+
+def test_metrics_need_the_token():
+    assert request_metrics("token") == 401
+    assert request_metrics("token", {"Authorization": "Bearer wrong"}) == 401
+    assert request_metrics("token", {"Authorization": "Bearer token"}) == 200
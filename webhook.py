@@ -0,0 +1,148 @@
+import asyncio
+import hashlib
+import logging
+import signal
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+from config import (
+    METRICS_TOKEN,
+    PORT,
+    TELEGRAM_BOT_TOKEN,
+    WEBHOOK_CONCURRENCY,
+    WEBHOOK_MAX_PENDING,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    WEBHOOK_URL,
+)
+from metrics import ERRORS, authorized_metrics_handler
+
+logger = logging.getLogger(__name__)
+
+
+# Processes updates concurrently across chats while keeping each chat's updates in arrival order.
+# on_update(update) runs as soon as an update is accepted, before it waits behind the chat's earlier ones.
+class ChatOrderedDispatcher:
+    def __init__(
+        self,
+        application: Application,
+        concurrency: int = WEBHOOK_CONCURRENCY,
+        max_pending: int = WEBHOOK_MAX_PENDING,
+        on_update=None,
+    ):
+        self.application = application
+        self.on_update = on_update
+        self.max_pending = max_pending
+        self.pending = 0
+        self.processed = 0
+        self.rejected = 0
+        self._semaphore = asyncio.Semaphore(concurrency)
+        # chat id -> task of the newest update for that chat
+        self._tails = {}
+
+    def submit(self, update: Update) -> bool:
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            return False
+        self.pending += 1
+        if self.on_update is not None:
+            self.on_update(update)
+        chat_id = update.effective_chat.id if update.effective_chat else None
+        previous = self._tails.get(chat_id) if chat_id is not None else None
+        task = asyncio.get_running_loop().create_task(self._process(update, previous))
+        if chat_id is not None:
+            self._tails[chat_id] = task
+            task.add_done_callback(lambda t: self._tails.pop(chat_id) if self._tails.get(chat_id) is t else None)
+        return True
+
+    async def _process(self, update: Update, previous):
+        try:
+            if previous is not None:
+                # Wait for the chat's previous update, whatever its outcome
+                await asyncio.wait({previous})
+            async with self._semaphore:
+                await self.application.process_update(update)
+            self.processed += 1
+        except Exception as e:
+            ERRORS.inc(where="dispatcher", type=type(e).__name__)
+            logger.error("Error processing update", exc_info=True, extra={"update_id": update.update_id})
+        finally:
+            self.pending -= 1
+
+    async def drain(self):
+        tasks = list(self._tails.values())
+        if tasks:
+            await asyncio.wait(tasks)
+
+
+class WebhookServer:
+    def __init__(
+        self,
+        application: Application,
+        path: str = WEBHOOK_PATH,
+        secret: str = WEBHOOK_SECRET,
+        on_update=None,
+        metrics_token: str = METRICS_TOKEN,
+    ):
+        self.application = application
+        self.path = "/" + path.strip("/")
+        # Telegram echoes the secret in a header; derived from the token when not configured
+        self.secret = secret or hashlib.sha256(TELEGRAM_BOT_TOKEN.encode("utf-8")).hexdigest()[:32]
+        self.dispatcher = ChatOrderedDispatcher(application, on_update=on_update)
+        self.app = web.Application()
+        self.app.router.add_post(self.path, self.handle_update)
+        self.app.router.add_get("/health", self.health)
+        if metrics_token:
+            # The webhook port is public; metrics are otherwise only served locally, see start_metrics_server
+            self.app.router.add_get("/metrics", authorized_metrics_handler(metrics_token))
+        self.app.router.add_get("/", self.health)
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != self.secret:
+            return web.Response(status=403)
+        try:
+            update = Update.de_json(await request.json(), self.application.bot)
+        except Exception as e:
+            logger.warning("Invalid webhook payload: %s", e)
+            return web.Response(status=400)
+        if not self.dispatcher.submit(update):
+            # Telegram retries the delivery later
+            return web.Response(status=503)
+        return web.Response()
+
+    async def health(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "status": "ok",
+            "pending_updates": self.dispatcher.pending,
+            "processed_updates": self.dispatcher.processed,
+            "rejected_updates": self.dispatcher.rejected,
+        })
+
+
+async def run_webhook(application: Application, url: str = WEBHOOK_URL, port: int = PORT, on_update=None):
+    server = WebhookServer(application, on_update=on_update)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    runner = web.AppRunner(server.app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, "0.0.0.0", port).start()
+        await application.bot.set_webhook(
+            url=url.rstrip("/") + server.path,
+            secret_token=server.secret,
+            drop_pending_updates=True,
+        )
+        logger.info("Webhook server listening", extra={"port": port})
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+        await server.dispatcher.drain()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        await application.shutdown()